@@ -0,0 +1,215 @@
+""" Write-behind notification of completed uploads: success_redirect_endpoint
+queues an event and answers at once, and a thread delivers the events queued
+to the backend (NOTIFY_SINK) in batches.
+"""
+import collections, contextlib, errno, fcntl, json, logging, os, sqlite3, \
+    threading, time, urllib2
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationQueue(object):
+    """ Completed uploads on their way to the backend. Events are added to an
+    SQLite (WAL) table, so they survive restarts, and it holds at most
+    `max_pending` of them: put() refuses more. A thread hands them to `sink`
+    in batches of up to `batch_size`, oldest first, and removes them once
+    the sink has returned. If the sink raises, it gets the same batch again
+    after `retry_delay` seconds, doubled each time up to `max_retry_delay`.
+    Delivery is at least once: a batch taken just before a crash comes again.
+
+    Every server process can queue events in the same file; one of them at a
+    time (flock on `<path>.lock`) delivers. `totals` counts the events
+    queued, refused, delivered and the sink's failures, in this process.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created REAL NOT NULL,
+            event TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path, sink, max_pending=100000, batch_size=100,
+            retry_delay=1.0, max_retry_delay=60.0, interval=5.0):
+        self.path = path
+        self.sink = sink
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.interval = interval
+        self.totals = collections.Counter()
+        self.last_batch_seconds = 0.0
+        self.wakeup = threading.Event()
+        self.thread_pid = None
+        self._local = threading.local()
+        # taken to update totals (from request threads and the delivery
+        # thread alike) and to start the thread
+        self._lock = threading.Lock()
+
+    def put(self, event):
+        """ Queue event (a dict) and return at once; False if the queue is
+        full.
+        """
+        with self._transaction() as db:
+            first, last = db.execute('SELECT min(id), max(id) FROM events').fetchone()
+            if first is not None and last - first + 1 >= self.max_pending:
+                with self._lock:
+                    self.totals['rejected'] += 1
+                return False
+            db.execute('INSERT INTO events (created, event) VALUES (?, ?)',
+                (time.time(), json.dumps(event)))
+        with self._lock:
+            self.totals['queued'] += 1
+            if self.thread_pid != os.getpid():
+                thread = threading.Thread(target=self.run, name='notify')
+                thread.daemon = True
+                thread.start()
+                self.thread_pid = os.getpid()
+        self.wakeup.set()
+        return True
+
+    def pending(self):
+        """ (events queued, age in seconds of the oldest) """
+        first, last, created = self._connect().execute(
+            'SELECT min(id), max(id), (SELECT created FROM events ORDER BY id LIMIT 1) '
+            'FROM events').fetchone()
+        if first is None:
+            return 0, 0.0
+        return last - first + 1, time.time() - created
+
+    def run(self):
+        delay = None
+        while True:
+            if delay:
+                time.sleep(delay)
+            else:
+                self.wakeup.wait(self.interval)
+                self.wakeup.clear()
+            try:
+                self.deliver()
+                delay = None
+            except Exception:
+                with self._lock:
+                    self.totals['failures'] += 1
+                delay = min(max(2 * (delay or 0), self.retry_delay), self.max_retry_delay)
+                logger.exception('Delivering notifications failed, retrying in %gs', delay)
+
+    def deliver(self):
+        """ Hand the queued events to the sink until there are none left.
+        Returns how many were delivered, or None if another process is
+        delivering them; raises what the sink raises.
+        """
+        lock = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EACCES):
+                    return None
+                raise
+            delivered = 0
+            while True:
+                rows = self._connect().execute('SELECT id, event FROM events ORDER BY id LIMIT ?',
+                    (self.batch_size,)).fetchall()
+                if not rows:
+                    return delivered
+                started = time.time()
+                self.sink([json.loads(event) for _, event in rows])
+                self.last_batch_seconds = time.time() - started
+                with self._transaction() as db:
+                    db.execute('DELETE FROM events WHERE id <= ?', (rows[-1][0],))
+                delivered += len(rows)
+                with self._lock:
+                    self.totals['delivered'] += len(rows)
+        finally:
+            os.close(lock)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _connect(self):
+        # A connection can't be shared by threads, nor survive a fork.
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=FULL')
+            db.executescript(self.SCHEMA)
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+
+class WebhookSink(object):
+    """ POSTs every batch to url as {"events": [...]}; an error status or no
+    answer within timeout seconds is a failure.
+    """
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, events):
+        notify = urllib2.Request(self.url, json.dumps({'events': events}),
+            {'Content-Type': 'application/json'})
+        urllib2.urlopen(notify, timeout=self.timeout).read()
+
+
+class SQLiteSink(object):
+    """ Adds every event to the completed_uploads table of an SQLite
+    database, for the backend to pick up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, events):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS completed_uploads ('
+                    'bucket TEXT, key TEXT, uuid TEXT, name TEXT, '
+                    'received REAL, event TEXT)')
+                db.executemany('INSERT INTO completed_uploads VALUES (?, ?, ?, ?, ?, ?)',
+                    [(event.get('bucket'), event.get('key'), event.get('uuid'),
+                      event.get('name'), event.get('received'), json.dumps(event))
+                     for event in events])
+        finally:
+            db.close()
+
+
+class FileSink(object):
+    """ Appends every event to a file, one JSON object a line. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, events):
+        with open(self.path, 'a') as out:
+            out.write(''.join(json.dumps(event) + '\n' for event in events))
+            out.flush()
+            os.fsync(out.fileno())
+
+
+def make_sink(spec):
+    """ The sink NOTIFY_SINK describes: an http(s):// URL to POST to,
+    sqlite:<path>, file:<path>, or module:callable.
+    """
+    if spec.startswith(('http://', 'https://')):
+        return WebhookSink(spec)
+    if spec.startswith('sqlite:'):
+        return SQLiteSink(spec[len('sqlite:'):])
+    if spec.startswith('file:'):
+        return FileSink(spec[len('file:'):])
+    if ':' in spec:
+        module, name = spec.split(':', 1)
+        return getattr(__import__(module, fromlist=[name]), name)
+    raise ValueError('Unknown NOTIFY_SINK: %r' % spec)
@@ -10,6 +10,17 @@ AWS_SERVER_SECRET_KEY = os.getenv("AWS_SERVER_SECRET_KEY")
 AWS_EXPECTED_BUCKET = 'fineuploadertest'
 AWS_MAX_SIZE = 15000000
 
+# Completed uploads are queued in this SQLite file and delivered to the backend
+# in the background (see notifications.py); None to not queue them.
+NOTIFY_QUEUE = None
+# Where they are delivered: an http(s):// URL they are POSTed to,
+# 'sqlite:<path>', 'file:<path>' (JSON lines) or 'module:callable'.
+NOTIFY_SINK = None
+# Most events queued; with more, the success endpoint answers 503.
+NOTIFY_MAX_PENDING = 100000
+# Most events delivered at once.
+NOTIFY_BATCH = 100
+
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
 
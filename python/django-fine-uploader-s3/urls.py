@@ -18,5 +18,6 @@ urlpatterns = patterns('',
     url(r'^$', 'views.home', name='home'),
     url(r'^s3/signature', 'views.handle_s3', name="s3_signee"),
     url(r'^s3/delete', 'views.handle_s3', name='s3_delete'),
-    url(r'^s3/success', 'views.success_redirect_endpoint', name="s3_succes_endpoint")
+    url(r'^s3/success', 'views.success_redirect_endpoint', name="s3_succes_endpoint"),
+    url(r'^metrics$', 'views.metrics', name='metrics')
 )
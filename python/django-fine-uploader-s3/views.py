@@ -4,7 +4,9 @@ from django.shortcuts import render
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 
-import base64, hmac, hashlib, json, sys
+import base64, collections, hmac, hashlib, json, re, sys, threading, time
+
+from notifications import NotificationQueue, make_sink
 
 try:
     import boto
@@ -24,13 +26,52 @@ def home(request):
     """
     return render(request, "index.html")
 
+_notification_queue = None
+_notification_lock = threading.Lock()
+
+def notification_queue():
+    """ This process's NotificationQueue of NOTIFY_QUEUE, or None. """
+    global _notification_queue
+    if settings.NOTIFY_QUEUE is None:
+        return None
+    with _notification_lock:
+        if _notification_queue is None:
+            _notification_queue = NotificationQueue(settings.NOTIFY_QUEUE,
+                make_sink(settings.NOTIFY_SINK or 'file:' + settings.NOTIFY_QUEUE + '.jsonl'),
+                max_pending=settings.NOTIFY_MAX_PENDING, batch_size=settings.NOTIFY_BATCH)
+    return _notification_queue
+
 @csrf_exempt
 def success_redirect_endpoint(request):
     """ This is where the upload will snd a POST request after the 
-    file has been stored in S3.
+    file has been stored in S3. The backend is told in the background (see
+    NOTIFY_QUEUE), so its latency is not the client's.
     """
+    notifications = notification_queue()
+    if notifications is not None:
+        event = dict(request.REQUEST.items())
+        event['received'] = time.time()
+        if not notifications.put(event):
+            response = make_response(503)
+            response['Retry-After'] = '10'
+            return response
     return make_response(200)
 
+def metrics(request):
+    """ Notification queue figures of this process, in the Prometheus text
+    format.
+    """
+    lines = []
+    notifications = notification_queue()
+    if notifications is not None:
+        depth, age = notifications.pending()
+        lines += ['fine_uploader_notifications_pending %d' % depth,
+                  'fine_uploader_notifications_oldest_seconds %.3f' % age,
+                  'fine_uploader_notifications_last_batch_seconds %.3f' % notifications.last_batch_seconds]
+        for name in ('queued', 'rejected', 'delivered', 'failures'):
+            lines.append('fine_uploader_notifications_%s_total %d' % (name, notifications.totals[name]))
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
+
 @csrf_exempt
 def handle_s3(request):
     """ View which handles all POST and DELETE requests sent by Fine Uploader
@@ -53,15 +94,25 @@ def handle_POST(request):
     else:
         request_payload = json.loads(request.body)
         headers = request_payload.get('headers', None)
-        if headers:
-            # The presence of the 'headers' property in the request payload 
-            # means this is a request to sign a REST/multipart request 
-            # and NOT a policy document
-            response_data = sign_headers(headers)
-        else:
-            if not is_valid_policy(request_payload):
-                return make_response(400, {'invalid': True})
-            response_data = sign_policy_document(request_payload)
+        try:
+            if headers:
+                # The presence of the 'headers' property in the request payload 
+                # means this is a request to sign a REST/multipart request 
+                # and NOT a policy document
+                if request.GET.get('v4') == 'true':
+                    response_data = sign_headers_v4(headers)
+                else:
+                    response_data = sign_headers(headers)
+            else:
+                if not is_valid_policy(request_payload):
+                    return make_response(400, {'invalid': True})
+                if request.GET.get('v4') == 'true':
+                    response_data = sign_policy_document_v4(request_payload)
+                else:
+                    response_data = sign_policy_document(request_payload)
+        except (ValueError, IndexError):
+            # a malformed credential scope
+            return make_response(400, json.dumps({'invalid': True}))
         response_payload = json.dumps(response_data)
         return make_response(200, response_payload)
 
@@ -106,19 +157,102 @@ def is_valid_policy(policy_document):
 
     return bucket == settings.AWS_EXPECTED_BUCKET and parsed_max_size == settings.AWS_MAX_SIZE
 
+# SigV4 signing keys kept, for the latest dates they were asked for
+SIGNING_KEY_DATES = 2
+# and at most this many of them, least recently used dropped first
+SIGNING_KEYS = 32
+
+_v2_hmac = None
+_v4_hmacs = collections.OrderedDict()
+_v4_lock = threading.Lock()
+
+def v2_hmac():
+    """ HMAC-SHA1 keyed with the secret key, set up once and copied for
+    every signature.
+    """
+    global _v2_hmac
+    if _v2_hmac is None:
+        _v2_hmac = hmac.new(str(settings.AWS_CLIENT_SECRET_KEY), digestmod=hashlib.sha1)
+    return _v2_hmac.copy()
+
+def v4_hmac(date, region, service='s3'):
+    """ HMAC-SHA256 keyed with the SigV4 signing key for date (YYYYMMDD),
+    region and service, copied from a cache that keeps the keys of the
+    latest SIGNING_KEY_DATES dates, SIGNING_KEYS at most.  Only S3
+    scopes are signed.
+    """
+    if not re.match(r'\d{8}$', date):
+        raise ValueError('Bad date in credential scope: %r' % date)
+    # Any name an S3-compatible store may use (`auto` for R2, MinIO's own
+    # names, ...), but short: it is part of the cache key.
+    if not re.match(r'[A-Za-z0-9_-]{1,32}$', region):
+        raise ValueError('Bad region in credential scope: %r' % region)
+    if service != 's3':
+        raise ValueError('Bad service in credential scope: %r' % service)
+    scope = (date, region, service)
+    with _v4_lock:
+        base = _v4_hmacs.pop(scope, None)
+        if base is not None:
+            _v4_hmacs[scope] = base
+    if base is None:
+        key = 'AWS4' + str(settings.AWS_CLIENT_SECRET_KEY)
+        for part in scope + ('aws4_request',):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        base = hmac.new(key, digestmod=hashlib.sha256)
+        with _v4_lock:
+            _v4_hmacs[scope] = base
+            dates = sorted(set(cached[0] for cached in _v4_hmacs))
+            for stale in [cached for cached in _v4_hmacs
+                          if cached[0] in dates[:-SIGNING_KEY_DATES]]:
+                del _v4_hmacs[stale]
+            while len(_v4_hmacs) > SIGNING_KEYS:
+                _v4_hmacs.popitem(last=False)
+    return base.copy()
+
 def sign_policy_document(policy_document):
     """ Sign and return the policy doucument for a simple upload.
     http://aws.amazon.com/articles/1434/#signyours3postform
     """
     policy = base64.b64encode(json.dumps(policy_document))
-    signature = base64.b64encode(hmac.new(settings.AWS_CLIENT_SECRET_KEY, policy, hashlib.sha1).digest())
+    hmac_v = v2_hmac()
+    hmac_v.update(policy)
     return {
         'policy': policy,
-        'signature': signature
+        'signature': base64.b64encode(hmac_v.digest())
     }
 
 def sign_headers(headers):
     """ Sign and return the headers for a chunked upload. """
+    hmac_v = v2_hmac()
+    hmac_v.update(headers.encode('utf-8'))
+    return {
+        'signature': base64.b64encode(hmac_v.digest())
+    }
+
+def sign_policy_document_v4(policy_document):
+    """ Sign and return the policy document for a simple upload with SigV4,
+    for the date and region of its x-amz-credential condition.
+    """
+    credential = [condition['x-amz-credential'] for condition in policy_document['conditions']
+                  if isinstance(condition, dict) and 'x-amz-credential' in condition][0]
+    (_, date, region, service, _) = credential.split('/')
+    policy = base64.b64encode(json.dumps(policy_document))
+    hmac_v = v4_hmac(date, region, service)
+    hmac_v.update(policy)
+    return {
+        'policy': policy,
+        'signature': hmac_v.hexdigest()
+    }
+
+def sign_headers_v4(headers):
+    """ Sign and return the headers for a chunked upload with SigV4. Fine
+    Uploader sends the canonical request in place of its hash.
+    """
+    (algorithm, amz_date, scope, canonical_request) = headers.split('\n', 3)
+    (date, region, service, _) = scope.split('/')
+    hashed_request = hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+    hmac_v = v4_hmac(date, region, service)
+    hmac_v.update('\n'.join((algorithm, amz_date, scope, hashed_request)).encode('utf-8'))
     return {
-        'signature': base64.b64encode(hmac.new(settings.AWS_CLIENT_SECRET_KEY, headers, hashlib.sha1).digest())
+        'signature': hmac_v.hexdigest()
     }
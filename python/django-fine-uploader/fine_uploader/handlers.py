@@ -0,0 +1,105 @@
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from django.http.multipartparser import MultiPartParser
+
+from fine_uploader.forms import UploadFileForm
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    """ Writes `qqfile` straight to where its upload (or chunk) is stored
+    as the request body is parsed, instead of having Django spool it to a
+    temporary file or memory for the view to copy again.
+
+    Where the file goes depends on the fields sent before it, which Fine
+    Uploader does, so this handler runs the multipart parser itself to see
+    them. If they are missing or invalid, the file is left to the other
+    upload handlers and the view handles it as usual.
+
+    `open_upload` is called with the cleaned fields and returns the writer
+    for the file, or None if its bytes are not needed. What it raises
+    (ValueError or KeyError for an invalid upload) comes out of the
+    parsing, i.e. of the view's first use of request.POST or request.FILES.
+
+    Django hands upload handlers the files of a request but not its other
+    fields: those are read from the parser's _post, which is private. It is
+    there in the Django of requirements.txt (1.6); with a Django without it
+    the file is left to the other upload handlers, as if fields were missing.
+    """
+
+    def __init__(self, request, open_upload):
+        super(StreamingUploadHandler, self).__init__(request)
+        self.open_upload = open_upload
+        self.parser = None
+        self.received_file = False
+        self.streaming = False
+        self.upload = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if self.parser is not None:
+            return None
+        handlers = [self] + [handler for handler in self.request.upload_handlers
+            if handler is not self]
+        self.parser = MultiPartParser(META, input_data, handlers, encoding)
+        try:
+            return self.parser.parse()
+        except Exception:
+            self.upload_complete()
+            raise
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None):
+        super(StreamingUploadHandler, self).new_file(field_name, file_name,
+            content_type, content_length, charset)
+        self.streaming = False
+        if field_name != 'qqfile' or self.received_file:
+            return
+        self.received_file = True
+
+        fields = getattr(self.parser, '_post', None)
+        if fields is None:
+            return
+        form = UploadFileForm(fields)
+        del form.fields['qqfile']
+        if not form.is_valid():
+            return
+        self.upload = self.open_upload(form.cleaned_data)
+        self.streaming = True
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.streaming:
+            return raw_data
+        if self.upload is not None:
+            self.upload.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.streaming:
+            return None
+        self.streaming = False
+        upload, self.upload = self.upload, None
+        if upload is None:
+            result = {}
+        elif not file_size:
+            # Rejected by the form, like any empty file.
+            upload.abort()
+            result = {}
+        else:
+            result = upload.close()
+        return StoredUpload(self.file_name, self.content_type, file_size,
+            self.charset, result)
+
+    def upload_complete(self):
+        # The body ended (or failed) in the middle of the file.
+        if self.upload is not None:
+            upload, self.upload = self.upload, None
+            upload.abort()
+
+
+class StoredUpload(UploadedFile):
+    """ A `qqfile` already stored by StreamingUploadHandler. Its `result`
+    holds the extra response fields from storing it.
+    """
+
+    def __init__(self, name, content_type, size, charset, result):
+        super(StoredUpload, self).__init__(None, name, content_type, size, charset)
+        self.result = result
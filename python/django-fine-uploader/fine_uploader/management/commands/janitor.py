@@ -0,0 +1,23 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fine_uploader.views import janitor
+
+
+class Command(BaseCommand):
+    help = ('Reclaims the chunks of abandoned uploads (see JANITOR_MAX_AGE '
+        'and JANITOR_BUDGET) once, and prints what was reclaimed.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rescan', action='store_true', dest='rescan',
+            default=False,
+            help='Also look for uploads missing from the index.'),
+    )
+
+    def handle(self, *args, **options):
+        stats = janitor().run(rescan=options['rescan'])
+        if stats is None:
+            raise CommandError('Another janitor is running')
+        self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
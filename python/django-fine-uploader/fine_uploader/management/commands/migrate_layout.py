@@ -0,0 +1,15 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from fine_uploader.views import migrate_layout
+
+
+class Command(BaseCommand):
+    help = ('Moves the uploads stored directly in UPLOAD_DIRECTORY into the '
+        'shards of SHARD_LEVELS, while the server keeps running, and prints '
+        'how many were moved.')
+
+    def handle(self, *args, **options):
+        stats = migrate_layout()
+        self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
@@ -0,0 +1,16 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fine_uploader.views import reaper
+
+
+class Command(BaseCommand):
+    help = ('Removes the deleted uploads in TRASH_DIRECTORY once, at the pace '
+        'of REAPER_RATE, and prints what was freed.')
+
+    def handle(self, *args, **options):
+        stats = reaper().run()
+        if stats is None:
+            raise CommandError('Another reaper is running')
+        self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
@@ -1,39 +1,1569 @@
-import os, os.path, shutil
+import binascii, bisect, collections, contextlib, errno, hashlib, io, multiprocessing.pool, os, os.path, shutil, sqlite3, stat, struct, tempfile, threading, time
 
-def combine_chunks(total_parts, total_size, source_folder, dest):
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+# Size of the buffer used when a part cannot be copied inside the kernel.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# S3's limits on the parts of a multipart upload: all but the last must be at
+# least S3_MIN_PART_SIZE bytes, and there can be no more than S3_MAX_PARTS.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+
+# Most uploads a listing returns, or a bulk delete takes, at once, and the
+# largest bulk delete request body accepted, in bytes.
+LISTING_LIMIT = 1000
+MAX_FIELDS_SIZE = 64 * 1024
+
+# Errors meaning "this pair of files can't be spliced, try the next method".
+SPLICE_FALLBACK_ERRNOS = frozenset(getattr(errno, code) for code in
+    ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF')
+    if hasattr(errno, code))
+
+def combine_chunks(total_parts, total_size, source_folder, dest, progress=None):
     """ Combine a chunked file into a whole file again. Goes through each part
     , in order, and appends that part's bytes to another destination file.
+    The bytes are spliced by the kernel where possible (see `copy_range`), so
+    memory use does not grow with the chunk size.
 
     Chunks are stored in media/chunks
     Uploads are saved in media/uploads
+
+    `progress`, if given, is called with the number of bytes written so far
+    after each part.
+
+    Returns a dict with the bytes written, the seconds it took, the
+    throughput in bytes/sec and the copy method(s) used.
     """
 
-    if not os.path.exists(os.path.dirname(dest)):
-        os.makedirs(os.path.dirname(dest))
+    ensure_dir(os.path.dirname(dest))
 
-    with open(dest, 'wb+') as destination:
-        for i in xrange(total_parts):
+    started = time.time()
+    written = 0
+    methods = set()
+    destination = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o666)
+    try:
+        for i in range(total_parts):
             part = os.path.join(source_folder, str(i))
-            with open(part, 'rb') as source:
-                destination.write(source.read())
+            source = os.open(part, os.O_RDONLY | O_BINARY)
+            try:
+                copied, method = copy_range(source, destination,
+                    os.fstat(source).st_size)
+            finally:
+                os.close(source)
+            written += copied
+            methods.add(method)
+            if progress is not None:
+                progress(written)
+    finally:
+        os.close(destination)
+
+    elapsed = time.time() - started
+    return {
+        'bytes': written,
+        'seconds': elapsed,
+        'bytes_per_sec': written / elapsed if elapsed > 0 else float(written),
+        'method': '+'.join(sorted(methods)),
+    }
+
+
+def copy_range(source, destination, count):
+    """ Copy `count` bytes from the current offset of the `source` file
+    descriptor to the current offset of `destination`.
+
+    copy_file_range(2) and sendfile(2) keep the bytes inside the kernel; when
+    neither is available (or the filesystems refuse), the copy carries on
+    through a buffer of COPY_BUFFER_SIZE bytes. Both descriptors' offsets
+    advance as bytes are copied, so a method can give up half way through
+    and the next one picks up where it stopped.
+
+    Returns a tuple of (bytes copied, name of the method that finished).
+    """
+    remaining = count
+    for name, method in COPY_METHODS:
+        try:
+            while remaining > 0:
+                copied = method(source, destination, remaining)
+                if not copied:
+                    break
+                remaining -= copied
+        except OSError as e:
+            if method is not _buffered_copy and e.errno in SPLICE_FALLBACK_ERRNOS:
+                continue
+            raise
+        return count - remaining, name
+
+
+def _copy_file_range(source, destination, count):
+    return os.copy_file_range(source, destination, count)
+
+
+def _sendfile(source, destination, count):
+    return os.sendfile(destination, source, None, count)
+
+
+def _buffered_copy(source, destination, count):
+    data = os.read(source, min(count, COPY_BUFFER_SIZE))
+    view = memoryview(data)
+    while view:
+        view = view[os.write(destination, view):]
+    return len(data)
+
+
+COPY_METHODS = [(name, method) for name, method, available in (
+    ('copy_file_range', _copy_file_range, hasattr(os, 'copy_file_range')),
+    ('sendfile', _sendfile, hasattr(os, 'sendfile')),
+    ('buffered', _buffered_copy, True),
+) if available]
+
+
+class FileWriter(object):
+    """ Writes a file under a temporary name and renames it into place on
+    `close`, so a retried chunk never truncates a part another request is
+    reading. `close` returns the number of bytes written.
+    """
+
+    def __init__(self, path):
+        ensure_dir(os.path.dirname(path))
+        self.path = path
+        self.temp = os.path.join(os.path.dirname(path), '.%s.%s' % (
+            os.path.basename(path), binascii.hexlify(os.urandom(6)).decode('ascii')))
+        self.file = open(self.temp, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        try:
+            self.file.close()
+            os.rename(self.temp, self.path)
+        except Exception:
+            self.abort()
+            raise
+        return self.size
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp):
+            os.unlink(self.temp)
+
+
+class OffsetWriter(object):
+    """ Writes one chunk of an upload straight into the file it belongs to,
+    at its byte offset. Whichever chunk arrives first creates the file at
+    its full size, so the chunks can be written in any order and nothing
+    is left to combine once the last one is in. `close` returns the number
+    of bytes written.
+    """
+
+    def __init__(self, path, offset, total_size):
+        ensure_dir(os.path.dirname(path))
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | O_BINARY, 0o666)
+        try:
+            if os.fstat(self.fd).st_size < total_size:
+                os.ftruncate(self.fd, total_size)
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.offset = offset
+        self.size = 0
+
+    def write(self, data):
+        pwrite_all(self.fd, data, self.offset + self.size)
+        self.size += len(data)
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = None
+        return self.size
+
+    def abort(self):
+        # A chunk written half way is simply written again by its retry.
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def check_uuid(uuid):
+    """ Return `uuid`, the name of an upload's folders, if it is safe to use
+    in a path: not empty, not hidden, with no path separator. Raises
+    ValueError otherwise.
+    """
+    if (not uuid or uuid.startswith('.') or '/' in uuid or os.sep in uuid
+            or '\0' in uuid):
+        raise ValueError('Invalid upload uuid: %r' % uuid)
+    return uuid
+
+
+def safe_filename(filename):
+    """ Return `filename`, the name an upload is stored under in its folder,
+    if it is safe to use in a path: a plain file name, not '.' or '..' and
+    with no path separator. Raises ValueError otherwise.
+    """
+    if (not filename or filename in ('.', '..') or '/' in filename
+            or os.sep in filename or '\0' in filename):
+        raise ValueError('Invalid file name: %r' % filename)
+    return filename
+
+
+def partial_path(dest):
+    """ Where an upload written in place lives until its last chunk is in."""
+    return os.path.join(os.path.dirname(dest), '.%s.part' % os.path.basename(dest))
+
+
+if hasattr(os, 'pwrite'):
+    pwrite = os.pwrite
+else:
+    def pwrite(fd, data, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+
+def ensure_dir(path):
+    """ os.makedirs that doesn't mind another request creating `path` first."""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class Layout(object):
+    """ Where the folder of each upload goes under `root`: directly in it,
+    or below `levels` levels of shard folders named after the first `width`
+    characters of the uuid, dashes left out (ab/cd/abcd1234-... for two
+    levels of two), so that no directory gets too big to look things up in,
+    list or back up. Folders a flat layout left directly in `root` are still
+    found until `migrate` moves them into their shards.
+    """
+
+    def __init__(self, root, levels=0, width=2):
+        self.root = root
+        self.levels = levels
+        self.width = width
+
+    def path(self, uuid):
+        """ Where the folder of `uuid` belongs."""
+        name = uuid.replace('-', '').ljust(self.levels * self.width, '_')
+        shards = [name[level * self.width:(level + 1) * self.width]
+            for level in range(self.levels)]
+        return os.path.join(self.root, *(shards + [uuid]))
+
+    def find(self, uuid):
+        """ The folder of `uuid`: where it belongs, unless it is still where
+        a flat layout put it.
+        """
+        path = self.path(uuid)
+        if self.levels and not os.path.isdir(path):
+            flat = os.path.join(self.root, uuid)
+            if os.path.isdir(flat):
+                return flat
+        return path
+
+    def uuids(self):
+        """ The uuid of every folder under `root`, in its shard or not."""
+        return self._walk(self.root, 0)
 
+    def migrate(self, busy=None):
+        """ Move the folders a flat layout left directly in `root` into
+        their shards, one rename(2) each, while the server keeps running.
+        Folders for which `busy(uuid)` is true, and ones whose shard already
+        holds a folder of the same name, are left where they are. Returns
+        how many were moved and skipped.
+        """
+        stats = collections.Counter(moved=0, skipped=0)
+        if not self.levels or not os.path.isdir(self.root):
+            return dict(stats)
+        for name in os.listdir(self.root):
+            flat = os.path.join(self.root, name)
+            if (name.startswith('.') or self._is_shard(name, 0) or
+                    not os.path.isdir(flat)):
+                continue
+            path = self.path(name)
+            if (busy is not None and busy(name)) or os.path.exists(path):
+                stats['skipped'] += 1
+                continue
+            ensure_dir(os.path.dirname(path))
+            os.rename(flat, path)
+            stats['moved'] += 1
+        return dict(stats)
 
-def save_upload(f, path):
-    """ Save an upload. Django will automatically "chunk" incoming files
-    (even when previously chunked by fine-uploader) to prevent large files
-    from taking up your server's memory. If Django has chunked the file, then
-    write the chunks, otherwise, save as you would normally save a file in
-    Python.
+    def _is_shard(self, name, depth):
+        # Below the first level every name is a shard; at the top, a
+        # legacy upload folder may sit next to the shards.
+        return (not name.startswith('.') and depth < self.levels and
+            (depth > 0 or len(name) == self.width))
 
-    Uploads are stored in media/uploads
+    def _walk(self, folder, depth):
+        try:
+            names = os.listdir(folder)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if self._is_shard(name, depth):
+                for uuid in self._walk(os.path.join(folder, name), depth + 1):
+                    yield uuid
+            elif not name.startswith('.'):
+                yield name
+
+
+class PartTracker(object):
+    """ Keeps track of which chunks of an upload have arrived, in whatever
+    order they come in. The record is a small file next to the chunks that
+    is read and updated under an exclusive flock(2), so every thread and
+    every pre-forked worker process sees the same state.
+
+    The file holds a header (state, total parts, parts and bytes received,
+    total size, bytes assembled) followed by one fixed-size record per part.
+    Every new upload is also appended to an index of the uploads in the
+    chunks directory `root` (by default the parent of `folder`), which the
+    Janitor works from.
+    """
+    FILENAME = '.parts'
+    INDEX = '.index'
+    MAGIC = b'FUP1'
+    HEADER = struct.Struct('<4sB3xIIQQQ')
+    RECORD = struct.Struct('<B7xQ')
+    Header = collections.namedtuple('Header', 'magic state total_parts '
+        'received total_size received_bytes assembled_bytes')
+
+    RECEIVING = 0
+    ASSEMBLING = 1
+    FAILED = 2
+    STATES = {RECEIVING: 'receiving', ASSEMBLING: 'assembling', FAILED: 'failed'}
+
+    def __init__(self, folder, root=None):
+        self.folder = folder
+        self.root = root if root is not None else os.path.dirname(folder)
+        self.path = os.path.join(folder, self.FILENAME)
+
+    def add(self, index, size, total_parts, total_size):
+        """ Record part `index` (`size` bytes long) as received. Returns
+        (completed, new): completed is True for exactly one caller, the one
+        whose part completed the upload; new is whether the part had not
+        been received before (rather than sent again).
+        """
+        if not 0 <= index < total_parts:
+            raise ValueError('Part %d is out of range (%d parts)' % (index, total_parts))
+
+        ensure_dir(self.folder)
+        with locked_file(self.path) as fd:
+            header = self._read_header(fd)
+            if header is None:
+                header = self.Header(self.MAGIC, self.RECEIVING, total_parts, 0,
+                    total_size, 0, 0)
+                self._register()
+
+            record_offset = self.HEADER.size + index * self.RECORD.size
+            record = self._read(fd, record_offset, self.RECORD)
+            new = record is None or not record[0]
+            if new:
+                header = header._replace(received=header.received + 1,
+                    received_bytes=header.received_bytes + size)
+            elif record[1] != size:
+                header = header._replace(
+                    received_bytes=header.received_bytes + size - record[1])
+            pwrite_all(fd, self.RECORD.pack(1, size), record_offset)
+
+            # A chunk sent again after assembling failed: assemble again.
+            if header.state == self.FAILED:
+                header = header._replace(state=self.RECEIVING, assembled_bytes=0)
+            completed = (header.state == self.RECEIVING and
+                header.received == header.total_parts)
+            if completed:
+                header = header._replace(state=self.ASSEMBLING)
+            pwrite_all(fd, self.HEADER.pack(*header), 0)
+            return completed, new
+
+    def set_progress(self, assembled_bytes):
+        """ Record how many bytes of the upload have been assembled."""
+        self._update(assembled_bytes=assembled_bytes)
+
+    def set_failed(self):
+        """ Record that assembling the upload failed."""
+        self._update(state=self.FAILED)
+
+    def failed(self):
+        """ Whether assembling the upload failed (and has not been retried)."""
+        header = self.header()
+        return header is not None and header.state == self.FAILED
+
+    def received(self, index):
+        """ The size of part `index` if it has been received, otherwise None.
+        """
+        with locked_file(self.path, shared=True) as fd:
+            record = fd is not None and self._read(fd,
+                self.HEADER.size + index * self.RECORD.size, self.RECORD)
+        return record[1] if record and record[0] else None
+
+    def status(self):
+        """ What is known about the upload, as a dict holding its state,
+        total parts and size, bytes received and assembled, and the
+        (index, size) of every part received so far. None if no part has
+        been received.
+        """
+        with locked_file(self.path, shared=True) as fd:
+            header = fd is not None and self._read_header(fd)
+            if not header:
+                return None
+            records = pread(fd, header.total_parts * self.RECORD.size, self.HEADER.size)
+
+        parts = []
+        for index in range(len(records) // self.RECORD.size):
+            flag, size = self.RECORD.unpack_from(records, index * self.RECORD.size)
+            if flag:
+                parts.append((index, size))
+        return {
+            'state': self.STATES.get(header.state, 'unknown'),
+            'total_parts': header.total_parts,
+            'total_size': header.total_size,
+            'received_bytes': header.received_bytes,
+            'assembled_bytes': header.assembled_bytes,
+            'parts': parts,
+        }
+
+    def header(self):
+        """ The Header of the upload, or None if no part has been received."""
+        with locked_file(self.path, shared=True) as fd:
+            return fd is not None and self._read_header(fd) or None
+
+    def _register(self):
+        index = os.path.join(self.root, self.INDEX)
+        with locked_file(index) as fd:
+            os.lseek(fd, 0, os.SEEK_END)
+            os.write(fd, (os.path.basename(self.folder) + '\n').encode('utf-8'))
+
+    def _update(self, **changes):
+        with locked_file(self.path) as fd:
+            header = self._read_header(fd)
+            if header is not None:
+                pwrite_all(fd, self.HEADER.pack(*header._replace(**changes)), 0)
+
+    def _read_header(self, fd):
+        header = self._read(fd, 0, self.HEADER)
+        return header and self.Header(*header)
+
+    def _read(self, fd, offset, layout):
+        data = pread(fd, layout.size, offset)
+        if len(data) < layout.size:
+            return None
+        return layout.unpack(data)
+
+
+@contextlib.contextmanager
+def locked_file(path, shared=False):
+    """ Open `path`, creating it if needed, and hold an exclusive lock on it
+    for the duration of the with block. With `shared`, the file is opened
+    read-only under a shared lock instead, and None is yielded if it does
+    not exist. Without flock(2) (Windows) the lock only covers the threads
+    of this process, and is held for every file at once.
     """
-    if not os.path.exists(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
-    with open(path, 'wb+') as destination:
-        if hasattr(f, 'multiple_chunks') and f.multiple_chunks():
-            for chunk in f.chunks():
-                destination.write(chunk)
+    if shared:
+        try:
+            fd = os.open(path, os.O_RDONLY | O_BINARY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            yield None
+            return
+    else:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | O_BINARY, 0o666)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
         else:
-            destination.write(f.read())
+            _file_lock.acquire()
+        try:
+            yield fd
+        finally:
+            if fcntl is None:
+                _file_lock.release()
+    finally:
+        # Closing the descriptor also releases the flock.
+        os.close(fd)
+
+_file_lock = threading.RLock()
+
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = pwrite(fd, view, offset)
+        offset += written
+        view = view[written:]
+
+
+if hasattr(os, 'pread'):
+    pread = os.pread
+else:
+    def pread(fd, size, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+class RunningDigests(object):
+    """ The content digests of the chunked uploads in progress in this
+    process, fed with each chunk's bytes as they are written. A chunk can
+    only be fed when it starts exactly where its digest has got to; the
+    bytes of any other chunk (out of order, or received by another worker
+    process) are hashed when the upload is finished, by reading just those
+    bytes back (see `finish_digest`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._digests = {}
+
+    def checkout(self, uuid, offset, algorithm):
+        """ The digest to feed with the chunk of `uuid` that starts at
+        `offset`, or None if it can't be fed (or `algorithm` is None). Hand
+        it back with `checkin` once the chunk is written.
+        """
+        if not algorithm or offset is None:
+            return None
+        with self._lock:
+            digest = self._digests.get(uuid)
+            if digest is None and offset == 0:
+                digest = self._digests[uuid] = RunningDigest(algorithm)
+            if digest is None or digest.busy or digest.offset != offset:
+                return None
+            digest.busy = True
+            return digest
+
+    def checkin(self, uuid, digest, failed=False):
+        """ Hand back a digest from `checkout`. A digest whose chunk `failed`
+        half way through is thrown away.
+        """
+        if digest is None:
+            return
+        if failed:
+            self.pop(uuid)
+            return
+        with self._lock:
+            digest.busy = False
+            digest.touched = time.time()
+
+    def pop(self, uuid):
+        """ Remove and return the running digest of `uuid`, if there is one."""
+        with self._lock:
+            return self._digests.pop(uuid, None)
+
+    def prune(self, before):
+        """ Forget the digests that have not been fed since `before` (a
+        time.time()). Returns how many were dropped.
+        """
+        with self._lock:
+            stale = [uuid for uuid, digest in self._digests.items()
+                if not digest.busy and digest.touched < before]
+            for uuid in stale:
+                del self._digests[uuid]
+        return len(stale)
+
+
+class RunningDigest(object):
+    """ A hashlib object plus how many bytes of the upload it has seen."""
+
+    def __init__(self, algorithm):
+        self.hasher = hashlib.new(algorithm)
+        self.offset = 0
+        self.busy = False
+        self.touched = time.time()
+
+    def update(self, data):
+        self.hasher.update(data)
+        self.offset += len(data)
+
+running_digests = RunningDigests()
+
+
+def finish_digest(digest, path, algorithm):
+    """ The hex digest of the file at `path`. `digest` is what the upload's
+    running digest got to: a hex digest if it saw every byte, a
+    RunningDigest to carry on from, or None to hash the file from scratch.
+    Only the bytes the running digest did not see are read.
+    """
+    if isinstance(digest, str):
+        return digest
+    if digest is None:
+        digest = RunningDigest(algorithm)
+    with open(path, 'rb') as source:
+        source.seek(digest.offset)
+        for data in iter(lambda: source.read(COPY_BUFFER_SIZE), b''):
+            digest.update(data)
+    return digest.hasher.hexdigest()
+
+
+def store_digest(dest, digest, algorithm):
+    """ Save the digest of an upload next to it, in the format of
+    sha256sum(1) and friends: `<dest>.<algorithm>`.
+    """
+    with io.open('%s.%s' % (dest, algorithm), 'w', encoding='utf-8') as sidecar:
+        sidecar.write(u'%s  %s\n' % (digest, os.path.basename(dest)))
+
+
+def read_digest(folder, algorithm):
+    """ The stored digest of the upload in `folder`, or None."""
+    if not algorithm or not os.path.isdir(folder):
+        return None
+    for name in os.listdir(folder):
+        if name.endswith('.' + algorithm):
+            with io.open(os.path.join(folder, name), encoding='utf-8') as sidecar:
+                return sidecar.read().split()[0]
+    return None
+
+
+def same_content(path, other):
+    """ Whether the files at `path` and `other` hold the same bytes."""
+    with open(path, 'rb') as f, open(other, 'rb') as g:
+        while True:
+            data = f.read(COPY_BUFFER_SIZE)
+            if data != g.read(COPY_BUFFER_SIZE):
+                return False
+            if not data:
+                return True
+
+
+class BlobStore(object):
+    """ Content-addressed store for completed uploads (UPLOAD_DEDUP): each
+    distinct content is kept once, as the blob `<root>/<algorithm>/ab/cd/
+    <digest>`, and every upload of it is a hard link to that blob, so
+    storing the same file again costs a directory entry. The link count is
+    the reference count: `release` removes a blob once no upload links to
+    it anymore. `root` has to be on the upload directory's file system.
+
+    Blobs are added and released under an exclusive flock(2) on `root`'s
+    lock file, so a blob is never removed while an upload is being linked
+    to it.
+    """
+    LOCKNAME = '.lock'
+
+    def __init__(self, root, algorithm):
+        self.root = root
+        self.algorithm = algorithm
+
+    def path(self, digest):
+        """ The blob of the content with `digest`."""
+        return os.path.join(self.root, self.algorithm, digest[:2], digest[2:4], digest)
+
+    def add(self, dest, digest):
+        """ Deduplicate the upload at `dest`, whose content has `digest`:
+        replace it with a link to the blob of that content if there is one
+        (and its bytes are the upload's: the digest alone is not trusted),
+        otherwise make it the blob. Returns whether a blob was reused.
+        """
+        blob = self.path(digest)
+        ensure_dir(os.path.dirname(blob))
+        with self._locked():
+            try:
+                os.link(dest, blob)
+                return False
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            info, blob_info = os.stat(dest), os.stat(blob)
+            if (info.st_dev, info.st_ino) == (blob_info.st_dev, blob_info.st_ino):
+                return False
+            if info.st_size != blob_info.st_size or not same_content(dest, blob):
+                # Not the same content after all (a digest collision, which
+                # can be made on purpose for md5 or sha1): keep the upload's
+                # own copy.
+                return False
+            link = os.path.join(os.path.dirname(dest), '.%s.%s' % (
+                os.path.basename(dest), binascii.hexlify(os.urandom(6)).decode('ascii')))
+            os.link(blob, link)
+            os.rename(link, dest)
+            return True
+
+    def release(self, digest, trash=None):
+        """ Drop the blob of the content with `digest` if no upload links to
+        it anymore. With `trash`, a folder on the same file system, the blob
+        is moved into it for a Reaper to free rather than unlinked. Returns
+        whether it was dropped.
+        """
+        blob = self.path(digest)
+        with self._locked():
+            try:
+                if os.stat(blob).st_nlink > 1:
+                    return False
+                if trash is None:
+                    os.unlink(blob)
+                else:
+                    os.rename(blob, os.path.join(trash, '%s.%s' % (digest,
+                        binascii.hexlify(os.urandom(6)).decode('ascii'))))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return False
+        return True
+
+    def _locked(self):
+        ensure_dir(self.root)
+        return locked_file(os.path.join(self.root, self.LOCKNAME))
+
+
+class UploadIndex(object):
+    """ A record of every upload in an SQLite database: its uuid, original
+    filename, state, total size and parts, parts and bytes received, digest,
+    and when it was started, last updated and completed. Looking an upload
+    up is then one query on the primary key rather than probing or listing
+    the upload directory.
+
+    The database is in WAL mode, so readers never wait for the writer and
+    every thread of every server process can share it; each gets its own
+    connection, opened on first use. Every method is one transaction.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS uploads (
+            uuid TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            state TEXT NOT NULL,
+            total_size INTEGER,
+            total_parts INTEGER,
+            received_parts INTEGER NOT NULL DEFAULT 0,
+            received_bytes INTEGER NOT NULL DEFAULT 0,
+            digest TEXT,
+            digest_algorithm TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            completed REAL
+        );
+        CREATE INDEX IF NOT EXISTS uploads_state ON uploads (state, uuid);
+    '''
+    RECEIVING = 'receiving'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def received(self, uuid, filename, size, total_parts, total_size):
+        """ Record a chunk of `size` bytes of the upload `uuid` as received,
+        once per chunk: not for one sent again.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO uploads (uuid, filename, state, '
+                'total_size, total_parts, created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (uuid, filename, self.RECEIVING, total_size, total_parts, now, now))
+            db.execute('UPDATE uploads SET received_parts = received_parts + 1, '
+                'received_bytes = received_bytes + ?, updated = ? WHERE uuid = ?',
+                (size, now, uuid))
+
+    def completed(self, uuid, filename, size, digest=None, algorithm=None):
+        """ Record the upload `uuid` as complete, `size` bytes long. An
+        upload that was not chunked is recorded here in one go.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO uploads (uuid, filename, state, '
+                'total_size, total_parts, received_parts, received_bytes, '
+                'created, updated) VALUES (?, ?, ?, ?, 1, 1, ?, ?, ?)',
+                (uuid, filename, self.RECEIVING, size, size, now, now))
+            db.execute('UPDATE uploads SET state = ?, total_size = ?, digest = ?, '
+                'digest_algorithm = ?, updated = ?, completed = ? WHERE uuid = ?',
+                (self.COMPLETE, size, digest, algorithm, now, now, uuid))
+
+    def failed(self, uuid):
+        """ Record that assembling the upload `uuid` failed."""
+        with self._transaction() as db:
+            db.execute('UPDATE uploads SET state = ?, updated = ? WHERE uuid = ?',
+                (self.FAILED, time.time(), uuid))
+
+    def remove(self, uuid):
+        """ Forget the upload `uuid`. Returns whether it was known."""
+        with self._transaction() as db:
+            return db.execute('DELETE FROM uploads WHERE uuid = ?', (uuid,)).rowcount > 0
+
+    def get(self, uuid):
+        """ The record of the upload `uuid` as a dict, or None."""
+        row = self._connect().execute('SELECT * FROM uploads WHERE uuid = ?',
+            (uuid,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def list(self, after=None, limit=100, state=None):
+        """ Up to `limit` records in uuid order, starting after the uuid
+        `after`, only those in `state` if given.
+        """
+        query, args = 'SELECT * FROM uploads WHERE uuid > ?', [after or '']
+        if state is not None:
+            query += ' AND state = ?'
+            args.append(state)
+        query += ' ORDER BY uuid LIMIT ?'
+        args.append(limit)
+        return [dict(row) for row in self._connect().execute(query, args)]
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _connect(self):
+        # A connection can't be shared by threads, nor survive a fork.
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            ensure_dir(os.path.dirname(os.path.abspath(self.path)))
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(self.SCHEMA)
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+
+class StorageError(Exception):
+    """ The upload store failed to do its part, e.g. lost parts of a
+    multipart upload. Not the client's fault: answered as a server error
+    rather than a bad request.
+    """
+
+
+class S3Storage(object):
+    """ Uploads kept in an S3-compatible store (UPLOAD_STORAGE = 's3'): the
+    upload at `dest`, `<uuid>/<filename>` in the (sharded) upload directory,
+    is the object `<prefix><uuid>/<filename>`.
+
+    One boto3 client, with its pool of connections, serves every thread.
+    Parts are sent by a pool of `max_in_flight` threads, and a writer with
+    a part to send waits while that many are on their way, so memory use
+    stays bounded however many uploads are coming in.
+    """
+    UPLOAD_ID = '.s3upload'
+
+    def __init__(self, bucket, prefix='', endpoint=None,
+            access_key=None, secret_key=None, part_size=8 * 1024 * 1024,
+            max_in_flight=4, spool_size=16 * 1024 * 1024):
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import ClientError
+        from botocore.utils import fix_s3_host
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, S3_MIN_PART_SIZE)
+        self.spool_size = spool_size
+        self.ClientError = ClientError
+        # Room for the part threads, and as many request threads again.
+        config = Config(max_pool_connections=max(10, 2 * max_in_flight),
+            s3={'addressing_style': 'path'} if endpoint else None)
+        self.client = boto3.client('s3', aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key, endpoint_url=endpoint, config=config)
+        if endpoint:
+            self.client.meta.events.unregister('before-sign.s3', fix_s3_host)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._pool = multiprocessing.pool.ThreadPool(max_in_flight)
+
+    def key(self, dest):
+        """ The object name of the upload at `dest`."""
+        folder, filename = os.path.split(dest)
+        return self.prefix + os.path.basename(folder) + '/' + filename
+
+    def forwards(self, total_parts, total_size):
+        """ Whether the chunks of an upload can be sent on as the parts of a
+        multipart upload: each chunk but the last is at least the average
+        size, which has to be enough for S3.
+        """
+        return (total_parts <= S3_MAX_PARTS and
+            total_size // total_parts >= S3_MIN_PART_SIZE)
+
+    def exists(self, dest):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(dest))
+        except self.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def has_upload(self, uuid):
+        """ Whether anything is stored for the upload `uuid`."""
+        found = self.client.list_objects_v2(Bucket=self.bucket,
+            Prefix=self.prefix + uuid + '/', MaxKeys=1)
+        return found.get('KeyCount', 0) > 0
+
+    def multipart_upload(self, folder, dest):
+        """ The id of the multipart upload that the chunks tracked in
+        `folder` (a PartTracker's) are sent to, started by whichever chunk
+        asks first; None if the upload has already been stored.
+        """
+        ensure_dir(folder)
+        with locked_file(os.path.join(folder, self.UPLOAD_ID)) as fd:
+            started = pread(fd, 4096, 0)
+            if started:
+                return started.decode('utf-8').split('\n')[0]
+            if self.exists(dest):
+                return None
+            key = self.key(dest)
+            upload_id = self.client.create_multipart_upload(Bucket=self.bucket,
+                Key=key)['UploadId']
+            pwrite_all(fd, (u'%s\n%s' % (upload_id, key)).encode('utf-8'), 0)
+            return upload_id
+
+    def send_part(self, key, upload_id, part_number, body):
+        """ Queue part `part_number` of a multipart upload, waiting while
+        too many parts are on their way. Returns an AsyncResult of the
+        part's {'ETag', 'PartNumber'}.
+        """
+        self._slots.acquire()
+        try:
+            return self._pool.apply_async(self._upload_part,
+                (key, upload_id, part_number, body))
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _upload_part(self, key, upload_id, part_number, body):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=key,
+                UploadId=upload_id, PartNumber=part_number, Body=body)
+            return {'ETag': response['ETag'], 'PartNumber': part_number}
+        finally:
+            self._slots.release()
+
+    def complete(self, folder, total_parts):
+        """ Complete the multipart upload of the chunks tracked in `folder`."""
+        upload_id, key = self._started(folder)
+        parts = []
+        pages = self.client.get_paginator('list_parts').paginate(
+            Bucket=self.bucket, Key=key, UploadId=upload_id)
+        for page in pages:
+            parts.extend({'ETag': part['ETag'], 'PartNumber': part['PartNumber']}
+                for part in page.get('Parts', ()))
+        if len(parts) != total_parts:
+            raise StorageError('%d of %d parts of %s are stored' % (len(parts),
+                total_parts, key))
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key,
+            UploadId=upload_id, MultipartUpload={'Parts': sorted(parts,
+                key=lambda part: part['PartNumber'])})
+
+    def abort_upload(self, folder):
+        """ Abort the multipart upload of the chunks tracked in `folder`, if
+        one was started. For the Janitor.
+        """
+        try:
+            upload_id, key = self._started(folder)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key,
+                UploadId=upload_id)
+        except self.ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+
+    def _started(self, folder):
+        with open(os.path.join(folder, self.UPLOAD_ID), 'rb') as f:
+            upload_id, key = f.read().decode('utf-8').split('\n', 1)
+        return upload_id, key
+
+    def upload_file(self, path, dest):
+        """ Store the file at `path` as the upload at `dest`."""
+        writer = S3Writer(self, self.key(dest))
+        try:
+            with open(path, 'rb') as source:
+                for data in iter(lambda: source.read(self.part_size), b''):
+                    writer.write(data)
+        except Exception:
+            writer.abort()
+            raise
+        return writer.close()
+
+    def delete(self, uuid):
+        """ Delete everything stored for the upload `uuid`."""
+        found = self.client.list_objects_v2(Bucket=self.bucket,
+            Prefix=self.prefix + uuid + '/')
+        keys = [{'Key': item['Key']} for item in found.get('Contents', ())]
+        if not keys:
+            raise OSError(errno.ENOENT, 'No such upload', uuid)
+        self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys})
+
+    def finish_digest(self, digest, dest, algorithm):
+        """ `finish_digest` for a stored upload: only the bytes the running
+        digest did not see are read back.
+        """
+        if isinstance(digest, str):
+            return digest
+        if digest is None:
+            digest = RunningDigest(algorithm)
+        request = {'Bucket': self.bucket, 'Key': self.key(dest)}
+        if digest.offset:
+            request['Range'] = 'bytes=%d-' % digest.offset
+        body = self.client.get_object(**request)['Body']
+        for data in iter(lambda: body.read(COPY_BUFFER_SIZE), b''):
+            digest.update(data)
+        return digest.hasher.hexdigest()
+
+    def store_digest(self, dest, digest, algorithm):
+        """ `store_digest`, as the object next to the upload's."""
+        self.client.put_object(Bucket=self.bucket,
+            Key='%s.%s' % (self.key(dest), algorithm),
+            Body=(u'%s  %s\n' % (digest, os.path.basename(dest))).encode('utf-8'))
+
+    def read_digest(self, uuid, algorithm):
+        """ `read_digest` for the upload `uuid`."""
+        if not algorithm:
+            return None
+        found = self.client.list_objects_v2(Bucket=self.bucket,
+            Prefix=self.prefix + uuid + '/')
+        for item in found.get('Contents', ()):
+            if item['Key'].endswith('.' + algorithm):
+                body = self.client.get_object(Bucket=self.bucket, Key=item['Key'])['Body']
+                return body.read().decode('utf-8').split()[0]
+        return None
+
+
+class S3Writer(object):
+    """ Streams a file to the object `key` as it is written: its bytes are
+    sent in parts of the storage's part size, without waiting for the
+    earlier ones. A file smaller than a part is sent in one request on
+    `close`, which returns the number of bytes written.
+    """
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.buffer = bytearray()
+        self.size = 0
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        part_size = self.storage.part_size
+        while len(self.buffer) >= part_size:
+            self._send(bytes(self.buffer[:part_size]))
+            del self.buffer[:part_size]
+
+    def close(self):
+        client = self.storage.client
+        if self.upload_id is None:
+            client.put_object(Bucket=self.storage.bucket, Key=self.key,
+                Body=bytes(self.buffer))
+            return self.size
+        try:
+            if self.buffer:
+                self._send(bytes(self.buffer))
+            parts = [part.get() for part in self.parts]
+            client.complete_multipart_upload(Bucket=self.storage.bucket,
+                Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        return self.size
+
+    def abort(self):
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        for part in self.parts:
+            part.wait()
+        upload_id, self.upload_id = self.upload_id, None
+        self.storage.client.abort_multipart_upload(Bucket=self.storage.bucket,
+            Key=self.key, UploadId=upload_id)
+
+    def _send(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.storage.client.create_multipart_upload(
+                Bucket=self.storage.bucket, Key=self.key)['UploadId']
+        self.parts.append(self.storage.send_part(self.key, self.upload_id,
+            len(self.parts) + 1, body))
+
+
+class S3PartWriter(object):
+    """ Receives one chunk of a chunked upload and sends it on, on `close`,
+    as part `part_number` of the upload's multipart upload. Until then it
+    is held in memory, or in a temporary file past the storage's spool
+    size. `close` returns the number of bytes written.
+    """
+
+    def __init__(self, storage, key, upload_id, part_number):
+        self.storage = storage
+        self.key = key
+        self.upload_id = upload_id
+        self.part_number = part_number
+        self.spool = tempfile.SpooledTemporaryFile(max_size=storage.spool_size)
+
+    def write(self, data):
+        self.spool.write(data)
+
+    def close(self):
+        with self.spool:
+            size = self.spool.tell()
+            self.spool.seek(0)
+            self.storage.send_part(self.key, self.upload_id, self.part_number,
+                self.spool).get()
+        return size
+
+    def abort(self):
+        self.spool.close()
+
+
+class Metrics(object):
+    """ Counters, gauges and histograms of what the server is doing, for the
+    /metrics endpoint in the Prometheus text format. Each server process
+    keeps its own.
+    """
+
+    # Upper bounds of the histogram buckets, in seconds.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+        2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = collections.OrderedDict()
+
+    def define(self, kind, name, documentation, labelled=False):
+        """ Add a 'counter', 'gauge' or 'histogram'. One that is not
+        `labelled` is reported from the start, as 0.
+        """
+        values = {}
+        if kind != 'histogram' and not labelled:
+            values[()] = 0
+        self._metrics[name] = (kind, documentation, values)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name][2]
+            values[key] = values.get(key, 0) + amount
+
+    def dec(self, name, amount=1, **labels):
+        self.inc(name, -amount, **labels)
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        bucket = bisect.bisect_left(self.BUCKETS, value)
+        with self._lock:
+            values = self._metrics[name][2]
+            counts = values.get(key)
+            if counts is None:
+                # A count per bucket (the last one unbounded), then the sum.
+                counts = values[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Observe how long the block takes."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, documentation, values) in self._metrics.items():
+                lines.append('# HELP %s %s' % (name, documentation))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key, value in sorted(values.items()):
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, _labels(key), _number(value)))
+                        continue
+                    total = 0
+                    for bound, count in zip(self.BUCKETS + (float('inf'),), value):
+                        total += count
+                        lines.append('%s_bucket%s %d' % (name,
+                            _labels(key + (('le', _number(bound)),)), total))
+                    lines.append('%s_sum%s %s' % (name, _labels(key), _number(value[-1])))
+                    lines.append('%s_count%s %d' % (name, _labels(key), total))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(key):
+    if not key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n')) for name, value in key)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return '%d' % value
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+metrics = Metrics()
+metrics.define('histogram', 'fine_uploader_phase_seconds', 'Seconds spent in '
+    'each phase of storing and deleting uploads: parse (reading and parsing '
+    'the request, less writing the file), write (writing the file as it '
+    'arrives), save (storing the received file or chunk), combine '
+    '(assembling the chunks), digest, transfer (uploading a file assembled '
+    'locally to S3), cleanup (removing the chunks) and delete.')
+metrics.define('histogram', 'fine_uploader_file_seconds', 'Seconds from the '
+    'start of an uploaded file to its being stored, by kind: upload (not '
+    'chunked), chunk, or final (the chunk that completed its upload).')
+metrics.define('counter', 'fine_uploader_files_total', 'Uploaded files and '
+    'chunks stored, by kind.', labelled=True)
+metrics.define('counter', 'fine_uploader_received_bytes_total', 'Bytes of '
+    'uploaded files and chunks received.')
+metrics.define('counter', 'fine_uploader_assembled_bytes_total', 'Bytes of '
+    'chunked uploads assembled.')
+metrics.define('counter', 'fine_uploader_deleted_uploads_total', 'Uploads deleted.')
+metrics.define('counter', 'fine_uploader_reaped_bytes_total', 'Bytes freed by '
+    'removing deleted uploads from the trash.')
+metrics.define('counter', 'fine_uploader_deduplicated_bytes_total', 'Bytes of '
+    'completed uploads stored as links to an existing blob (UPLOAD_DEDUP).')
+metrics.define('counter', 'fine_uploader_errors_total', 'Failures, by where: '
+    'request (rejected as invalid), upload (a file or chunk not stored), '
+    'assembly or delete.', labelled=True)
+metrics.define('gauge', 'fine_uploader_uploads_in_flight', 'Files and chunks '
+    'being received.')
+metrics.define('gauge', 'fine_uploader_assemblies_in_flight', 'Uploads being '
+    'assembled, or queued for it.')
+metrics.define('gauge', 'fine_uploader_deletes_in_flight', 'Uploads being deleted.')
+metrics.define('counter', 'fine_uploader_rejected_total', 'Upload requests '
+    'turned away by admission control, by reason: bytes (ADMISSION_MAX_BYTES), '
+    'assemblies (ADMISSION_MAX_ASSEMBLIES) or client (ADMISSION_CLIENT_RATE).',
+    labelled=True)
+
+
+class AdmissionControl(object):
+    """ Decides which upload requests to take on now and which to turn
+    away, so that a burst of uploads doesn't have the disks thrash between
+    them: the ones let in keep the disks near their best throughput, and the
+    others come back later (Fine Uploader retries them). A request is turned
+    away while
+
+    - the upload requests being received add up to more than `max_bytes`
+      (by their Content-Length; one is always let in when no other is being
+      received, however big),
+    - `max_assemblies` uploads are being assembled or queued for it, or
+    - its client has used up its token bucket: `client_rate` requests a
+      second, in bursts of up to `client_burst`. Buckets are kept for the
+      `max_clients` clients seen last.
+
+    None means no limit.
+    """
+
+    def __init__(self, max_bytes=None, max_assemblies=None, client_rate=None,
+            client_burst=10, max_clients=10000):
+        self.max_bytes = max_bytes
+        self.max_assemblies = max_assemblies
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+        self.bytes = 0
+        self.assemblies = 0
+        self._clients = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def admit(self, client, length):
+        """ Take on a request of `length` bytes from `client` and return
+        None, or turn it away and return why: 'bytes', 'assemblies' or
+        'client'. A request taken on has to be `release`d once it is over.
+        """
+        now = time.time()
+        with self._lock:
+            if self.max_assemblies is not None and self.assemblies >= self.max_assemblies:
+                return 'assemblies'
+            if (self.max_bytes is not None and self.bytes and
+                    self.bytes + length > self.max_bytes):
+                return 'bytes'
+            if self.client_rate is not None:
+                tokens, last = self._clients.pop(client, (self.client_burst, now))
+                tokens = min(self.client_burst, tokens + (now - last) * self.client_rate)
+                self._clients[client] = (tokens - 1 if tokens >= 1 else tokens, now)
+                if len(self._clients) > self.max_clients:
+                    self._clients.popitem(last=False)
+                if tokens < 1:
+                    return 'client'
+            self.bytes += length
+        return None
+
+    def release(self, length):
+        with self._lock:
+            self.bytes -= length
+
+    def assembling(self, count):
+        """ Count `count` more (or, negative, fewer) uploads being
+        assembled.
+        """
+        with self._lock:
+            self.assemblies += count
+
+
+class Janitor(object):
+    """ Reclaims the staging area from uploads that were abandoned part way:
+    their chunks and `.parts` record under the chunks directory and, when
+    they were written in place, their partial file in the upload directory.
+
+    Uploads are found through the index PartTracker appends every new
+    upload to, and dated and sized from their `.parts` record, so a run
+    never walks the chunk folders. An upload is expired once its record has
+    not changed for `max_age` seconds; while the uploads left take up more
+    than `budget` bytes, the least recently active ones that are still
+    receiving chunks are removed as well. `on_remove` is called with the
+    chunk folder of every upload removed, before the folder is.
+
+    `chunks` and `uploads` are the Layouts of the two directories.
+    """
+    LOCKNAME = '.janitor'
+    Staged = collections.namedtuple('Staged', 'uuid state size mtime')
+
+    def __init__(self, chunks, uploads, max_age, budget=None, on_remove=None):
+        self.chunks = chunks
+        self.uploads = uploads
+        self.max_age = max_age
+        self.budget = budget
+        self.on_remove = on_remove
+        self.totals = collections.Counter()
+
+    def run(self, rescan=False):
+        """ Make one pass over the staging area. With `rescan`, uploads the
+        index does not know about (staged by an older version, or whose
+        first chunk never got recorded) are picked up from a listing of the
+        chunks directory, and indexed from then on.
+
+        Returns the statistics of the run, or None if another process's
+        janitor is already running.
+        """
+        ensure_dir(self.chunks.root)
+        lock = os.open(os.path.join(self.chunks.root, self.LOCKNAME),
+            os.O_RDWR | os.O_CREAT | O_BINARY, 0o666)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as e:
+                    if e.errno in (errno.EAGAIN, errno.EACCES):
+                        return None
+                    raise
+            return self._run(rescan)
+        finally:
+            os.close(lock)
+
+    def _run(self, rescan):
+        started = time.time()
+        deadline = started - self.max_age
+        index = os.path.join(self.chunks.root, PartTracker.INDEX)
+
+        with locked_file(index) as fd:
+            indexed, indexed_size = self._read_index(fd, 0)
+        uuids = collections.OrderedDict.fromkeys(indexed)
+        if rescan:
+            for uuid in self.chunks.uuids():
+                uuids.setdefault(uuid, None)
+
+        uploads = [upload for upload in map(self._inspect, uuids) if upload]
+        staged = sum(upload.size for upload in uploads)
+
+        # Least recently active first, so the budget is met by removing the
+        # uploads that have been idle the longest.
+        stats = collections.Counter(expired=0, evicted=0)
+        removed = set()
+        for upload in sorted(uploads, key=lambda upload: upload.mtime):
+            if upload.mtime < deadline:
+                reason, not_after = 'expired', deadline
+            elif (self.budget is not None and staged > self.budget and
+                    upload.size and upload.state == PartTracker.RECEIVING):
+                reason, not_after = 'evicted', upload.mtime
+            else:
+                continue
+            if self._remove(upload, not_after):
+                removed.add(upload.uuid)
+                staged -= upload.size
+                stats[reason] += 1
+                stats['reclaimed_bytes'] += upload.size
+        stats['reclaimed_uploads'] = len(removed)
+        stats['pruned_digests'] = running_digests.prune(deadline)
+
+        # Drop the finished and removed uploads from the index, keeping the
+        # ones appended while this run was going on.
+        with locked_file(index) as fd:
+            appended, _ = self._read_index(fd, indexed_size)
+            keep = collections.OrderedDict.fromkeys(upload.uuid
+                for upload in uploads if upload.uuid not in removed)
+            keep.update((uuid, None) for uuid in appended)
+            data = u''.join(uuid + u'\n' for uuid in keep).encode('utf-8')
+            pwrite_all(fd, data, 0)
+            os.ftruncate(fd, len(data))
+
+        self.totals.update(stats)
+        self.totals['runs'] += 1
+        stats.update(uploads=len(uploads) - len(removed), staged_bytes=staged,
+            seconds=time.time() - started)
+        return dict(stats)
+
+    def _read_index(self, fd, offset):
+        size = os.fstat(fd).st_size
+        data = pread(fd, size - offset, offset) if size > offset else b''
+        return data.decode('utf-8').split(), size
+
+    def _inspect(self, uuid):
+        """ The Staged upload `uuid`, or None if it is not staged anymore."""
+        tracker = PartTracker(self.chunks.find(uuid), self.chunks.root)
+        try:
+            mtime = os.stat(tracker.path).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # No part recorded yet: dated by its folder, if there is one.
+            try:
+                return self.Staged(uuid, None, 0, os.stat(tracker.folder).st_mtime)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return None
+        header = tracker.header()
+        if header is None:
+            return self.Staged(uuid, None, 0, mtime)
+        return self.Staged(uuid, header.state, header.received_bytes, mtime)
+
+    def _remove(self, upload, not_after):
+        """ Remove a staged upload, unless it has been active since
+        `not_after`. Returns whether it was removed.
+        """
+        tracker = PartTracker(self.chunks.find(upload.uuid), self.chunks.root)
+        # The shared lock keeps chunks from being recorded (under an
+        # exclusive lock) while the upload is removed.
+        with locked_file(tracker.path, shared=True) as fd:
+            try:
+                mtime = os.fstat(fd).st_mtime if fd is not None else \
+                    os.stat(tracker.folder).st_mtime
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return False
+            if mtime > not_after:
+                return False
+            if self.on_remove is not None:
+                self.on_remove(tracker.folder)
+            shutil.rmtree(tracker.folder, ignore_errors=True)
+
+        folder = self.uploads.find(upload.uuid)
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                if name.startswith('.') and name.endswith('.part'):
+                    os.unlink(os.path.join(folder, name))
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+        running_digests.pop(upload.uuid)
+        return True
+
+
+class Reaper(object):
+    """ Empties the trash that deleted uploads are moved into, freeing at
+    most `rate` bytes per second (None for no limit) so that removing big
+    uploads doesn't starve the uploads coming in of disk bandwidth. A file
+    bigger than TRUNCATE_STEP with no other link is shrunk a step at a time
+    before it is unlinked, so the file system frees its blocks gradually
+    rather than in one long stall. With `blobs` (a BlobStore), the blob of
+    every deduplicated upload reaped is released, into the trash.
+    """
+    LOCKNAME = '.reaper'
+    TRUNCATE_STEP = 64 * 1024 * 1024
+
+    def __init__(self, trash, rate=None, blobs=None):
+        self.trash = trash
+        self.rate = rate
+        self.blobs = blobs
+        self.totals = collections.Counter()
+
+    def run(self):
+        """ Remove everything in the trash, including what is moved into it
+        while the run is going on.
+
+        Returns the statistics of the run, or None if another process's
+        reaper is already running.
+        """
+        ensure_dir(self.trash)
+        lock = os.open(os.path.join(self.trash, self.LOCKNAME),
+            os.O_RDWR | os.O_CREAT | O_BINARY, 0o666)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as e:
+                    if e.errno in (errno.EAGAIN, errno.EACCES):
+                        return None
+                    raise
+            return self._run()
+        finally:
+            os.close(lock)
+
+    def _run(self):
+        started = time.time()
+        stats = collections.Counter(reaped_uploads=0, reaped_bytes=0)
+        while True:
+            names = [name for name in os.listdir(self.trash) if not name.startswith('.')]
+            if not names:
+                break
+            for name in names:
+                freed = self._reap(os.path.join(self.trash, name))
+                metrics.inc('fine_uploader_reaped_bytes_total', freed)
+                stats['reaped_uploads'] += 1
+                stats['reaped_bytes'] += freed
+        self.totals.update(stats)
+        self.totals['runs'] += 1
+        stats['seconds'] = time.time() - started
+        return dict(stats)
+
+    def _reap(self, folder):
+        """ Remove a trashed upload. Returns the bytes freed."""
+        if not os.path.isdir(folder):
+            return self._unlink(folder)
+        digest = None
+        if self.blobs is not None:
+            digest = read_digest(folder, self.blobs.algorithm)
+        freed = 0
+        for parent, folders, files in os.walk(folder, topdown=False):
+            for name in files:
+                freed += self._unlink(os.path.join(parent, name))
+            for name in folders:
+                os.rmdir(os.path.join(parent, name))
+        os.rmdir(folder)
+        if digest is not None:
+            self.blobs.release(digest, self.trash)
+        return freed
 
+    def _unlink(self, path):
+        info = os.lstat(path)
+        if info.st_nlink > 1 or not stat.S_ISREG(info.st_mode):
+            # Frees nothing but a directory entry.
+            os.unlink(path)
+            return 0
+        size = info.st_size
+        if size > self.TRUNCATE_STEP:
+            fd = os.open(path, os.O_WRONLY | O_BINARY)
+            try:
+                while size > self.TRUNCATE_STEP:
+                    size -= self.TRUNCATE_STEP
+                    os.ftruncate(fd, size)
+                    self._throttle(self.TRUNCATE_STEP)
+            finally:
+                os.close(fd)
+        os.unlink(path)
+        self._throttle(size)
+        return info.st_size
 
+    def _throttle(self, freed):
+        if self.rate:
+            time.sleep(float(freed) / self.rate)
@@ -1,8 +1,15 @@
+import binascii
+import errno
+import hashlib
 import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
 import shutil
+import threading
+import time
 
 from django.conf import settings
 from django.http import HttpResponse, HttpRequest
@@ -11,6 +18,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
 from fine_uploader.forms import UploadFileForm
+from fine_uploader.handlers import StoredUpload, StreamingUploadHandler
 from fine_uploader import utils
 
 logger = logging.getLogger('django')
@@ -45,31 +53,180 @@ def home(request):
     return render(request, 'fine_uploader/index.html')
 
 
+def upload_status(request, qquuid):
+    """ Poll an upload: whether its chunks are still arriving, it is being
+    assembled, or it is complete (or failed), and how far along it is.
+    """
+    try:
+        status = handle_status(qquuid)
+    except ValueError, e:
+        return make_response(status=400,
+            content=json.dumps({
+                'success': False,
+                'error': '%s' % e
+            }))
+    if status is None:
+        return make_response(status=404,
+            content=json.dumps({
+                'success': False,
+                'error': 'Upload not found'
+            }))
+    status['success'] = True
+    return make_response(content=json.dumps(status))
+
+
+def list_uploads(request):
+    """ List the uploads in the UPLOAD_INDEX, a page at a time: pass the
+    `next` of a page as `after` to get the next one. `limit` and `state`
+    narrow it down.
+    """
+    try:
+        listing = handle_listing(request.GET.get('after'),
+            request.GET.get('limit'), request.GET.get('state'))
+    except ValueError, e:
+        return make_response(status=400,
+            content=json.dumps({
+                'success': False,
+                'error': 'Invalid request: %s' % e
+            }))
+    if listing is None:
+        return make_response(status=404,
+            content=json.dumps({
+                'success': False,
+                'error': 'No upload index'
+            }))
+    listing['success'] = True
+    return make_response(content=json.dumps(listing))
+
+
+@csrf_exempt
+def delete_uploads(request):
+    """ Delete many uploads in one POST request: a JSON object listing their
+    uuids as `uuids`. Reports which were deleted, not found, or failed.
+    """
+    if request.method != 'POST':
+        return make_response(status=405,
+            content=json.dumps({
+                'success': False,
+                'error': 'Expected POST'
+            }))
+    if int(request.META.get('CONTENT_LENGTH') or 0) > utils.MAX_FIELDS_SIZE:
+        return make_response(status=413,
+            content=json.dumps({
+                'success': False,
+                'error': 'Request too large'
+            }))
+    try:
+        result = handle_bulk_delete(parse_uuids(request.body))
+    except ValueError, e:
+        return make_response(status=400,
+            content=json.dumps({
+                'success': False,
+                'error': 'Invalid request: %s' % e
+            }))
+    result['success'] = not result['failed']
+    return make_response(content=json.dumps(result))
+
+
+def export_metrics(request):
+    """ What this server process has been doing, in the Prometheus text
+    format: see `utils.metrics`.
+    """
+    return make_response(content_type=utils.METRICS_CONTENT_TYPE,
+        content=utils.metrics.render())
+
+
 class UploadView(View):
     """ View which will handle all upload requests sent by Fine Uploader.
     See: https://docs.djangoproject.com/en/dev/topics/security/#user-uploaded-content-security
 
-    Handles POST and DELETE requests.
+    Handles GET, POST and DELETE requests.
     """
 
     @csrf_exempt
     def dispatch(self, *args, **kwargs):
         return super(UploadView, self).dispatch(*args, **kwargs)
 
-    def post(self, request, *args, **kwargs):
-        """A POST request. Validate the form and then handle the upload
-        based ont the POSTed data. Does not handle extra parameters yet.
+    def get(self, request, *args, **kwargs):
+        """A GET request. Lists the chunks of an upload the server already
+        holds, so the client only has to send the missing ones.
         """
-        form = UploadFileForm(request.POST, request.FILES)
-        if form.is_valid():
-            handle_upload(request.FILES['qqfile'], form.cleaned_data)
-            return make_response(content=json.dumps({ 'success': True }))
-        else:
+        try:
+            parts = handle_parts(kwargs.get('qquuid', ''))
+        except ValueError, e:
             return make_response(status=400,
                 content=json.dumps({
                     'success': False,
-                    'error': '%s' % repr(form.errors)
+                    'error': '%s' % e
                 }))
+        if parts is None:
+            return make_response(status=404,
+                content=json.dumps({
+                    'success': False,
+                    'error': 'Upload not found'
+                }))
+        parts['success'] = True
+        return make_response(content=json.dumps(parts))
+
+    def post(self, request, *args, **kwargs):
+        """A POST request. Validate the form and then handle the upload
+        based ont the POSTed data. Does not handle extra parameters yet.
+        Requests over the ADMISSION_* limits are answered 503 before any of
+        the body is read.
+        """
+        janitor_thread()
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        admission = admission_control()
+        if admission is not None:
+            refused = admission.admit(request.META.get('REMOTE_ADDR'), length)
+            if refused is not None:
+                utils.metrics.inc('fine_uploader_rejected_total', reason=refused)
+                response = make_response(status=503,
+                    content=json.dumps({
+                        'success': False,
+                        'error': 'Server busy, try again later'
+                    }))
+                response['Retry-After'] = str(settings.ADMISSION_RETRY_AFTER)
+                return response
+        try:
+            request.upload_handlers.insert(0, StreamingUploadHandler(request, open_upload))
+            try:
+                form = UploadFileForm(request.POST, request.FILES)
+                if form.is_valid():
+                    f = request.FILES['qqfile']
+                    if isinstance(f, StoredUpload):
+                        result = f.result
+                    else:
+                        result = handle_upload(f, form.cleaned_data)
+            except (KeyError, ValueError), e:
+                # Raised by open_upload, for an invalid upload.
+                utils.metrics.inc('fine_uploader_errors_total', where='request')
+                return make_response(status=400,
+                    content=json.dumps({
+                        'success': False,
+                        'error': 'Invalid request: %s' % e
+                    }))
+            except utils.StorageError, e:
+                # Counted in the errors metric by the assembly that failed.
+                logger.error('Storing upload failed: %s' % e)
+                return make_response(status=500,
+                    content=json.dumps({
+                        'success': False,
+                        'error': 'Storage error: %s' % e
+                    }))
+            if form.is_valid():
+                result['success'] = True
+                return make_response(content=json.dumps(result))
+            else:
+                utils.metrics.inc('fine_uploader_errors_total', where='request')
+                return make_response(status=400,
+                    content=json.dumps({
+                        'success': False,
+                        'error': '%s' % repr(form.errors)
+                    }))
+        finally:
+            if admission is not None:
+                admission.release(length)
 
     def delete(self, request, *args, **kwargs):
         """A DELETE request. If found, deletes a file with the corresponding
@@ -80,6 +237,18 @@ class UploadView(View):
             try:
                 handle_deleted_file(qquuid)
                 return make_response(content=json.dumps({ 'success': True }))
+            except EnvironmentError, e:
+                if e.errno == errno.ENOENT:
+                    return make_response(status=404,
+                        content=json.dumps({
+                            'success': False,
+                            'error': 'Upload not found'
+                        }))
+                return make_response(status=400,
+                    content=json.dumps({
+                        'success': False,
+                        'error': '%s' % repr(e)
+                    }))
             except Exception, e:
                 return make_response(status=400,
                     content=json.dumps({
@@ -92,40 +261,794 @@ class UploadView(View):
                 'error': 'File not present'
             }))
 
+def handle_parts(uuid):
+    """ Report which chunks of an upload have been received so far, so that
+    an interrupted upload can be resumed. Answered from the upload's
+    PartTracker rather than by listing the chunks. Returns None if nothing
+    is known about the upload; raises ValueError if `uuid` is invalid.
+    """
+    if not uuid:
+        return None
+    status = part_tracker(uuid).status()
+    if status is not None:
+        return {
+            'uuid': uuid,
+            'state': status['state'],
+            'totalParts': status['total_parts'],
+            'totalSize': status['total_size'],
+            'receivedBytes': status['received_bytes'],
+            'parts': [{'index': index, 'size': size}
+                for index, size in status['parts']],
+        }
+    if upload_exists(uuid):
+        return {'uuid': uuid, 'state': 'complete', 'parts': []}
+    return None
+
+def handle_status(uuid):
+    """ Report how far along an upload is: receiving its chunks, being
+    assembled, complete or failed. `progress` is the fraction of the
+    current phase that is done. Returns None if nothing is known about the
+    upload; raises ValueError if `uuid` is invalid.
+    """
+    status = part_tracker(uuid).status()
+    if status is not None:
+        done = status['received_bytes']
+        if status['state'] == 'assembling':
+            done = status['assembled_bytes']
+        return {
+            'uuid': uuid,
+            'state': status['state'],
+            'totalSize': status['total_size'],
+            'receivedBytes': status['received_bytes'],
+            'assembledBytes': status['assembled_bytes'],
+            'progress': float(done) / status['total_size'] if status['total_size'] else 0.0,
+        }
+    record = indexed_upload(uuid)
+    if record is not None and record['state'] == utils.UploadIndex.COMPLETE:
+        status = {'uuid': uuid, 'state': 'complete', 'progress': 1.0}
+        if record['digest'] is not None:
+            status['digest'] = record['digest']
+            status['digestAlgorithm'] = record['digest_algorithm']
+        return status
+    if upload_exists(uuid):
+        status = {'uuid': uuid, 'state': 'complete', 'progress': 1.0}
+        s3 = s3_storage()
+        if s3 is not None:
+            digest = s3.read_digest(uuid, settings.UPLOAD_DIGEST)
+        else:
+            digest = utils.read_digest(upload_layout().find(uuid),
+                settings.UPLOAD_DIGEST)
+        if digest is not None:
+            status['digest'] = digest
+            status['digestAlgorithm'] = settings.UPLOAD_DIGEST
+        return status
+    return None
+
+def handle_listing(after=None, limit=None, state=None):
+    """ A page of the uploads in the UPLOAD_INDEX, in uuid order: up to
+    `limit` (at most utils.LISTING_LIMIT) of them after the uuid `after`,
+    only the ones in `state` if given. `next` is the `after` of the next
+    page, or None on the last one. Returns None if there is no index.
+    """
+    index = upload_index()
+    if index is None:
+        return None
+    limit = min(int(limit or utils.LISTING_LIMIT), utils.LISTING_LIMIT)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    records = index.list(after, limit + 1, state)
+    uploads = [describe_upload(record) for record in records[:limit]]
+    return {
+        'uploads': uploads,
+        'next': uploads[-1]['uuid'] if len(records) > limit else None,
+    }
+
+def describe_upload(record):
+    """ A utils.UploadIndex record, as the API reports it."""
+    return {
+        'uuid': record['uuid'],
+        'filename': record['filename'],
+        'state': record['state'],
+        'totalSize': record['total_size'],
+        'totalParts': record['total_parts'],
+        'receivedParts': record['received_parts'],
+        'receivedBytes': record['received_bytes'],
+        'digest': record['digest'],
+        'digestAlgorithm': record['digest_algorithm'],
+        'created': record['created'],
+        'updated': record['updated'],
+        'completed': record['completed'],
+    }
+
+def indexed_upload(uuid):
+    """ The utils.UploadIndex record of the upload `uuid`, or None if it is
+    not in the index (or there is none).
+    """
+    index = upload_index()
+    return index.get(uuid) if index is not None else None
+
+def upload_exists(uuid):
+    """ Whether the upload `uuid` has been stored. Uploads stored before
+    the UPLOAD_INDEX was set up are looked for in storage.
+    """
+    record = indexed_upload(uuid)
+    if record is not None:
+        return record['state'] == utils.UploadIndex.COMPLETE
+    s3 = s3_storage()
+    if s3 is not None:
+        return s3.has_upload(uuid)
+    return os.path.isdir(upload_layout().find(uuid))
+
+def upload_layout():
+    """ The utils.Layout of UPLOAD_DIRECTORY (SHARD_LEVELS)."""
+    return utils.Layout(settings.UPLOAD_DIRECTORY, settings.SHARD_LEVELS,
+        settings.SHARD_WIDTH)
+
+def chunks_layout():
+    """ The utils.Layout of CHUNKS_DIRECTORY (SHARD_LEVELS)."""
+    return utils.Layout(settings.CHUNKS_DIRECTORY, settings.SHARD_LEVELS,
+        settings.SHARD_WIDTH)
+
+def part_tracker(uuid):
+    """ The PartTracker of the upload `uuid`, wherever its chunks are."""
+    return utils.PartTracker(chunks_layout().find(utils.check_uuid(uuid)),
+        settings.CHUNKS_DIRECTORY)
+
 def handle_upload(f, fileattrs):
     """ Handle a chunked or non-chunked upload.
+
+    Chunks may arrive in any order (concurrent chunking): the upload is
+    finished by whichever request completes its PartTracker, exactly once.
+
+    Returns a dict of extra fields for the response.
+    """
+    upload = open_upload(fileattrs)
+    if upload is None:
+        return {}
+    try:
+        for chunk in f.chunks():
+            upload.write(chunk)
+    except Exception:
+        upload.abort()
+        raise
+    return upload.close()
+
+def open_upload(fileattrs):
+    """ Get ready to receive the file of an upload request, given the
+    request's other (cleaned) fields. Returns an UploadWriter to write the
+    file's bytes to as they come in, or None when they are not needed: the
+    chunk is already stored, or its upload is already complete.
+
+    With UPLOAD_STORAGE = 's3', the file is streamed to the store, as one
+    object or as a part of its upload's multipart upload.
+
+    Raises ValueError if the uuid or file name is not safe to store the
+    upload under (see utils.check_uuid, utils.safe_filename).
     """
     logger.info(fileattrs)
 
-    chunked = False
-    dest_folder = os.path.join(settings.UPLOAD_DIRECTORY, fileattrs['qquuid'])
-    dest = os.path.join(dest_folder, fileattrs['qqfilename'])
+    dest_folder = upload_layout().find(utils.check_uuid(fileattrs['qquuid']))
+    dest = os.path.join(dest_folder, utils.safe_filename(fileattrs['qqfilename']))
+    algorithm = settings.UPLOAD_DIGEST
+    s3 = s3_storage()
+
+    # Not chunked
+    if not (fileattrs.get('qqtotalparts') and int(fileattrs['qqtotalparts']) > 1):
+        digest = hashlib.new(algorithm) if algorithm else None
+        if s3 is not None:
+            writer = utils.S3Writer(s3, s3.key(dest))
+        else:
+            writer = utils.FileWriter(dest)
+        return UploadWriter(fileattrs['qquuid'], dest, writer, digest)
 
     # Chunked
-    if fileattrs.get('qqtotalparts') and int(fileattrs['qqtotalparts']) > 1:
-        chunked = True
-        dest_folder = os.path.join(settings.CHUNKS_DIRECTORY, fileattrs['qquuid'])
-        dest = os.path.join(dest_folder, fileattrs['qqfilename'], str(fileattrs['qqpartindex']))
-        logger.info('Chunked upload received')
+    tracker = part_tracker(fileattrs['qquuid'])
+    index = fileattrs['qqpartindex']
+    total_parts = fileattrs['qqtotalparts']
+    total_size = fileattrs['qqtotalfilesize'] or 0
+    offset = fileattrs.get('qqpartbyteoffset')
+
+    # A retried chunk of an upload that has already been finished.
+    if os.path.exists(dest) or (s3 is not None and
+            not os.path.isdir(tracker.folder) and s3.exists(dest)):
+        logger.info('Upload already complete: %s' % dest)
+        return None
+
+    # A chunk that is already stored, sent again by a resumed upload; not
+    # if assembling the upload failed, which the chunk is sent again to retry.
+    if (fileattrs.get('qqchunksize') is not None and
+            tracker.received(index) == fileattrs['qqchunksize'] and not tracker.failed()):
+        logger.info('Chunk %s already stored' % index)
+        return None
+
+    digest = utils.running_digests.checkout(fileattrs['qquuid'], offset, algorithm)
+    try:
+        # Sent on as a part of the upload's multipart upload.
+        if s3 is not None and s3.forwards(total_parts, total_size):
+            upload_id = s3.multipart_upload(tracker.folder, dest)
+            if upload_id is None:
+                logger.info('Upload already complete: %s' % dest)
+                utils.running_digests.checkin(fileattrs['qquuid'], digest, failed=True)
+                return None
+            writer = utils.S3PartWriter(s3, s3.key(dest), upload_id, index + 1)
+            source = None
+        # Written in place: the last chunk only has to rename the file.
+        elif settings.CHUNKS_IN_PLACE and offset is not None:
+            source = utils.partial_path(dest)
+            writer = utils.OffsetWriter(source, offset, total_size)
+        else:
+            part = os.path.join(tracker.folder, fileattrs['qqfilename'], str(index))
+            writer = utils.FileWriter(part)
+            source = os.path.dirname(part)
+    except Exception:
+        utils.running_digests.checkin(fileattrs['qquuid'], digest, failed=True)
+        raise
+    return UploadWriter(fileattrs['qquuid'], dest, writer, digest,
+        chunk=(tracker, index, total_parts, total_size, source))
+
+class UploadWriter(object):
+    """ Receives the file of one upload request, the whole upload or one
+    chunk of it, through `write` as its bytes come in. `close` stores it
+    and returns the extra fields for the response; for a chunk, that
+    includes finishing the upload if it was the last one in. `abort` throws
+    away what has been written.
+
+    The time from opening the writer to `close` is recorded in
+    `utils.metrics` as the parse and write phases: the time spent in
+    `write`, and the rest.
+    """
+
+    def __init__(self, uuid, dest, writer, digest=None, chunk=None):
+        self.uuid = uuid
+        self.dest = dest
+        self.writer = writer
+        self.digest = digest
+        self.chunk = chunk
+        self.kind = 'upload' if chunk is None else 'chunk'
+        self.opened = time.time()
+        self.write_seconds = 0.0
+        self.finished = False
+        utils.metrics.inc('fine_uploader_uploads_in_flight')
+
+    def write(self, data):
+        started = time.time()
+        self.writer.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        self.write_seconds += time.time() - started
+        utils.metrics.inc('fine_uploader_received_bytes_total', len(data))
+
+    def abort(self):
+        self.writer.abort()
+        if self.chunk is not None:
+            utils.running_digests.checkin(self.uuid, self.digest, failed=True)
+        self._finish(failed=True)
+
+    def close(self):
+        received = time.time()
+        utils.metrics.observe('fine_uploader_phase_seconds',
+            received - self.opened - self.write_seconds, phase='parse')
+        utils.metrics.observe('fine_uploader_phase_seconds', self.write_seconds,
+            phase='write')
+        try:
+            size = self.writer.close()
+        except Exception:
+            self.abort()
+            raise
+
+        algorithm = settings.UPLOAD_DIGEST
+        if self.chunk is None:
+            fields = {}
+            if self.digest is not None:
+                s3 = s3_storage()
+                (s3.store_digest if s3 is not None else utils.store_digest)(
+                    self.dest, self.digest.hexdigest(), algorithm)
+                fields = { 'digest': self.digest.hexdigest(), 'digestAlgorithm': algorithm }
+            uploads = upload_index()
+            if uploads is not None:
+                uploads.completed(self.uuid, os.path.basename(self.dest), size,
+                    fields.get('digest'), fields.get('digestAlgorithm'))
+            deduplicate(self.dest, fields.get('digest'))
+            saved = time.time()
+            utils.metrics.observe('fine_uploader_phase_seconds', saved - received,
+                phase='save')
+            logger.info('Upload saved: %s (%d bytes in %.3fs, %.3fs writing)' % (
+                self.dest, size, saved - self.opened, self.write_seconds))
+            self._finish()
+            return fields
+
+        utils.running_digests.checkin(self.uuid, self.digest)
+        tracker, index, total_parts, total_size, source = self.chunk
+        last, new = tracker.add(index, size, total_parts, total_size)
+        uploads = upload_index()
+        if uploads is not None and new:
+            uploads.received(self.uuid, os.path.basename(self.dest), size,
+                total_parts, total_size)
+        saved = time.time()
+        utils.metrics.observe('fine_uploader_phase_seconds', saved - received,
+            phase='save')
+        logger.info('Chunk %s saved: %s (%d bytes in %.3fs, %.3fs writing)' % (
+            index, source, size, saved - self.opened, self.write_seconds))
+        if not last:
+            self._finish()
+            return {}
+
+        # Once every part has been received, finish the upload.
+        self.kind = 'final'
+        try:
+            return finish_upload(self.uuid, tracker.folder, source, self.dest,
+                total_parts, total_size)
+        finally:
+            self._finish()
+
+    def _finish(self, failed=False):
+        """ Count the file in `utils.metrics`, once."""
+        if self.finished:
+            return
+        self.finished = True
+        utils.metrics.dec('fine_uploader_uploads_in_flight')
+        if failed:
+            utils.metrics.inc('fine_uploader_errors_total', where='upload')
+            return
+        utils.metrics.inc('fine_uploader_files_total', kind=self.kind)
+        utils.metrics.observe('fine_uploader_file_seconds', time.time() - self.opened,
+            kind=self.kind)
+
+def deduplicate(dest, digest):
+    """ With UPLOAD_DEDUP, swap the completed upload at `dest` for a link
+    to the blob of its content (see utils.BlobStore). Failing to only costs
+    the space it would have saved, so it is logged rather than raised.
+    """
+    blobs = blob_store()
+    if blobs is None or digest is None:
+        return
+    try:
+        if blobs.add(dest, digest):
+            utils.metrics.inc('fine_uploader_deduplicated_bytes_total',
+                os.path.getsize(dest))
+    except (IOError, OSError):
+        logger.exception('Could not deduplicate %s' % dest)
+
+def finish_upload(uuid, tracker_folder, source, dest, total_parts, total_size):
+    """ Assemble an upload whose parts have all been received, or queue it
+    for the assembly pool when there is one (ASSEMBLY_WORKERS). Hands its
+    running digest on to `assemble_upload` and returns the extra response
+    fields.
+    """
+    digest = utils.running_digests.pop(uuid)
+    if digest is not None and digest.offset == total_size:
+        digest = digest.hasher.hexdigest()
+    job = (tracker_folder, source, dest, total_parts, total_size, digest)
+
+    pool = assembly_pool()
+    utils.metrics.inc('fine_uploader_assemblies_in_flight')
+    admission = admission_control()
+    if admission is not None:
+        admission.assembling(1)
+    if pool is None:
+        return assemble_upload(*job)
+    if isinstance(digest, utils.RunningDigest) and settings.ASSEMBLY_POOL == 'process':
+        # hashlib objects can't be sent to another process: hash from scratch.
+        job = job[:-1] + (None,)
+    logger.info('Queued for assembly: %s' % dest)
+    pool.apply_async(assemble_in_background, job,
+        callback=lambda result: record_assembly(*result))
+    return {'assembling': True}
+
+def assemble_upload(tracker_folder, source, dest, total_parts, total_size,
+        digest=None, phases=None):
+    """ Turn the received parts of an upload into the file at `dest`, then
+    remove its chunks. `source` is either the folder holding the parts,
+    which are combined, or the file the chunks were written into in place,
+    which is renamed, or None when the chunks were sent on to S3, where
+    their multipart upload is completed. A file assembled locally for S3 is
+    uploaded and removed. Progress and failure are recorded in the upload's
+    PartTracker for the status endpoint.
+
+    With UPLOAD_DIGEST, `digest` (see `utils.finish_digest`) is completed
+    and stored; returns the digest fields for the response. The outcome is
+    recorded in the UPLOAD_INDEX.
+
+    The seconds each phase takes are recorded in `utils.metrics`, unless a
+    `phases` dict is given to hold them instead.
+    """
+    tracker = utils.PartTracker(tracker_folder, settings.CHUNKS_DIRECTORY)
+    algorithm = settings.UPLOAD_DIGEST
+    fields = {}
+    timings = {} if phases is None else phases
+    s3 = s3_storage()
+    index = upload_index()
+    uuid = os.path.basename(tracker_folder)
+    try:
+        started = time.time()
+        if source is None:
+            logger.info('Completing multipart upload: %s' % dest)
+            assembled = None
+            s3.complete(tracker_folder, total_parts)
+            tracker.set_progress(total_size)
+        elif os.path.isdir(source):
+            logger.info('Combining chunks: %s' % source)
+            assembled = utils.partial_path(dest)
+            stats = utils.combine_chunks(total_parts, total_size,
+                source_folder=source, dest=assembled,
+                progress=tracker.set_progress)
+            logger.info('Combined: %s (%d bytes in %.3fs, %.1f MB/s, %s)' % (dest,
+                stats['bytes'], stats['seconds'],
+                stats['bytes_per_sec'] / (1024 * 1024), stats['method']))
+        else:
+            assembled = source
+            tracker.set_progress(total_size)
+        timings['combine'] = time.time() - started
+        if algorithm:
+            started = time.time()
+            if assembled is None:
+                fields['digest'] = s3.finish_digest(digest, dest, algorithm)
+            else:
+                fields['digest'] = utils.finish_digest(digest, assembled, algorithm)
+            fields['digestAlgorithm'] = algorithm
+            (s3.store_digest if s3 is not None else utils.store_digest)(
+                dest, fields['digest'], algorithm)
+            timings['digest'] = time.time() - started
+        if assembled is not None and s3 is not None:
+            started = time.time()
+            s3.upload_file(assembled, dest)
+            os.unlink(assembled)
+            try:
+                os.rmdir(os.path.dirname(dest))
+            except OSError:
+                pass
+            timings['transfer'] = time.time() - started
+        elif assembled is not None:
+            os.rename(assembled, dest)
+            deduplicate(dest, fields.get('digest'))
+        logger.info('Upload saved: %s' % dest)
+        if index is not None:
+            index.completed(uuid, os.path.basename(dest), total_size,
+                fields.get('digest'), fields.get('digestAlgorithm'))
+    except Exception:
+        tracker.set_failed()
+        if index is not None:
+            index.failed(uuid)
+        if phases is None:
+            record_assembly(timings, total_size, failed=True)
+        raise
+
+    started = time.time()
+    shutil.rmtree(tracker_folder, ignore_errors=True)
+    timings['cleanup'] = time.time() - started
+    if phases is None:
+        record_assembly(timings, total_size)
+    return fields
+
+def assemble_in_background(*job):
+    """ `assemble_upload` for the assembly pool, where nobody is waiting for
+    the exception. Returns the arguments for `record_assembly`, which is
+    called with them back in the process that queued the job.
+    """
+    phases = {}
+    try:
+        assemble_upload(*job, phases=phases)
+    except Exception:
+        logger.exception('Assembling %s failed' % job[2])
+        return phases, job[4], True
+    return phases, job[4], False
+
+def record_assembly(phases, total_size, failed=False):
+    """ Record an assembly that is over in `utils.metrics`."""
+    for phase, seconds in phases.items():
+        utils.metrics.observe('fine_uploader_phase_seconds', seconds, phase=phase)
+    if failed:
+        utils.metrics.inc('fine_uploader_errors_total', where='assembly')
+    else:
+        utils.metrics.inc('fine_uploader_assembled_bytes_total', total_size)
+    utils.metrics.dec('fine_uploader_assemblies_in_flight')
+    admission = admission_control()
+    if admission is not None:
+        admission.assembling(-1)
+
+def assembly_pool():
+    """ The pool of ASSEMBLY_WORKERS threads or processes that assemble
+    uploads off the request path, or None if uploads are assembled in the
+    request. Created on first use, so every pre-forked server process gets
+    its own.
+    """
+    global _assembly_pool, _assembly_pool_pid
+
+    workers = settings.ASSEMBLY_WORKERS
+    if not workers:
+        return None
+    with _assembly_pool_lock:
+        if _assembly_pool is None or _assembly_pool_pid != os.getpid():
+            if settings.ASSEMBLY_POOL == 'process':
+                _assembly_pool = multiprocessing.Pool(workers)
+            else:
+                _assembly_pool = multiprocessing.pool.ThreadPool(workers)
+            _assembly_pool_pid = os.getpid()
+    return _assembly_pool
+
+_assembly_pool = None
+_assembly_pool_pid = None
+_assembly_pool_lock = threading.Lock()
+
+def admission_control():
+    """ This process's AdmissionControl, or None if none of the
+    ADMISSION_* limits is set.
+    """
+    global _admission_control, _admission_control_pid
+
+    if (settings.ADMISSION_MAX_BYTES is None and
+            settings.ADMISSION_MAX_ASSEMBLIES is None and
+            settings.ADMISSION_CLIENT_RATE is None):
+        return None
+    with _admission_control_lock:
+        if _admission_control is None or _admission_control_pid != os.getpid():
+            _admission_control = utils.AdmissionControl(settings.ADMISSION_MAX_BYTES,
+                settings.ADMISSION_MAX_ASSEMBLIES, settings.ADMISSION_CLIENT_RATE,
+                settings.ADMISSION_CLIENT_BURST)
+            _admission_control_pid = os.getpid()
+    return _admission_control
+
+_admission_control = None
+_admission_control_pid = None
+_admission_control_lock = threading.Lock()
+
+def s3_storage():
+    """ This process's utils.S3Storage if uploads are kept in S3
+    (UPLOAD_STORAGE), otherwise None. Created on first use, so every
+    pre-forked server process gets its own client and part pool.
+    """
+    global _s3_storage, _s3_storage_pid
+
+    if settings.UPLOAD_STORAGE != 's3':
+        return None
+    with _s3_storage_lock:
+        if _s3_storage is None or _s3_storage_pid != os.getpid():
+            _s3_storage = utils.S3Storage(settings.S3_BUCKET,
+                prefix=settings.S3_PREFIX,
+                endpoint=settings.S3_ENDPOINT,
+                access_key=settings.S3_ACCESS_KEY,
+                secret_key=settings.S3_SECRET_KEY,
+                part_size=settings.S3_PART_SIZE,
+                max_in_flight=settings.S3_MAX_IN_FLIGHT_PARTS,
+                spool_size=settings.S3_SPOOL_SIZE)
+            _s3_storage_pid = os.getpid()
+    return _s3_storage
+
+_s3_storage = None
+_s3_storage_pid = None
+_s3_storage_lock = threading.Lock()
+
+def blob_store():
+    """ The utils.BlobStore uploads are deduplicated into (UPLOAD_DEDUP), or
+    None.
+    """
+    if not (settings.UPLOAD_DEDUP and settings.UPLOAD_DIGEST and
+            settings.UPLOAD_STORAGE == 'local'):
+        return None
+    return utils.BlobStore(settings.BLOBS_DIRECTORY, settings.UPLOAD_DIGEST)
+
+def upload_index():
+    """ The utils.UploadIndex of UPLOAD_INDEX, or None if there is none."""
+    global _upload_index
+
+    path = settings.UPLOAD_INDEX
+    if not path:
+        return None
+    with _upload_index_lock:
+        if _upload_index is None or _upload_index.path != path:
+            _upload_index = utils.UploadIndex(path)
+    return _upload_index
+
+_upload_index = None
+_upload_index_lock = threading.Lock()
+
+def janitor():
+    """ This process's Janitor, configured from JANITOR_MAX_AGE and
+    JANITOR_BUDGET. Its `totals` add up what every run has reclaimed. With
+    S3 storage, it aborts the multipart uploads of the uploads it removes,
+    and they are dropped from the UPLOAD_INDEX.
+    """
+    global _janitor
+    with _janitor_lock:
+        if _janitor is None:
+            _janitor = utils.Janitor(chunks_layout(), upload_layout(),
+                settings.JANITOR_MAX_AGE,
+                settings.JANITOR_BUDGET, on_remove=abandon_upload)
+    return _janitor
+
+def abandon_upload(folder):
+    """ Undo what was stored of the upload whose chunk folder the janitor is
+    removing: its multipart upload and its UPLOAD_INDEX record.
+    """
+    s3 = s3_storage()
+    if s3 is not None:
+        s3.abort_upload(folder)
+    index = upload_index()
+    if index is not None:
+        index.remove(os.path.basename(folder))
 
-    utils.save_upload(f, dest)
-    logger.info('Upload saved: %s' % dest)
+def janitor_thread():
+    """ Start the thread that runs the janitor every JANITOR_INTERVAL
+    seconds, if there is an interval and this process has not started it
+    yet. Each pre-forked server process starts its own; only one of them
+    runs at a time.
+    """
+    global _janitor_thread_pid
+
+    interval = settings.JANITOR_INTERVAL
+    if not interval:
+        return
+    with _janitor_lock:
+        if _janitor_thread_pid != os.getpid():
+            thread = threading.Thread(target=run_janitor, args=(interval,),
+                name='janitor')
+            thread.daemon = True
+            thread.start()
+            _janitor_thread_pid = os.getpid()
+
+def run_janitor(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            stats = janitor().run()
+        except Exception:
+            logger.exception('Janitor run failed')
+            continue
+        if stats is not None:
+            logger.info('Janitor: reclaimed %(reclaimed_uploads)d uploads '
+                '(%(reclaimed_bytes)d bytes), %(uploads)d uploads '
+                '(%(staged_bytes)d bytes) staged' % stats)
+
+_janitor = None
+_janitor_thread_pid = None
+_janitor_lock = threading.Lock()
+
+def reaper():
+    """ This process's utils.Reaper of TRASH_DIRECTORY, configured from
+    REAPER_RATE. Its `totals` add up what every run has freed.
+    """
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = utils.Reaper(settings.TRASH_DIRECTORY, settings.REAPER_RATE,
+                blobs=blob_store())
+    return _reaper
+
+def wake_reaper():
+    """ Have this process's reaper thread empty the trash now, starting it
+    if need be (see REAPER_INTERVAL).
+    """
+    global _reaper_thread_pid
 
-    # If the last chunk has been sent, combine the parts.
-    if chunked and (fileattrs['qqtotalparts'] - 1 == fileattrs['qqpartindex']):
+    interval = settings.REAPER_INTERVAL
+    if not interval:
+        return
+    with _reaper_lock:
+        if _reaper_thread_pid != os.getpid():
+            thread = threading.Thread(target=run_reaper, args=(interval,),
+                name='reaper')
+            thread.daemon = True
+            thread.start()
+            _reaper_thread_pid = os.getpid()
+    _reaper_wakeup.set()
 
-        logger.info('Combining chunks: %s' % os.path.dirname(dest))
-        utils.combine_chunks(fileattrs['qqtotalparts'],
-            fileattrs['qqtotalfilesize'],
-            source_folder=os.path.dirname(dest),
-            dest=os.path.join(settings.UPLOAD_DIRECTORY, fileattrs['qquuid'], fileattrs['qqfilename']))
-        logger.info('Combined: %s' % dest)
+def run_reaper(interval):
+    while True:
+        _reaper_wakeup.wait(interval)
+        _reaper_wakeup.clear()
+        try:
+            stats = reaper().run()
+        except Exception:
+            logger.exception('Reaper run failed')
+            continue
+        if stats is not None and stats['reaped_uploads']:
+            logger.info('Reaper: freed %(reaped_bytes)d bytes of '
+                '%(reaped_uploads)d deleted uploads in %(seconds).1fs' % stats)
 
-        shutil.rmtree(os.path.dirname(os.path.dirname(dest)))
+_reaper = None
+_reaper_thread_pid = None
+_reaper_lock = threading.Lock()
+_reaper_wakeup = threading.Event()
+
+def migrate_layout():
+    """ Move the uploads a flat layout stored directly in UPLOAD_DIRECTORY
+    into the shards of SHARD_LEVELS, while the server keeps running: each
+    is a single rename(2), and an upload is found both before and after it.
+    Uploads still receiving chunks are left for a later run; their chunks
+    stay where they are until the upload finishes or the janitor reclaims
+    them. Returns how many uploads were moved and skipped.
+    """
+    chunks = chunks_layout()
+    return upload_layout().migrate(
+        busy=lambda uuid: os.path.isdir(chunks.find(uuid)))
 
 def handle_deleted_file(uuid):
-    """ Handles a filesystem delete based on UUID."""
+    """ Handles a filesystem delete based on UUID. The upload is moved to
+    the trash, in one rename, for the reaper to remove (see utils.Reaper),
+    so the request doesn't wait for its files to be freed. Raises OSError
+    (ENOENT) if there is no such upload, ValueError if `uuid` is invalid.
+    """
     logger.info(uuid)
 
-    loc = os.path.join(settings.UPLOAD_DIRECTORY, uuid)
-    shutil.rmtree(loc)
+    utils.check_uuid(uuid)
+    s3 = s3_storage()
+    utils.metrics.inc('fine_uploader_deletes_in_flight')
+    try:
+        with utils.metrics.timer('fine_uploader_phase_seconds', phase='delete'):
+            if s3 is not None:
+                s3.delete(uuid)
+            else:
+                trash_upload(uuid)
+                wake_reaper()
+    except Exception, e:
+        utils.metrics.inc('fine_uploader_errors_total', where='delete')
+        if isinstance(e, EnvironmentError) and e.errno == errno.ENOENT:
+            # Gone from disk already: its record has to go all the same.
+            unindex(uuid)
+        raise
+    else:
+        utils.metrics.inc('fine_uploader_deleted_uploads_total')
+    finally:
+        utils.metrics.dec('fine_uploader_deletes_in_flight')
+    unindex(uuid)
+
+
+def unindex(uuid):
+    """ Remove the record of a deleted upload from the upload index."""
+    index = upload_index()
+    if index is not None:
+        index.remove(uuid)
+
+def handle_bulk_delete(uuids):
+    """ Delete many uploads at once, at most utils.LISTING_LIMIT (see
+    `handle_deleted_file`). Returns the uuids deleted, the ones not found,
+    and the error of every one that could not be deleted.
+    """
+    if len(uuids) > utils.LISTING_LIMIT:
+        raise ValueError('At most %d uploads can be deleted at once' % utils.LISTING_LIMIT)
+    result = {'deleted': [], 'notFound': [], 'failed': {}}
+    for uuid in uuids:
+        try:
+            handle_deleted_file(uuid)
+        except Exception, e:
+            if isinstance(e, EnvironmentError) and e.errno == errno.ENOENT:
+                result['notFound'].append(uuid)
+            else:
+                logger.exception('Deleting %s failed' % uuid)
+                result['failed'][uuid] = '%s' % e
+        else:
+            result['deleted'].append(uuid)
+    return result
+
+def parse_uuids(data):
+    """ The uuids of a bulk delete request: a JSON object holding them as a
+    list, `uuids`. Raises ValueError if that is not what `data` is.
+    """
+    try:
+        body = json.loads(data.decode('utf-8'))
+    except ValueError:
+        raise ValueError('Expected a JSON object')
+    uuids = body.get('uuids') if isinstance(body, dict) else None
+    if not isinstance(uuids, list) or not all(isinstance(uuid, unicode) for uuid in uuids):
+        raise ValueError('Expected {"uuids": [...]}')
+    return uuids
+
+def trash_upload(uuid):
+    """ Move the folder of the upload `uuid` into TRASH_DIRECTORY, under a
+    name of its own.
+    """
+    utils.check_uuid(uuid)
+    utils.ensure_dir(settings.TRASH_DIRECTORY)
+    target = os.path.join(settings.TRASH_DIRECTORY, '%s.%s' % (uuid,
+        binascii.hexlify(os.urandom(6))))
+    loc = upload_layout().find(uuid)
+    try:
+        os.rename(loc, target)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        # Moved into its shard by migrate_layout meanwhile?
+        moved = upload_layout().find(uuid)
+        if moved == loc:
+            raise OSError(errno.ENOENT, 'No such upload', uuid)
+        os.rename(moved, target)
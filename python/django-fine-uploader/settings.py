@@ -37,6 +37,97 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 UPLOAD_DIRECTORY = os.path.join(MEDIA_ROOT, 'uploads')
 CHUNKS_DIRECTORY = os.path.join(MEDIA_ROOT, 'chunks')
 
+# Keep the folder of every upload under SHARD_LEVELS levels of shard folders
+# named after the first SHARD_WIDTH characters of its uuid (two levels of
+# two: <directory>/ab/cd/abcd12...), in UPLOAD_DIRECTORY and
+# CHUNKS_DIRECTORY, so no directory grows past a few thousand entries. 0
+# keeps them all directly in the directory. Uploads stored before the layout
+# changed are still found; `python manage.py migrate_layout` moves them.
+SHARD_LEVELS = 0
+SHARD_WIDTH = 2
+
+# Write each chunk straight into the final file at its byte offset instead of
+# storing it under CHUNKS_DIRECTORY and combining the parts at the end.
+CHUNKS_IN_PLACE = False
+
+# Number of workers that assemble finished uploads off the request path, and
+# whether they are threads ('thread') or processes ('process'). With 0, the
+# request that delivers the last chunk assembles the upload itself.
+ASSEMBLY_WORKERS = 0
+ASSEMBLY_POOL = 'thread'
+
+# hashlib algorithm used to digest every upload as it is written ('md5',
+# 'sha1', 'sha256', 'blake2b', ...), or None. The digest is returned in the
+# response and stored next to the upload as <filename>.<algorithm>.
+UPLOAD_DIGEST = None
+
+# Deleted uploads are moved into TRASH_DIRECTORY (on the same file system as
+# UPLOAD_DIRECTORY) in one rename, and removed from there by a reaper that
+# frees at most REAPER_RATE bytes per second (None for no limit). Every
+# server process runs it in a background thread, woken by deletes and every
+# REAPER_INTERVAL seconds; with 0, run `python manage.py reaper` instead.
+TRASH_DIRECTORY = os.path.join(MEDIA_ROOT, 'trash')
+REAPER_RATE = 256 * 1024 * 1024
+REAPER_INTERVAL = 60
+
+# Store each distinct content once (needs UPLOAD_DIGEST, and 'local'
+# storage): a completed upload whose digest matches an earlier one becomes a
+# hard link to the same blob under BLOBS_DIRECTORY, which is only removed
+# with the last upload linking to it. BLOBS_DIRECTORY has to be on the same
+# file system as UPLOAD_DIRECTORY.
+UPLOAD_DEDUP = False
+BLOBS_DIRECTORY = os.path.join(MEDIA_ROOT, 'blobs')
+
+# SQLite database in which every upload is recorded (filename, size, parts
+# received, digest, timestamps), or None. Status, resume and delete look
+# uploads up in it, and GET /uploads lists them from it.
+UPLOAD_INDEX = None
+
+# Incomplete uploads whose chunks have not been touched for JANITOR_MAX_AGE
+# seconds are removed by the janitor, and while the chunks staged take up
+# more than JANITOR_BUDGET bytes (None for no limit) the least recently
+# active uploads are removed too. With a JANITOR_INTERVAL (seconds), every
+# server process runs the janitor in a background thread; otherwise run
+# `python manage.py janitor` (from cron, say).
+JANITOR_MAX_AGE = 24 * 60 * 60
+JANITOR_BUDGET = None
+JANITOR_INTERVAL = 0
+
+# Where finished uploads are kept: 'local', in UPLOAD_DIRECTORY, or 's3', in
+# S3_BUCKET of an S3-compatible store (at S3_ENDPOINT, or AWS if None) under
+# the same <uuid>/<filename> names, behind S3_PREFIX. Needs boto3. Uploads
+# are sent on to the store as they are received: the chunks of a chunked
+# upload become the parts of a multipart upload, provided they are at least
+# 5 MiB (Fine Uploader's chunking.partSize); an upload with smaller chunks is
+# staged under CHUNKS_DIRECTORY as usual and uploaded once assembled.
+UPLOAD_STORAGE = 'local'
+S3_BUCKET = os.getenv('S3_BUCKET')
+S3_PREFIX = ''
+S3_ENDPOINT = os.getenv('AWS_ENDPOINT')
+S3_ACCESS_KEY = os.getenv('AWS_CLIENT_ACCESS_KEY')
+S3_SECRET_KEY = os.getenv('AWS_CLIENT_SECRET_KEY')
+
+# Whole uploads and staged files are sent in parts of S3_PART_SIZE bytes. At
+# most S3_MAX_IN_FLIGHT_PARTS parts are on their way at once per process;
+# more wait their turn. Chunks of up to S3_SPOOL_SIZE bytes are held in
+# memory until they are sent, bigger ones in a temporary file.
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_MAX_IN_FLIGHT_PARTS = 4
+S3_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Admission control: an upload request is answered 503 at once, with a
+# Retry-After of ADMISSION_RETRY_AFTER seconds, while the upload requests
+# being received add up to more than ADMISSION_MAX_BYTES (by Content-Length),
+# while ADMISSION_MAX_ASSEMBLIES uploads are being assembled, or when its
+# client (address) has sent more than ADMISSION_CLIENT_RATE requests a second,
+# in bursts of up to ADMISSION_CLIENT_BURST. None for no limit; the limits
+# hold per server process.
+ADMISSION_MAX_BYTES = None
+ADMISSION_MAX_ASSEMBLIES = None
+ADMISSION_CLIENT_RATE = None
+ADMISSION_CLIENT_BURST = 10
+ADMISSION_RETRY_AFTER = 5
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.6/howto/deployment/checklist/
 
@@ -59,6 +150,7 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'fine_uploader',
 )
 
 MIDDLEWARE_CLASSES = (
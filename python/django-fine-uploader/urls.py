@@ -5,6 +5,10 @@ from fine_uploader.views import UploadView
 
 urlpatterns = patterns('',
     url(r'^$', 'fine_uploader.views.home', name='home'),
+    url(r'^metrics$', 'fine_uploader.views.export_metrics', name='metrics'),
+    url(r'^uploads$', 'fine_uploader.views.list_uploads', name='list_uploads'),
+    url(r'^uploads/delete$', 'fine_uploader.views.delete_uploads', name='delete_uploads'),
+    url(r'^upload/(?P<qquuid>[^/]+)/status$', 'fine_uploader.views.upload_status', name='upload_status'),
     url(r'^upload(?:/(?P<qquuid>\S+))?', UploadView.as_view(), name='upload'),
 )
 urlpatterns += static.static('/browse/', document_root=settings.UPLOAD_DIRECTORY)
@@ -10,13 +10,13 @@
 # * Upload to S3
 # * Delete from S3
 # * Sign Policy documents (simple uploads) and REST requests (chunked/multipart)
-#   uploads
+#   uploads, with Signature Version 2 or 4
 # * non-CORS environment
 
-import base64, hmac, hashlib, os, sys
+import base64, collections, hmac, hashlib, os, re, sys, threading
 
-from flask import (Flask, json, jsonify, make_response, render_template, 
-        request)
+from flask import (Flask, abort, json, jsonify, make_response,
+        render_template, request)
 
 AWS_CLIENT_SECRET_KEY = os.getenv('AWS_CLIENT_SECRET_KEY')
 AWS_SERVER_PUBLIC_KEY = os.getenv('AWS_SERVER_PUBLIC_KEY')
@@ -27,42 +27,133 @@ AWS_MAX_SIZE = 15000000
 app = Flask(__name__)
 app.config.from_object(__name__)
 
+# SigV4 signing keys kept, for the latest dates they were asked for
+SIGNING_KEY_DATES = 2
+# and at most this many of them, least recently used dropped first
+SIGNING_KEYS = 32
+
+_v2_hmac = None
+_v4_hmacs = collections.OrderedDict()
+_v4_lock = threading.Lock()
+
+def v2_hmac():
+    """ HMAC-SHA1 keyed with the secret key, set up once and copied for
+    every signature. """
+    global _v2_hmac
+    if _v2_hmac is None:
+        _v2_hmac = hmac.new(str(app.config.get('AWS_CLIENT_SECRET_KEY')),
+            digestmod=hashlib.sha1)
+    return _v2_hmac.copy()
+
+def v4_hmac(date, region, service='s3'):
+    """ HMAC-SHA256 keyed with the SigV4 signing key for date (YYYYMMDD),
+    region and service, copied from a cache that keeps the keys of the
+    latest SIGNING_KEY_DATES dates, SIGNING_KEYS at most.  Only S3
+    scopes are signed. """
+    if not re.match(r'\d{8}$', date):
+        raise ValueError('Bad date in credential scope: %r' % date)
+    # Any name an S3-compatible store may use (`auto` for R2, MinIO's own
+    # names, ...), but short: it is part of the cache key.
+    if not re.match(r'[A-Za-z0-9_-]{1,32}$', region):
+        raise ValueError('Bad region in credential scope: %r' % region)
+    if service != 's3':
+        raise ValueError('Bad service in credential scope: %r' % service)
+    scope = (date, region, service)
+    with _v4_lock:
+        base = _v4_hmacs.pop(scope, None)
+        if base is not None:
+            _v4_hmacs[scope] = base
+    if base is None:
+        key = 'AWS4' + str(app.config.get('AWS_CLIENT_SECRET_KEY'))
+        for part in scope + ('aws4_request',):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        base = hmac.new(key, digestmod=hashlib.sha256)
+        with _v4_lock:
+            _v4_hmacs[scope] = base
+            dates = sorted(set(cached[0] for cached in _v4_hmacs))
+            for stale in [cached for cached in _v4_hmacs
+                          if cached[0] in dates[:-SIGNING_KEY_DATES]]:
+                del _v4_hmacs[stale]
+            while len(_v4_hmacs) > SIGNING_KEYS:
+                _v4_hmacs.popitem(last=False)
+    return base.copy()
+
 def sign_policy(policy):
     """ Sign and return the policy document for a simple upload.
     http://aws.amazon.com/articles/1434/#signyours3postform """
     signed_policy = base64.b64encode(policy)
-    signature = base64.b64encode(hmac.new(
-        app.config.get('AWS_CLIENT_SECRET_KEY'), signed_policy, hashlib.sha1).
-        digest())
-    return { 'policy': signed_policy, 'signature': signature }
+    hmac_v = v2_hmac()
+    hmac_v.update(signed_policy)
+    return { 'policy': signed_policy,
+             'signature': base64.b64encode(hmac_v.digest()) }
 
 def sign_headers(headers):
     """ Sign and return the headers for a chunked upload. """
-    headers = bytearray(headers, 'utf-8')  # hmac doesn't want unicode
-    return {
-        'signature': base64.b64encode(hmac.new(
-            app.config.get('AWS_CLIENT_SECRET_KEY'), headers, hashlib.sha1).
-            digest())
-    }
+    hmac_v = v2_hmac()
+    hmac_v.update(headers.encode('utf-8'))  # hmac doesn't want unicode
+    return { 'signature': base64.b64encode(hmac_v.digest()) }
+
+def sign_policy_v4(policy, conditions):
+    """ Sign and return the policy document for a simple upload with SigV4,
+    for the date and region of its x-amz-credential condition. """
+    credential = [condition['x-amz-credential'] for condition in conditions
+        if isinstance(condition, dict) and 'x-amz-credential' in condition][0]
+    (_, date, region, service, _) = credential.split('/')
+    signed_policy = base64.b64encode(policy)
+    hmac_v = v4_hmac(date, region, service)
+    hmac_v.update(signed_policy)
+    return { 'policy': signed_policy, 'signature': hmac_v.hexdigest() }
+
+def sign_headers_v4(headers):
+    """ Sign and return the headers for a chunked upload with SigV4. Fine
+    Uploader sends the canonical request in place of its hash. """
+    (algorithm, amz_date, scope, canonical_request) = headers.split('\n', 3)
+    (date, region, service, _) = scope.split('/')
+    hashed_request = hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+    hmac_v = v4_hmac(date, region, service)
+    hmac_v.update('\n'.join((algorithm, amz_date, scope, hashed_request)).
+        encode('utf-8'))
+    return { 'signature': hmac_v.hexdigest() }
     
 @app.route("/s3/sign", methods=['POST'])
 def s3_signature():
     """ Route for signing the policy document or REST headers. """
     request_payload = request.get_json()
-    if request_payload.get('headers'):
-        response_data = sign_headers(request_payload['headers']) 
-    else:
-        response_data = sign_policy(request.data)
+    v4 = request.args.get('v4') == 'true'
+    try:
+        if request_payload.get('headers'):
+            if v4:
+                response_data = sign_headers_v4(request_payload['headers'])
+            else:
+                response_data = sign_headers(request_payload['headers'])
+        elif v4:
+            response_data = sign_policy_v4(request.data,
+                request_payload['conditions'])
+        else:
+            response_data = sign_policy(request.data)
+    except (ValueError, IndexError):
+        # a malformed credential scope
+        abort(400)
     return jsonify(response_data)
     
 
+_s3 = threading.local()
+
+def s3_connection():
+    """ This thread's S3Connection, kept open for the next requests instead of
+    connecting (and handshaking) again for each. """
+    from boto.s3.connection import S3Connection
+    if getattr(_s3, 'connection', None) is None:
+        _s3.connection = S3Connection(app.config.get("AWS_SERVER_PUBLIC_KEY"),
+            app.config.get("AWS_SERVER_SECRET_KEY"))
+    return _s3.connection
+
 @app.route("/s3/delete/<key>", methods=['POST', 'DELETE'])
 def s3_delete(key=None):
     """ Route for deleting files off S3. Uses the SDK. """
     try:
-        from boto.s3.connection import Key, S3Connection
-        S3 = S3Connection(app.config.get("AWS_SERVER_PUBLIC_KEY"), 
-            app.config.get("AWS_SERVER_SECRET_KEY"))
+        from boto.s3.connection import Key
+        S3 = s3_connection()
         request_payload = request.values
         bucket_name = request_payload.get('bucket')
         key_name = request_payload.get('key')
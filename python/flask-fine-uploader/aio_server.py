@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+""" An asyncio server for the upload endpoints of app.py:
+
+    POST   /upload
+    GET    /upload/<uuid>
+    DELETE /upload/<uuid>
+    GET    /upload/<uuid>/status
+    GET    /uploads
+    POST   /uploads/delete
+    GET    /metrics
+
+Request bodies are parsed as they arrive and the file is written to disk in
+pieces of at most WRITE_SIZE bytes, so a slow client costs a coroutine and
+a few buffers rather than a thread. File system calls run on a small thread
+pool. Uploads are stored, and answered, exactly as by app.py, whose Config
+applies (UPLOAD_DIRECTORY, CHUNKS_IN_PLACE, ASSEMBLY_WORKERS, ...).
+
+The page and static files are not served: keep serving them with app.py,
+or a web server in front, and point the uploader's endpoint here.
+
+Requires Python 3.5+.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import errno
+import functools
+import http.client
+import json
+import logging
+import sys
+import tempfile
+from urllib.parse import parse_qsl, unquote
+
+from werkzeug.http import parse_options_header
+
+import app as fine_uploader
+
+logger = logging.getLogger('aio_server')
+
+# Bytes read from a client at a time.
+READ_SIZE = 64 * 1024
+
+# Bytes of an uploaded file collected before they are written out.
+WRITE_SIZE = 256 * 1024
+
+# Limit on a request's head (that on its non-file form fields, all together,
+# is app.py's MAX_FIELDS_SIZE).
+MAX_HEAD_SIZE = 64 * 1024
+
+# Seconds a client may stay silent before it is disconnected.
+READ_TIMEOUT = 60
+
+
+class BadRequest(Exception):
+    pass
+
+
+class UploadServer(object):
+    """ Serves the upload endpoints over HTTP/1.1 (with keep-alive) on
+    asyncio streams, one coroutine per connection.
+    """
+
+    def __init__(self, workers, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def run(self, function, *args):
+        """ Run a blocking call on the file system thread pool."""
+        return self.loop.run_in_executor(self.executor,
+            functools.partial(function, *args))
+
+    async def read(self, reader, size):
+        data = await asyncio.wait_for(reader.read(size), READ_TIMEOUT)
+        if not data:
+            raise ConnectionError('Client disconnected')
+        return data
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while await self.handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception('Connection failed')
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer):
+        """ Serve one request. Returns whether the connection can be used
+        for another.
+        """
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), READ_TIMEOUT)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return False
+        except asyncio.LimitOverrunError:
+            await self.respond(writer, 431, {'success': False,
+                'error': 'Request header too large'}, keep_alive=False)
+            return False
+
+        request_line, _, header_lines = head.partition(b'\r\n')
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+            headers = fine_uploader.parse_headers(header_lines)
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            await self.respond(writer, 400, {'success': False,
+                'error': 'Malformed request'}, keep_alive=False)
+            return False
+        connection = headers.get('connection', '').lower()
+        keep_alive = (connection != 'close' if version == 'HTTP/1.1'
+            else connection == 'keep-alive')
+        xhr = headers.get('x-requested-with') == 'XMLHttpRequest'
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            await self.respond(writer, 411, {'success': False,
+                'error': 'Content-Length required'}, keep_alive=False)
+            return False
+        max_length = fine_uploader.app.config['MAX_CONTENT_LENGTH']
+        if max_length is not None and length > max_length:
+            # Refused before any of the body is read, like app.py does.
+            await self.respond(writer, 413, {'success': False,
+                'error': 'Request too large'}, keep_alive=False, xhr=xhr)
+            return False
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        body = RequestBody(self, reader, length)
+        location, _, query = target.partition('?')
+        path = [unquote(segment) for segment in location.strip('/').split('/')]
+        try:
+            status, content = await self.dispatch(method, path, dict(parse_qsl(query)),
+                headers, body)
+        except BadRequest as e:
+            fine_uploader.metrics.inc('fine_uploader_errors_total', where='request')
+            status, content = 400, {'success': False, 'error': str(e)}
+        except fine_uploader.StorageError as e:
+            # Counted in the errors metric by the assembly that failed.
+            logger.error('%s %s failed: %s', method, target, e)
+            status, content = 500, {'success': False, 'error': 'Storage error: %s' % e}
+        except (ConnectionError, asyncio.TimeoutError):
+            raise
+        except Exception:
+            logger.exception('%s %s failed', method, target)
+            status, content = 500, {'success': False, 'error': 'Internal server error'}
+
+        # Whatever is left of a body that was not read can't be skipped
+        # safely: drop the connection after answering.
+        keep_alive = keep_alive and body.remaining == 0
+        await self.respond(writer, status, content, keep_alive, xhr)
+        return keep_alive
+
+    async def dispatch(self, method, path, query, headers, body):
+        if path == ['upload'] and method == 'POST':
+            return await self.upload(headers, body)
+        if len(path) == 2 and path[0] == 'upload' and method == 'GET':
+            try:
+                return self.found(await self.run(fine_uploader.handle_parts, path[1]))
+            except ValueError as e:
+                raise BadRequest(str(e))
+        if len(path) == 2 and path[0] == 'upload' and method == 'DELETE':
+            try:
+                await self.run(fine_uploader.handle_delete, path[1])
+            except Exception as e:
+                if isinstance(e, OSError) and e.errno == errno.ENOENT:
+                    return 404, {'success': False, 'error': 'Upload not found'}
+                return 400, {'success': False, 'error': str(e)}
+            return 200, {'success': True}
+        if len(path) == 3 and path[0] == 'upload' and path[2] == 'status' and method == 'GET':
+            try:
+                return self.found(await self.run(fine_uploader.handle_status, path[1]))
+            except ValueError as e:
+                raise BadRequest(str(e))
+        if path == ['uploads'] and method == 'GET':
+            try:
+                listing = await self.run(fine_uploader.handle_listing,
+                    query.get('after'), query.get('limit'), query.get('state'))
+            except ValueError as e:
+                raise BadRequest(str(e))
+            if listing is None:
+                return 404, {'success': False, 'error': 'No upload index'}
+            listing['success'] = True
+            return 200, listing
+        if path == ['uploads', 'delete'] and method == 'POST':
+            if body.remaining > fine_uploader.MAX_FIELDS_SIZE:
+                return 413, {'success': False, 'error': 'Request too large'}
+            data = b''
+            while body.remaining:
+                data += await body.read()
+            try:
+                result = await self.run(fine_uploader.handle_bulk_delete,
+                    fine_uploader.parse_uuids(data))
+            except ValueError as e:
+                raise BadRequest(str(e))
+            result['success'] = not result['failed']
+            return 200, result
+        if path == ['metrics'] and method == 'GET':
+            return 200, fine_uploader.metrics.render()
+        return 404, {'success': False, 'error': 'Not found'}
+
+    def found(self, content):
+        if content is None:
+            return 404, {'success': False, 'error': 'Upload not found'}
+        content['success'] = True
+        return 200, content
+
+    async def upload(self, headers, body):
+        """ The POST of an upload, as `fine_uploader.receive_upload`: the
+        file is streamed to its UploadWriter as the body comes in. Fine
+        Uploader sends the other fields before the file, so the writer can
+        be opened as soon as the file starts; if they come after it, the
+        file is spooled and stored once the body is in.
+        """
+        content_type, options = parse_options_header(headers.get('content-type', ''))
+        if content_type != 'multipart/form-data' or 'boundary' not in options:
+            raise BadRequest('Expected multipart/form-data')
+        parser = fine_uploader.MultipartParser(options['boundary'].encode('latin-1'))
+
+        fields = {}
+        field = None
+        fields_size = 0
+        upload = None
+        spool = None
+        received_file = False
+        pending = []
+        pending_size = 0
+        try:
+            while not parser.done:
+                if not body.remaining:
+                    raise BadRequest('Truncated multipart body')
+                try:
+                    events = parser.feed(await body.read())
+                except ValueError as e:
+                    raise BadRequest(str(e))
+                for event in events:
+                    if event[0] == 'part':
+                        name, filename = event[1:]
+                        if name == 'qqfile' and filename is not None and not received_file:
+                            received_file = True
+                            field = None
+                            if not fine_uploader.validate(fields):
+                                raise BadRequest('Invalid request')
+                            try:
+                                upload = await self.run(fine_uploader.open_upload, fields)
+                            except KeyError:
+                                spool = await self.run(tempfile.TemporaryFile)
+                            except ValueError as e:
+                                raise BadRequest('Invalid request: %s' % e)
+                        else:
+                            field = fields[name] = bytearray()
+                    elif event[0] == 'data':
+                        if field is not None:
+                            field += event[1]
+                            fields_size += len(event[1])
+                            if fields_size > fine_uploader.MAX_FIELDS_SIZE:
+                                raise BadRequest('Too much form data')
+                        elif upload is not None or spool is not None:
+                            pending.append(event[1])
+                            pending_size += len(event[1])
+                            if pending_size >= WRITE_SIZE:
+                                await self.run((upload or spool).write, b''.join(pending))
+                                pending, pending_size = [], 0
+                    elif field is not None:
+                        fields[name] = field.decode('utf-8')
+                        field = None
+            if not received_file:
+                raise BadRequest('No file')
+            if pending:
+                await self.run((upload or spool).write, b''.join(pending))
+        except BaseException:
+            if upload is not None:
+                await self.run(upload.abort)
+            if spool is not None:
+                spool.close()
+            raise
+
+        # close aborts the upload itself if it fails.
+        if spool is not None:
+            try:
+                result = await self.run(store_spooled, spool, fields)
+            except (KeyError, ValueError) as e:
+                raise BadRequest('Invalid request: %s' % e)
+        elif upload is not None:
+            result = await self.run(upload.close)
+        else:
+            # Already stored: the bytes were skipped.
+            result = {}
+        result['success'] = True
+        return 200, result
+
+    async def respond(self, writer, status, content, keep_alive=True, xhr=False):
+        """ Send a response: `content` is the dict of a JSON response, or
+        the text of /metrics.
+        """
+        if isinstance(content, str):
+            body = content.encode('utf-8')
+            content_type = fine_uploader.METRICS_CONTENT_TYPE
+        else:
+            body = json.dumps(content, indent=None if xhr else 2).encode('utf-8')
+            content_type = 'text/plain'
+        writer.write(('HTTP/1.1 %d %s\r\n'
+            'Content-Type: %s\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: %s\r\n\r\n' % (status, http.client.responses.get(status, ''),
+                content_type, len(body), 'keep-alive' if keep_alive else 'close')).encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+
+def store_spooled(spool, fields):
+    """ Store the file spooled by `UploadServer.upload`, whose fields came
+    after it, and close the spool.
+    """
+    with spool:
+        spool.seek(0)
+        return fine_uploader.handle_upload(spool, fields)
+
+
+class RequestBody(object):
+    """ The body of a request, read in pieces of at most READ_SIZE bytes."""
+
+    def __init__(self, server, reader, length):
+        self.server = server
+        self.reader = reader
+        self.remaining = length
+
+    async def read(self):
+        data = await self.server.read(self.reader, min(self.remaining, READ_SIZE))
+        self.remaining -= len(data)
+        return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fine Uploader asyncio upload server.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4,
+        help='threads that make the file system calls (default: 4)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = UploadServer(args.workers, loop)
+    listener = loop.run_until_complete(asyncio.start_server(
+        server.handle_connection, args.host, args.port, limit=MAX_HEAD_SIZE))
+    fine_uploader.janitor_thread()
+    logger.info('Serving uploads on %s:%d', args.host, args.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        server.executor.shutdown()
+        loop.close()
+    return 0
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,184 @@
+""" Tests of the chunked upload paths of app.py: assembly, resume and retry
+after a failed assembly. Run with `python -m unittest test_app` (or pytest)
+from this directory.
+"""
+import errno
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import app as fine_uploader
+
+
+class ChunkedUploadTest(unittest.TestCase):
+
+    CHUNK_SIZE = 4
+    DATA = b'0123456789ab'  # three chunks of CHUNK_SIZE bytes
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.config = dict(fine_uploader.app.config)
+        fine_uploader.app.config.update(
+            UPLOAD_DIRECTORY=os.path.join(self.folder, 'upload'),
+            CHUNKS_DIRECTORY=os.path.join(self.folder, 'chunks'),
+            TRASH_DIRECTORY=os.path.join(self.folder, 'trash'),
+            CHUNKS_IN_PLACE=False,
+            ASSEMBLY_WORKERS=0,
+            UPLOAD_DIGEST=None,
+            UPLOAD_INDEX=None)
+        self.client = fine_uploader.app.test_client()
+        self.copy_range = fine_uploader.copy_range
+
+    def tearDown(self):
+        fine_uploader.copy_range = self.copy_range
+        fine_uploader.app.config.clear()
+        fine_uploader.app.config.update(self.config)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def post_chunk(self, uuid, index):
+        data = self.DATA[index * self.CHUNK_SIZE:(index + 1) * self.CHUNK_SIZE]
+        response = self.client.post('/upload', data={
+            'qquuid': uuid,
+            'qqfilename': 'f.bin',
+            'qqpartindex': str(index),
+            'qqpartbyteoffset': str(index * self.CHUNK_SIZE),
+            'qqchunksize': str(len(data)),
+            'qqtotalparts': str(len(self.DATA) // self.CHUNK_SIZE),
+            'qqtotalfilesize': str(len(self.DATA)),
+            'qqfile': (io.BytesIO(data), 'f.bin'),
+        })
+        return response.status_code, json.loads(response.data.decode('utf-8'))
+
+    def get(self, url):
+        response = self.client.get(url)
+        return response.status_code, json.loads(response.data.decode('utf-8'))
+
+    def stored(self, uuid):
+        path = os.path.join(fine_uploader.app.config['UPLOAD_DIRECTORY'], uuid, 'f.bin')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_chunks_in_any_order_are_assembled_once(self):
+        for index in (2, 0, 1):
+            self.assertEqual(self.post_chunk('u1', index), (200, {'success': True}))
+        self.assertEqual(self.stored('u1'), self.DATA)
+        self.assertFalse(os.path.exists(fine_uploader.part_tracker('u1').folder))
+        self.assertEqual(self.get('/upload/u1/status')[1]['state'], 'complete')
+
+    def test_resume_lists_the_received_chunks_and_skips_them(self):
+        self.post_chunk('u2', 0)
+        self.post_chunk('u2', 2)
+        status, parts = self.get('/upload/u2')
+        self.assertEqual(status, 200)
+        self.assertEqual(parts['state'], 'receiving')
+        self.assertEqual(sorted(part['index'] for part in parts['parts']), [0, 2])
+
+        # A chunk already stored, sent again, is not counted again.
+        self.assertEqual(self.post_chunk('u2', 0), (200, {'success': True}))
+        self.assertEqual(self.get('/upload/u2/status')[1]['receivedBytes'], 8)
+        self.assertIsNone(self.stored('u2'))
+
+        self.assertEqual(self.post_chunk('u2', 1), (200, {'success': True}))
+        self.assertEqual(self.stored('u2'), self.DATA)
+
+    def test_retry_after_failed_assembly(self):
+        copied = []
+        def copy_range(source, destination, count):
+            copied.append(count)
+            if len(copied) == 3:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            return self.copy_range(source, destination, count)
+        fine_uploader.copy_range = copy_range
+
+        self.assertEqual(self.post_chunk('u3', 0)[0], 200)
+        self.assertEqual(self.post_chunk('u3', 1)[0], 200)
+        with self.assertRaises(OSError):
+            # Propagated by the test client; a server answers 500.
+            self.post_chunk('u3', 2)
+        self.assertEqual(self.get('/upload/u3/status')[1]['state'], 'failed')
+        self.assertIsNone(self.stored('u3'))
+
+        # The client retries the last chunk: the upload is assembled again.
+        self.assertEqual(self.post_chunk('u3', 2), (200, {'success': True}))
+        self.assertEqual(self.stored('u3'), self.DATA)
+        self.assertEqual(self.get('/upload/u3/status')[1]['state'], 'complete')
+
+    def test_delete_of_an_upload_gone_from_disk_forgets_it(self):
+        fine_uploader.app.config['UPLOAD_INDEX'] = os.path.join(self.folder, 'index.db')
+        for index in range(3):
+            self.post_chunk('u4', index)
+        self.assertIsNotNone(fine_uploader.upload_index().get('u4'))
+        shutil.rmtree(os.path.join(fine_uploader.app.config['UPLOAD_DIRECTORY'], 'u4'))
+
+        self.assertEqual(self.client.delete('/upload/u4').status_code, 404)
+        self.assertIsNone(fine_uploader.upload_index().get('u4'))
+
+
+class PartTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.tracker = fine_uploader.PartTracker(os.path.join(self.folder, 'u'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_completes_once(self):
+        self.assertEqual(self.tracker.add(1, 4, 2, 8), (False, True))
+        self.assertEqual(self.tracker.add(1, 4, 2, 8), (False, False))
+        self.assertEqual(self.tracker.add(0, 4, 2, 8), (True, True))
+        self.assertEqual(self.tracker.add(0, 4, 2, 8), (False, False))
+        status = self.tracker.status()
+        self.assertEqual(status['state'], 'assembling')
+        self.assertEqual(status['received_bytes'], 8)
+        self.assertEqual(status['parts'], [(0, 4), (1, 4)])
+
+    def test_a_failed_upload_completes_again(self):
+        self.tracker.add(0, 4, 1, 4)
+        self.tracker.set_failed()
+        self.assertTrue(self.tracker.failed())
+        self.assertEqual(self.tracker.add(0, 4, 1, 4), (True, False))
+        self.assertFalse(self.tracker.failed())
+
+    def test_rejects_parts_out_of_range(self):
+        self.assertRaises(ValueError, self.tracker.add, 2, 4, 2, 8)
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.blobs = fine_uploader.BlobStore(os.path.join(self.folder, 'blobs'), 'md5')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def upload(self, name, data):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_same_content_is_linked(self):
+        first, second = self.upload('a', b'same'), self.upload('b', b'same')
+        self.assertFalse(self.blobs.add(first, 'd1'))
+        self.assertTrue(self.blobs.add(second, 'd1'))
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+
+    def test_colliding_digest_is_not_linked(self):
+        first, second = self.upload('a', b'mine'), self.upload('b', b'evil')
+        self.blobs.add(first, 'd1')
+        self.assertFalse(self.blobs.add(second, 'd1'))
+        with open(second, 'rb') as f:
+            self.assertEqual(f.read(), b'evil')
+        with open(first, 'rb') as f:
+            self.assertEqual(f.read(), b'mine')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+""" Microbenchmark of the signing functions of s3-sign-srv.py.
+
+Measures signatures/sec for SigV2 and SigV4 policies and chunked REST
+headers, signed the way s3-sign-srv.py used to (the HMAC key set up from
+AWS_CLIENT_SECRET_KEY, and for SigV4 the signing key derived, on every call)
+and the way it does now (copies of HMAC state keyed once, SigV4 signing keys
+cached per date/region/service).
+
+    ./bench_sign.py --seconds 2
+
+Needs the same dependencies as s3-sign-srv.py (Flask) and nothing else.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import importlib.util
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('AWS_CLIENT_SECRET_KEY', 'XyXyXyXyXyXyXyXyXyXyXyXyXyXyXyXyXyXyXyXy')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCOPE = '20170101/us-east-1/s3/aws4_request'
+
+POLICY = json.dumps({
+    'expiration': '2017-01-01T00:05:00.000Z',
+    'conditions': [
+        {'acl': 'private'},
+        {'bucket': 'somebucket'},
+        {'Content-Type': 'text/plain'},
+        {'success_action_status': '200'},
+        {'x-amz-algorithm': 'AWS4-HMAC-SHA256'},
+        {'key': '0b6a1f2e-8c35-4cd8-9d1b-9a2f4e0c7b11.txt'},
+        {'x-amz-credential': 'XXXXXXXXXXXXXXXXXXXX/' + SCOPE},
+        {'x-amz-date': '20170101T000000Z'},
+        {'x-amz-meta-qqfilename': '1kb.txt'},
+        {'x-amz-meta-dataset': '731db507-1240-44ab-a616-de95f02aeaa4'},
+        ['content-length-range', '0', '15000000'],
+    ]}).encode()
+
+CONDITIONS = json.loads(POLICY.decode())['conditions']
+
+HEADERS_V2 = ('PUT\n\n\n\nx-amz-date:Sun, 01 Jan 2017 00:00:00 GMT\n'
+              '/somebucket/0b6a1f2e-8c35-4cd8-9d1b-9a2f4e0c7b11.txt'
+              '?partNumber=2&uploadId=VXBsb2FkSWQ')
+
+HEADERS_V4 = ('AWS4-HMAC-SHA256\n20170101T000000Z\n' + SCOPE + '\n'
+              'PUT\n/0b6a1f2e-8c35-4cd8-9d1b-9a2f4e0c7b11.txt\n'
+              'partNumber=2&uploadId=VXBsb2FkSWQ\n'
+              'host:somebucket.s3.amazonaws.com\n'
+              'x-amz-content-sha256:UNSIGNED-PAYLOAD\n'
+              'x-amz-date:20170101T000000Z\n\n'
+              'host;x-amz-content-sha256;x-amz-date\nUNSIGNED-PAYLOAD')
+
+
+def load_server():
+    """ s3-sign-srv.py, imported as a module. """
+    spec = importlib.util.spec_from_file_location(
+        's3_sign_srv', os.path.join(HERE, 's3-sign-srv.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # for app.config.from_object()
+    spec.loader.exec_module(module)
+    return module
+
+
+# How s3-sign-srv.py signed before: everything set up again on every call.
+
+def secret():
+    return str(os.getenv('AWS_CLIENT_SECRET_KEY')).encode()
+
+
+def uncached_signing_key(date, region, service):
+    key = b'AWS4' + secret()
+    for part in (date, region, service, 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+
+def uncached_sign_policy(policy):
+    signed_policy = base64.b64encode(policy)
+    return base64.b64encode(hmac.new(secret(), signed_policy, hashlib.sha1).digest())
+
+
+def uncached_sign_headers(headers):
+    return base64.b64encode(hmac.new(secret(), headers.encode(), hashlib.sha1).digest())
+
+
+def uncached_sign_policy_v4(policy, conditions):
+    credential = [c['x-amz-credential'] for c in conditions
+                  if isinstance(c, dict) and 'x-amz-credential' in c][0]
+    (_, date, region, service, _) = credential.split('/')
+    key = uncached_signing_key(date, region, service)
+    return hmac.new(key, base64.b64encode(policy), hashlib.sha256).hexdigest()
+
+
+def uncached_sign_headers_v4(headers):
+    (algorithm, amz_date, scope, canonical_request) = headers.split('\n', 3)
+    (date, region, service, _) = scope.split('/')
+    key = uncached_signing_key(date, region, service)
+    string_to_sign = '\n'.join((algorithm, amz_date, scope,
+        hashlib.sha256(canonical_request.encode()).hexdigest()))
+    return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+
+def rate(sign, seconds):
+    """ Signatures/sec of sign(), called for about that many seconds. """
+    count = 0
+    batch = 1000
+    started = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            sign()
+        count += batch
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=1.0,
+        help='time to run each case for (default: %(default)s)')
+    parser.add_argument('--json', metavar='FILE',
+        help="also write the results as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    srv = load_server()
+    cases = [
+        ('v2 policy', lambda: uncached_sign_policy(POLICY).decode(),
+            lambda: srv.sign_policy(POLICY)['signature']),
+        ('v2 headers', lambda: uncached_sign_headers(HEADERS_V2).decode(),
+            lambda: srv.sign_headers(HEADERS_V2)['signature']),
+        ('v4 policy', lambda: uncached_sign_policy_v4(POLICY, CONDITIONS),
+            lambda: srv.sign_policy_v4(POLICY, CONDITIONS)['signature']),
+        ('v4 headers', lambda: uncached_sign_headers_v4(HEADERS_V4),
+            lambda: srv.sign_headers_v4(HEADERS_V4)['signature']),
+    ]
+    for (name, before, after) in cases:
+        if before() != after():
+            sys.exit('%s: signatures differ' % name)
+
+    results = {}
+    print('%-12s %14s %14s %8s' % ('signing', 'before/sec', 'after/sec', 'speedup'))
+    for (name, before, after) in cases:
+        results[name] = {'before': rate(before, args.seconds),
+                         'after': rate(after, args.seconds)}
+        print('%-12s %14.0f %14.0f %7.2fx' % (name, results[name]['before'],
+            results[name]['after'], results[name]['after'] / results[name]['before']))
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    elif args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,7 @@ Features:
 * Upload to S3
 * Delete from S3
 * Sign Policy documents (simple uploads) and REST requests (chunked/multipart) uploads
+  with Signature Version 2 or 4
 * non-CORS environment
 
 Enhanced by: Keiran Raine
@@ -19,26 +20,257 @@ Enhanced by: Keiran Raine
 * Standardised access to request data for server side hooks
 """
 
-import base64, hmac, hashlib, os, sys, re
+import atexit, base64, collections, contextlib, errno, fcntl, fnmatch, heapq, hmac, hashlib, importlib, logging, logging.handlers, os, queue, random, sys, re, signal, socket, sqlite3, ssl, threading, time
+import urllib.request
+from socketserver import ThreadingMixIn
 
 from flask import (Flask, json, jsonify, make_response, render_template,
         request, abort)
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 
 AWS_CLIENT_SECRET_KEY = os.getenv('AWS_CLIENT_SECRET_KEY')
 AWS_CLIENT_ACCESS_KEY = os.getenv('AWS_CLIENT_ACCESS_KEY')
 AWS_ENDPOINT = os.getenv('AWS_ENDPOINT')
 
+# SigV4 signing keys kept, for the latest dates they were asked for
+SIGNING_KEY_DATES = 2
+# and at most this many of them, least recently used dropped first
+SIGNING_KEYS = 32
+
+# most requests /s3/sign/batch signs at once (the most parts an S3 upload has)
+SIGN_BATCH_LIMIT = 10000
+
+PART_NUMBER = re.compile(r'(?<=[?&\n])partNumber=\d+')
+META_HEADER = re.compile(r'(x-amz-meta-[^:]+):(.+)')
+INITIATE_RESOURCE = re.compile(r'/([^/]+)/([^.]+)\.([^?]+)\?uploads')
+HOST_HEADER = re.compile(r'^host:(.+)$', re.M)
+# virtual-hosted-style S3 endpoint: the bucket (dots and all) is what precedes
+# s3., s3.<region>., s3-<region>. or s3.dualstack.<region>.
+VIRTUAL_HOST = re.compile(r'^(.+)\.s3(?:[.-][a-z0-9-]+)*\.amazonaws\.com(?:\.cn)?(?::\d+)?$')
+
+# file (JSON or SQLite) of the rules that say which uploads may be signed
+P3S3F_POLICY = os.getenv('P3S3F_POLICY')
+
+# connections the S3 client keeps open, shared by every thread
+P3S3F_S3_POOL = int(os.getenv('P3S3F_S3_POOL', '10'))
+# seconds a delete waits for others to go in the same DeleteObjects call
+P3S3F_DELETE_LINGER = float(os.getenv('P3S3F_DELETE_LINGER', '0.05'))
+
+# SQLite file completed uploads are queued in for the backend (None: not queued)
+P3S3F_NOTIFY_QUEUE = os.getenv('P3S3F_NOTIFY_QUEUE')
+# where they are delivered: http(s)://... webhook, sqlite:<path>, file:<path>
+# or module:callable
+P3S3F_NOTIFY_SINK = os.getenv('P3S3F_NOTIFY_SINK')
+P3S3F_NOTIFY_MAX_PENDING = int(os.getenv('P3S3F_NOTIFY_MAX_PENDING', '100000'))
+P3S3F_NOTIFY_BATCH = int(os.getenv('P3S3F_NOTIFY_BATCH', '100'))
+
+# log records queued for the thread writing them to stderr (as JSON lines);
+# more are dropped rather than keep requests waiting
+P3S3F_LOG_QUEUE = int(os.getenv('P3S3F_LOG_QUEUE', '10000'))
+# per event, the fraction of its info records logged, e.g. sign=0.01,success=0.5
+P3S3F_LOG_SAMPLE = os.getenv('P3S3F_LOG_SAMPLE', '')
+# per event, the most records logged a second, e.g. sign=100,delete=50
+P3S3F_LOG_RATE = os.getenv('P3S3F_LOG_RATE', '')
+
+NOT_APPROVED = 'This file has not been approved for transfer, check upload is to correct dataset.'
+
 app = Flask(__name__)
 app.config.from_object(__name__)
 
+class JSONFormatter(logging.Formatter):
+    """ A record as a line of JSON: its time, level, event (the logger's name
+    if it has none), message and the fields logged with it. """
+
+    def format(self, record):
+        entry = dict(getattr(record, 'fields', {}))
+        entry.update({'time': round(record.created, 6), 'level': record.levelname,
+                      'event': getattr(record, 'event', record.name),
+                      'message': record.getMessage().rstrip()})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class EventFilter(logging.Filter):
+    """ Thins out records by their event: of the info (and debug) records of
+    an event in `sample`, only that fraction is kept, picked at random, and
+    of the records of an event in `rate`, at most that many a second (a token
+    bucket, so bursts of up to a second's worth go through). `dropped` counts
+    the records dropped, by (event, reason). """
+
+    def __init__(self, sample=None, rate=None):
+        logging.Filter.__init__(self)
+        self.sample = sample or {}
+        self.rate = rate or {}
+        self.buckets = {}
+        self.dropped = collections.Counter()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, 'event', record.name)
+        fraction = self.sample.get(event)
+        if fraction is not None and record.levelno < logging.WARNING and random.random() >= fraction:
+            with self._lock:
+                self.dropped[(event, 'sampled')] += 1
+            return False
+        limit = self.rate.get(event)
+        if limit is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            (tokens, last) = self.buckets.get(event, (limit, now))
+            tokens = min(limit, tokens + (now - last) * limit)
+            if tokens < 1:
+                self.buckets[event] = (tokens, now)
+                self.dropped[(event, 'rate')] += 1
+                return False
+            self.buckets[event] = (tokens - 1, now)
+        return True
+
+class LogQueue(logging.handlers.QueueHandler):
+    """ Logs in the background: a thread, like QueueListener's, hands the
+    records to `target` (a handler), so all a request pays to log is a put on
+    the queue. Records are formatted in that thread too. When `size` records
+    are waiting, more are dropped (and counted in `dropped`) rather than wait
+    for a slow stderr. Every process (see serve()) starts a thread of its own.
+    """
+
+    def __init__(self, target, size=10000):
+        logging.handlers.QueueHandler.__init__(self, queue.Queue(size))
+        self.target = target
+        self.thread = None
+        self.pid = None
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            # the parent's thread didn't come along into this process
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.thread = threading.Thread(target=self._run, args=(self.queue,),
+                                           name='log', daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def stop(self, timeout=5):
+        """ Write out the records still queued and stop the thread, giving up
+        after timeout seconds: a sentinel is queued behind the records (as
+        QueueListener.stop does, but waiting for room if the queue is full)
+        and the thread joined. """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if self.pid != os.getpid():
+                return
+            self.pid = None
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self.thread.join(max(0, deadline - time.monotonic()))
+
+    def _run(self, records):
+        while True:
+            record = records.get()
+            if record is None:
+                return
+            if record.levelno >= self.target.level:
+                self.target.handle(record)
+
+def event_settings(spec):
+    """ {event: number} of a P3S3F_LOG_SAMPLE/P3S3F_LOG_RATE setting. """
+    settings = {}
+    for item in spec.split(','):
+        if item.strip():
+            (event, value) = item.split('=')
+            settings[event.strip()] = float(value)
+    return settings
+
+def log_event(name, fields=(), **more):
+    """ The `extra` of a record of event `name`, with those fields (a dict,
+    and/or keywords): log.info('Delete', extra=log_event('delete', key=key)) """
+    return {'event': name, 'fields': dict(fields, **more)}
+
+_log_output = logging.StreamHandler(sys.stderr)
+_log_output.setFormatter(JSONFormatter())
+log_filter = EventFilter(event_settings(P3S3F_LOG_SAMPLE), event_settings(P3S3F_LOG_RATE))
+log_queue = LogQueue(_log_output, P3S3F_LOG_QUEUE)
+log_queue.addFilter(log_filter)
+atexit.register(log_queue.stop)
+
+log = logging.getLogger('s3-sign-srv')
+# werkzeug's is the access log, a record a request (event 'werkzeug')
+for _logger in (log, logging.getLogger('werkzeug')):
+    _logger.setLevel(logging.INFO)
+    _logger.addHandler(log_queue)
+    _logger.propagate = False
+
+_v2_hmac = None
+_v4_hmacs = collections.OrderedDict()
+_v4_lock = threading.Lock()
+
+def v2_hmac():
+    """ HMAC-SHA1 keyed with the secret key (SigV2). The key is set up once;
+    every signature starts from a copy of it. """
+    global _v2_hmac
+    if _v2_hmac is None:
+        _v2_hmac = hmac.new(str(AWS_CLIENT_SECRET_KEY).encode(),
+                            digestmod=hashlib.sha1)
+    return _v2_hmac.copy()
+
+def v4_hmac(date, region, service='s3'):
+    """ HMAC-SHA256 keyed with the SigV4 signing key for date (YYYYMMDD),
+    region and service. The key takes four HMACs to derive and only changes
+    with the date, so it is derived once and cached; the cache only keeps the
+    keys of the latest SIGNING_KEY_DATES dates, so it moves on with the date
+    (clients a little behind still find theirs), and SIGNING_KEYS keys at
+    most. Only well-formed S3 scopes are derived, so a client cannot fill it
+    with made-up regions and services. """
+    if not re.match(r'\d{8}$', date):
+        raise ValueError('Bad date in credential scope: %r' % date)
+    # Any name an S3-compatible store may use (`auto` for R2, MinIO's own
+    # names, ...), but short: it is part of the cache key.
+    if not re.match(r'[A-Za-z0-9_-]{1,32}$', region):
+        raise ValueError('Bad region in credential scope: %r' % region)
+    if service != 's3':
+        raise ValueError('Bad service in credential scope: %r' % service)
+    scope = (date, region, service)
+    with _v4_lock:
+        base = _v4_hmacs.pop(scope, None)
+        if base is not None:
+            _v4_hmacs[scope] = base
+    if base is None:
+        key = ('AWS4' + str(AWS_CLIENT_SECRET_KEY)).encode()
+        for part in scope + ('aws4_request',):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        base = hmac.new(key, digestmod=hashlib.sha256)
+        with _v4_lock:
+            _v4_hmacs[scope] = base
+            dates = sorted(set(cached[0] for cached in _v4_hmacs))
+            for stale in [cached for cached in _v4_hmacs
+                          if cached[0] in dates[:-SIGNING_KEY_DATES]]:
+                del _v4_hmacs[stale]
+            while len(_v4_hmacs) > SIGNING_KEYS:
+                _v4_hmacs.popitem(last=False)
+    return base.copy()
+
 def sign_policy(policy):
     """ Sign and return the policy document for a simple upload.
     http://aws.amazon.com/articles/1434/#signyours3postform """
     signed_policy = base64.b64encode(policy)
-    encoded_key = str(AWS_CLIENT_SECRET_KEY).encode()
-    hmac_v = hmac.new(encoded_key,
-                      signed_policy,
-                      hashlib.sha1)
+    hmac_v = v2_hmac()
+    hmac_v.update(signed_policy)
     signature = base64.b64encode(hmac_v.digest())
     return {
         'policy': signed_policy.decode("utf-8"),
@@ -47,38 +279,240 @@ def sign_policy(policy):
 
 def sign_headers(headers):
     """ Sign and return the headers for a chunked upload. """
-    encoded_key = str(AWS_CLIENT_SECRET_KEY).encode()
-    hmac_v = hmac.new(encoded_key,
-                      bytearray(headers, 'utf-8'), # hmac doesn't want unicode
-                      hashlib.sha1)
+    hmac_v = v2_hmac()
+    hmac_v.update(headers.encode('utf-8')) # hmac doesn't want unicode
     signature = base64.b64encode(hmac_v.digest())
     return {
         'signature': signature.decode("utf-8")
     }
 
+def sign_policy_v4(policy, conditions):
+    """ Sign and return the policy document for a simple upload with SigV4:
+    the date and region are those of its x-amz-credential condition.
+    https://docs.aws.amazon.com/AmazonS3/latest/API/sigv4-post-example.html """
+    credential = challenge_from_conditions(conditions)['x-amz-credential']
+    (_, date, region, service, _) = credential.split('/')
+    signed_policy = base64.b64encode(policy)
+    hmac_v = v4_hmac(date, region, service)
+    hmac_v.update(signed_policy)
+    return {
+        'policy': signed_policy.decode("utf-8"),
+        'signature': hmac_v.hexdigest()
+    }
+
+def sign_headers_v4(headers):
+    """ Sign and return the headers for a chunked upload with SigV4. Fine
+    Uploader sends the string to sign with the canonical request in place of
+    its hash, so hash it first. """
+    (algorithm, amz_date, scope, canonical_request) = headers.split('\n', 3)
+    (date, region, service, _) = scope.split('/')
+    hashed_request = hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+    hmac_v = v4_hmac(date, region, service)
+    hmac_v.update('\n'.join((algorithm, amz_date, scope, hashed_request)).encode('utf-8'))
+    return {
+        'signature': hmac_v.hexdigest()
+    }
+
 def challenge_from_headers(headers):
-    print(">>>>" + headers)
-    patt = re.compile(r'(x-amz-meta-[^:]+):(.+)')
+    log.info('Headers to sign', extra=log_event('sign.headers', headers=headers))
     for_challenge = {}
-    for (key, value) in re.findall(patt, headers):
+    for (key, value) in META_HEADER.findall(headers):
         for_challenge[key] = value
 
     # now figure out bucket key and uuid from request
     url_data = headers.split('\n')[-1].strip()
-    (bucket, uuid, ext) = re.match(r'/([^/]+)/([^.]+)\.([^?]+)\?uploads', url_data).groups()
+    (bucket, uuid, ext) = INITIATE_RESOURCE.match(url_data).groups()
     for_challenge['bucket'] = bucket
     for_challenge['uuid'] = uuid
     for_challenge['key'] = uuid + '.' + ext
 
     return for_challenge
 
+def challenge_from_v4_headers(headers):
+    """ As challenge_from_headers, for the SigV4 string to sign, whose
+    canonical request has the key as its path and the bucket in the host
+    header of virtual-hosted-style requests, or first in the path of
+    path-style ones (to s3.amazonaws.com, a regional endpoint or another
+    S3 endpoint altogether). """
+    canonical_request = headers.split('\n', 3)[3]
+    for_challenge = dict(META_HEADER.findall(canonical_request))
+
+    path = canonical_request.split('\n')[1]
+    host = HOST_HEADER.search(canonical_request).group(1).strip().lower()
+    virtual_host = VIRTUAL_HOST.match(host)
+    if virtual_host:
+        (bucket, key) = (virtual_host.group(1), path[1:])
+    elif path.count('/') > 1:
+        (bucket, key) = path[1:].split('/', 1)
+    else:
+        (bucket, key) = (host.split('.')[0], path[1:])
+    for_challenge['bucket'] = bucket
+    for_challenge['uuid'] = key.split('.')[0]
+    for_challenge['key'] = key
+
+    return for_challenge
+
 def challenge_from_conditions(conditions):
     for_challenge = {}
     for item in conditions:
+        if isinstance(item, list):
+            # e.g. ["content-length-range", 0, 15000000]
+            for_challenge[item[0]] = item[1:]
+            continue
         for key, value in item.items():
             for_challenge[key] = value
     return for_challenge
 
+class UploadPolicy(object):
+    """ Which uploads may be signed: allow rules, each for a bucket, a dataset
+    ('*' for any), a filename pattern (shell-style, '*' for any) and the
+    largest size allowed (None for any). They are read from a JSON file
+
+        {"rules": [{"bucket": "somebucket", "dataset": "731db507-...",
+                    "filename": "*.txt", "maxSize": 20480000}, ...]}
+
+    or from the rules table of an SQLite database (columns bucket, dataset,
+    filename and max_size), and indexed by (bucket, dataset), with the
+    patterns of the rules with the same size limit compiled into one regex.
+    The file is read again when it changes, checked at most every
+    CHECK_INTERVAL seconds; if it can't be read, the rules read before stay.
+    Uploads refused are remembered until then, so retries of a refused
+    upload are answered from a dict.
+    """
+
+    CHECK_INTERVAL = 1.0
+    DENIED_CACHE_SIZE = 4096
+
+    def __init__(self, path=None, rules=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        self.denied = {}
+        self.version = None
+        self.checked = 0
+        if rules is not None:
+            self.index = self.build(rules)
+        else:
+            self.refresh()
+
+    def allows(self, bucket, dataset, filename, size=None):
+        """ Whether an upload of filename, size bytes (None if unknown), to
+        dataset in bucket may be signed. """
+        self.refresh()
+        (index, denied) = (self.index, self.denied)
+        upload = (bucket, dataset, filename, size)
+        if upload in denied:
+            return False
+        for key in ((bucket, dataset), (bucket, '*')):
+            for (pattern, max_size) in index.get(key, ()):
+                if ((max_size is None or (size is not None and size <= max_size)) and
+                        (pattern is None or pattern.match(filename or ''))):
+                    return True
+        if len(denied) >= self.DENIED_CACHE_SIZE:
+            denied.clear()
+        denied[upload] = True
+        return False
+
+    def refresh(self):
+        """ Read the rules again if the file has changed. """
+        if self.path is None or time.time() - self.checked < self.CHECK_INTERVAL:
+            return
+        with self.lock:
+            if time.time() - self.checked < self.CHECK_INTERVAL:
+                return
+            self.checked = time.time()
+            version = self.stat()
+            if version == self.version:
+                return
+            try:
+                index = self.build(self.load())
+            except (EnvironmentError, ValueError, KeyError, TypeError, sqlite3.Error) as e:
+                log.warning('Could not read upload policy %s: %s', self.path, e,
+                            extra=log_event('policy', path=self.path))
+                return
+            (self.index, self.denied, self.version) = (index, {}, version)
+            log.info('Read upload policy %s', self.path, extra=log_event('policy', path=self.path))
+
+    def stat(self):
+        version = []
+        for path in (self.path, self.path + '-wal'):
+            try:
+                info = os.stat(path)
+            except OSError:
+                info = None
+            version.append(info and (info.st_ino, info.st_size, info.st_mtime_ns))
+        return tuple(version)
+
+    def load(self):
+        """ The rules in the file, as dicts. """
+        with open(self.path, 'rb') as f:
+            sqlite = f.read(16) == b'SQLite format 3\x00'
+        if not sqlite:
+            with open(self.path) as f:
+                return json.load(f)['rules']
+        db = sqlite3.connect(self.path)
+        try:
+            return [{'bucket': bucket, 'dataset': dataset, 'filename': filename,
+                     'maxSize': max_size}
+                    for (bucket, dataset, filename, max_size) in db.execute(
+                        'SELECT bucket, dataset, filename, max_size FROM rules')]
+        finally:
+            db.close()
+
+    @staticmethod
+    def build(rules):
+        """ {(bucket, dataset): ((regex or None, max_size), ...)} """
+        patterns = {}
+        for rule in rules:
+            key = (str(rule['bucket']), str(rule.get('dataset') or '*'))
+            max_size = rule.get('maxSize')
+            max_size = None if max_size is None else int(max_size)
+            patterns.setdefault(key, {}).setdefault(max_size, set()).add(
+                str(rule.get('filename') or '*'))
+        index = {}
+        for (key, by_size) in patterns.items():
+            index[key] = tuple(
+                (None if '*' in names else
+                 re.compile('|'.join('(?:%s)' % fnmatch.translate(name) for name in sorted(names))),
+                 max_size)
+                for (max_size, names) in by_size.items())
+        return index
+
+_upload_policy = None
+_upload_policy_lock = threading.Lock()
+
+def upload_policy():
+    """ The UploadPolicy of P3S3F_POLICY, or of the P3S3F_EXAMPLE_ALLOW_*
+    uploads if that is not set; None if neither is (everything is allowed). """
+    global _upload_policy
+    if _upload_policy is None:
+        with _upload_policy_lock:
+            if _upload_policy is None and P3S3F_POLICY:
+                _upload_policy = UploadPolicy(P3S3F_POLICY)
+            elif _upload_policy is None and os.getenv('P3S3F_EXAMPLE_ALLOW_SMALL') is not None:
+                # this simulates signing rejection based on data being expected
+                rules = []
+                for name in ('P3S3F_EXAMPLE_ALLOW_SMALL', 'P3S3F_EXAMPLE_ALLOW_LARGE'):
+                    if os.getenv(name):
+                        (bucket, dataset, filename) = os.getenv(name).split('/', 2)
+                        rules.append({'bucket': bucket, 'dataset': dataset,
+                                      'filename': re.sub(r'([*?[])', r'[\1]', filename)})
+                _upload_policy = UploadPolicy(rules=rules)
+    return _upload_policy
+
+def declared_size(to_challenge):
+    """ Size of the upload as the client declares it: the most its policy
+    allows (content-length-range, which S3 enforces), or for chunked uploads
+    the x-amz-meta-qqtotalfilesize header, if the client sends one. """
+    try:
+        if 'content-length-range' in to_challenge:
+            return int(to_challenge['content-length-range'][1])
+        if 'x-amz-meta-qqtotalfilesize' in to_challenge:
+            return int(to_challenge['x-amz-meta-qqtotalfilesize'])
+    except (ValueError, TypeError, IndexError):
+        pass
+    return None
+
 def challenge_is_good(to_challenge):
     """
     This is where you would run checks based on the 'x-aws-meta-' header elements
@@ -89,43 +523,97 @@ def challenge_is_good(to_challenge):
         name - original file name from client (no path)
         bucket - destination bucket
     Recommended you augment this with additional request.params fields in the js object.
+
+    Here they are checked against the rules of the upload policy (see
+    UploadPolicy), if there is one.
     """
+    policy = upload_policy()
+    if policy is None:
+        return True
+    return policy.allows(to_challenge['bucket'],
+                         to_challenge.get('x-amz-meta-dataset'),
+                         to_challenge.get('x-amz-meta-qqfilename'),
+                         declared_size(to_challenge))
 
-    transfer_req_for = '%s/%s/%s' % (to_challenge['bucket'],
-                                     to_challenge['x-amz-meta-dataset'],
-                                     to_challenge['x-amz-meta-qqfilename'])
+def challenge_from_rest_request(headers, v4):
+    """ What to challenge the string to sign of a REST request with: the
+    request that starts a chunked upload is, the ones for its parts and for
+    completing it (which carry its uploadId) are not (None). """
+    # this if is where you'd do some checking against the back end to check allowed to upload
+     # signifies first element of chunked data
+    if v4:
+        if headers.split('\n', 3)[3].startswith('POST') and 'uploadId' not in headers:
+            log.info('Chunked signing request', extra=log_event('sign', kind='chunked', v4=True))
+            return challenge_from_v4_headers(headers)
+    elif headers.startswith('POST') and 'uploadId' not in headers:
+        log.info('Chunked signing request', extra=log_event('sign', kind='chunked', v4=False))
+        return challenge_from_headers(headers)
+    return None
 
-    # this simulates signing rejection based on data being expected
-    # REMOVE/REPLACE BLOCK IN PRODUCTION CODE
-    if os.getenv('P3S3F_EXAMPLE_ALLOW_SMALL') is not None:
-        if (transfer_req_for == os.getenv('P3S3F_EXAMPLE_ALLOW_SMALL') or
-            transfer_req_for == os.getenv('P3S3F_EXAMPLE_ALLOW_LARGE')):
-           return True
-        return False
+def sign_rest_request(headers, v4):
+    if v4:
+        return sign_headers_v4(headers)
+    return sign_headers(headers)
 
+def batch_headers(request_payload, v4=False):
+    """ The strings to sign of a batch signing request: either its list of
+    'headers', or the 'headers' of one part of a multipart upload repeated
+    for every part number in 'partNumbers'. None if the request is neither.
 
+    A SigV4 canonical request carries the hash of its body, which differs
+    from part to part, so with v4 'partNumbers' only goes for parts sent
+    with an UNSIGNED-PAYLOAD. """
+    headers = request_payload.get('headers')
+    part_numbers = request_payload.get('partNumbers')
+    if part_numbers is None:
+        if not isinstance(headers, list) or not all(isinstance(item, str) for item in headers):
+            return None
+        return headers
+    if (not isinstance(headers, str) or 'uploadId=' not in headers or
+            len(PART_NUMBER.findall(headers)) != 1 or not isinstance(part_numbers, list)):
+        return None
+    if not all(type(number) is int and 0 < number <= SIGN_BATCH_LIMIT for number in part_numbers):
+        return None
+    if v4 and headers.rstrip('\n').rsplit('\n', 1)[-1] != 'UNSIGNED-PAYLOAD':
+        return None
+    return [PART_NUMBER.sub('partNumber=%d' % number, headers) for number in part_numbers]
+
+def challenge_batch(blocks, v4):
+    """ Challenge the uploads a batch of REST requests is for, each once
+    however many of its requests the batch has. """
+    approved = {}
+    for headers in blocks:
+        challenge_data = challenge_from_rest_request(headers, v4)
+        if challenge_data is None:
+            continue
+        upload = (challenge_data['bucket'], challenge_data['key'])
+        if upload not in approved:
+            log.info('Challenge', extra=log_event('challenge', challenge_data))
+            approved[upload] = challenge_is_good(challenge_data) is not False
+        if not approved[upload]:
+            return False
     return True
 
 def challenge_request(request):
     request_payload = request.get_json()
     response_data = None
     challenge_data = None
+    v4 = request.args.get('v4') == 'true'
     if request_payload.get('headers'):
-        # this if is where you'd do some checking against the back end to check allowed to upload
-         # signifies first element of chunked data
-        if request_payload['headers'].startswith('POST') and 'uploadId' not in request_payload['headers']:
-            print("\t**** Chunked signing request ****", file=sys.stderr)
-            challenge_data = challenge_from_headers(request_payload['headers'])
-        response_data = sign_headers(request_payload['headers'])
+        challenge_data = challenge_from_rest_request(request_payload['headers'], v4)
+        response_data = sign_rest_request(request_payload['headers'], v4)
     else:
         # this if is where you'd do some checking against the back end to check allowed to upload
-        print("\t**** Un-Chunked signing request ****", file=sys.stderr)
+        log.info('Un-chunked signing request', extra=log_event('sign', kind='simple', v4=v4))
         challenge_data = challenge_from_conditions(request_payload['conditions'])
-        response_data = sign_policy(request.data)
+        if v4:
+            response_data = sign_policy_v4(request.data, request_payload['conditions'])
+        else:
+            response_data = sign_policy(request.data)
 
     # although we've already done the signing, now do the actual challenge
     if challenge_data is not None:
-        print('\t' + str(challenge_data), file=sys.stderr)
+        log.info('Challenge', extra=log_event('challenge', challenge_data))
         if challenge_is_good(challenge_data) is False:
             return None
 
@@ -134,52 +622,458 @@ def challenge_request(request):
 @app.route("/s3/sign", methods=['POST'])
 def s3_signature():
     """ Route for signing the policy document or REST headers. """
-    response_data = challenge_request(request)
+    try:
+        response_data = challenge_request(request)
+    except (ValueError, IndexError):
+        # a malformed credential scope
+        abort(400)
     if response_data is None:
-        response_data = {'error': 'This file has not been approved for transfer, check upload is to correct dataset.'}
+        response_data = {'error': NOT_APPROVED}
     return jsonify(response_data)
 
+@app.route("/s3/sign/batch", methods=['POST'])
+def s3_batch_signature():
+    """ Route for signing many REST requests in one round trip, e.g. the
+    parts of a multipart upload. Takes {"headers": [...]}, or the headers of
+    one part and {"partNumbers": [...]}; returns {"signatures": [...]} in the
+    same order. """
+    request_payload = request.get_json()
+    v4 = request.args.get('v4') == 'true'
+    blocks = batch_headers(request_payload, v4) if isinstance(request_payload, dict) else None
+    if not blocks or len(blocks) > SIGN_BATCH_LIMIT:
+        abort(400)
+    if not challenge_batch(blocks, v4):
+        return jsonify({'error': NOT_APPROVED})
+    try:
+        signatures = [sign_rest_request(headers, v4)['signature'] for headers in blocks]
+    except (ValueError, IndexError):
+        abort(400)
+    return jsonify({'signatures': signatures})
+
+
+_s3_client = None
+_s3_client_pid = None
+_s3_lock = threading.Lock()
+
+def s3_client():
+    """ This process's boto3 S3 client. Clients are thread-safe, so one,
+    with a pool of P3S3F_S3_POOL connections, serves every request instead of
+    setting up credentials, endpoint and TLS again for each. """
+    global _s3_client, _s3_client_pid
+    with _s3_lock:
+        if _s3_client_pid != os.getpid():
+            import boto3
+            from botocore.config import Config
+            from botocore.utils import fix_s3_host
+
+            _s3_client = boto3.client("s3",
+                                      aws_access_key_id = AWS_CLIENT_ACCESS_KEY,
+                                      aws_secret_access_key = AWS_CLIENT_SECRET_KEY,
+                                      endpoint_url=AWS_ENDPOINT,
+                                      config=Config(max_pool_connections=P3S3F_S3_POOL))
+            _s3_client.meta.events.unregister('before-sign.s3', fix_s3_host)
+            _s3_client_pid = os.getpid()
+    return _s3_client
+
+class DeleteQueue(object):
+    """ Deletes S3 objects in the background, as few DeleteObjects calls as
+    possible: a thread takes the keys queued (for one bucket at a time, the
+    same key only once) up to BATCH_SIZE at once, waiting `linger` seconds for
+    more to come in first. Keys that fail are queued again after
+    `retry_delay` seconds, doubled on every attempt, until `max_attempts`.
+
+    `client` is called for the boto3 client to use. `totals` counts the
+    keys deleted, retried and given up on.
+    """
+
+    BATCH_SIZE = 1000  # the most keys a DeleteObjects call takes
+
+    def __init__(self, client, linger=0.05, max_attempts=8, retry_delay=1.0):
+        self.client = client
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.pending = collections.OrderedDict()  # (bucket, key): attempts
+        self.retries = []  # heap of (when, bucket, key, attempts)
+        self.busy = 0
+        self.totals = collections.Counter()
+        self.cond = threading.Condition()
+        self.thread_pid = None
+
+    def put(self, bucket, key):
+        """ Queue the object for deletion, and return at once. """
+        with self.cond:
+            self.pending.setdefault((bucket, key), 0)
+            if self.thread_pid != os.getpid():
+                thread = threading.Thread(target=self.run, name='s3-delete')
+                thread.daemon = True
+                thread.start()
+                self.thread_pid = os.getpid()
+            self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """ Wait for the keys queued to be deleted (or given up on); False if
+        some are still queued after timeout seconds. """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.pending or self.retries or self.busy:
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                self.cond.wait(None if deadline is None else deadline - time.time())
+        return True
+
+    def run(self):
+        while True:
+            (bucket, batch) = self.take()
+            try:
+                self.delete(bucket, batch)
+            except Exception:
+                log.exception('Deleting from %s failed', bucket, extra=log_event('delete', bucket=bucket))
+            finally:
+                with self.cond:
+                    self.busy -= 1
+                    self.cond.notify_all()
+
+    def take(self):
+        """ Wait for keys to delete, and return the next batch: the bucket,
+        and up to BATCH_SIZE (key, attempts) in it. """
+        with self.cond:
+            while not self.pending:
+                self.requeue()
+                if not self.pending:
+                    self.cond.wait(self.retries[0][0] - time.time() if self.retries else None)
+            deadline = time.time() + self.linger
+            while len(self.pending) < self.BATCH_SIZE and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            bucket = next(iter(self.pending))[0]
+            batch = []
+            for (pending_bucket, key) in list(self.pending):
+                if pending_bucket == bucket:
+                    batch.append((key, self.pending.pop((bucket, key))))
+                    if len(batch) == self.BATCH_SIZE:
+                        break
+            self.busy += 1
+            return (bucket, batch)
+
+    def requeue(self):
+        """ Queue again the keys whose retry is due. """
+        while self.retries and self.retries[0][0] <= time.time():
+            (_, bucket, key, attempts) = heapq.heappop(self.retries)
+            self.pending.setdefault((bucket, key), attempts)
+
+    def delete(self, bucket, batch):
+        try:
+            response = self.client().delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': key} for (key, _) in batch], 'Quiet': True})
+            failed = dict((error['Key'], error.get('Code')) for error in response.get('Errors', ()))
+        except Exception as e:
+            failed = dict((key, repr(e)) for (key, _) in batch)
+        with self.cond:
+            self.totals['deleted'] += len(batch) - len(failed)
+            for (key, attempts) in batch:
+                if key not in failed:
+                    continue
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    self.totals['failed'] += 1
+                    log.error('Gave up deleting %s/%s: %s', bucket, key, failed[key],
+                              extra=log_event('delete', bucket=bucket, key=key))
+                else:
+                    self.totals['retried'] += 1
+                    heapq.heappush(self.retries, (time.time() + self.retry_delay * 2 ** (attempts - 1),
+                                                  bucket, key, attempts))
+            self.cond.notify_all()
+
+_delete_queue = None
+
+def delete_queue():
+    """ This process's DeleteQueue, over s3_client(). Deletes still queued at
+    exit get a few seconds to go through. """
+    global _delete_queue
+    s3_client()  # no boto3, no queue
+    with _s3_lock:
+        if _delete_queue is None:
+            _delete_queue = DeleteQueue(s3_client, linger=P3S3F_DELETE_LINGER)
+            atexit.register(_delete_queue.flush, 5)
+    return _delete_queue
 
 # Probably delete this completely for systems that should't allow delete
 @app.route("/s3/delete/<key>", methods=['POST', 'DELETE'])
 def s3_delete(key=None):
-    """ Route for deleting files off S3. Uses the SDK. """
+    """ Route for deleting files off S3. Uses the SDK: the key is queued, and
+    deleted in the background together with the others queued meanwhile. """
 
     request_payload = request.values
 
-    print("\t**** THIS DATA USED TO NOTIFY BACKEND OF DELETED DATA ****", file=sys.stderr)
-    print("\tBucket: %s\n\tKey: %s" % (request_payload.get('bucket'), request_payload.get('key')), file=sys.stderr)
-    print("\t**********************************************************", file=sys.stderr)
+    # THIS DATA USED TO NOTIFY BACKEND OF DELETED DATA
+    log.info('Delete', extra=log_event('delete', bucket=request_payload.get('bucket'),
+                                   key=request_payload.get('key')))
 
+    if not request_payload.get('bucket') or not request_payload.get('key'):
+        abort(400)
     try:
-        import boto3
-        from botocore.utils import fix_s3_host
-
-        s3 = boto3.resource("s3",
-                            aws_access_key_id = AWS_CLIENT_ACCESS_KEY,
-                            aws_secret_access_key = AWS_CLIENT_SECRET_KEY,
-                            endpoint_url=AWS_ENDPOINT)
-        s3.meta.client.meta.events.unregister('before-sign.s3', fix_s3_host)
-
-        s3.meta.client.delete_object(Bucket=request_payload.get('bucket'),
-                                Key=request_payload.get('key'))
-
+        delete_queue().put(request_payload.get('bucket'), request_payload.get('key'))
         return make_response('', 200)
     except ImportError:
         abort(500)
 
+class NotificationQueue(object):
+    """ Completed uploads on their way to the backend. Events are added to an
+    SQLite (WAL) table, so they survive restarts, and it holds at most
+    `max_pending` of them: put() refuses more. A thread hands them to `sink`
+    in batches of up to `batch_size`, oldest first, and removes them once
+    the sink has returned. If the sink raises, it gets the same batch again
+    after `retry_delay` seconds, doubled each time up to `max_retry_delay`.
+    Delivery is at least once: a batch taken just before a crash comes again.
+
+    Every server process can queue events in the same file; one of them at a
+    time (flock on `<path>.lock`) delivers. `totals` counts the events
+    queued, refused, delivered and the sink's failures, in this process.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created REAL NOT NULL,
+            event TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path, sink, max_pending=100000, batch_size=100,
+                 retry_delay=1.0, max_retry_delay=60.0, interval=5.0):
+        self.path = path
+        self.sink = sink
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.interval = interval
+        self.totals = collections.Counter()
+        self.last_batch_seconds = 0.0
+        self.wakeup = threading.Event()
+        self.thread_pid = None
+        self._local = threading.local()
+        # taken to update totals (from request threads and the delivery
+        # thread alike) and to start the thread
+        self._lock = threading.Lock()
+
+    def put(self, event):
+        """ Queue event (a dict) and return at once; False if the queue is
+        full. """
+        with self._transaction() as db:
+            (first, last) = db.execute('SELECT min(id), max(id) FROM events').fetchone()
+            if first is not None and last - first + 1 >= self.max_pending:
+                with self._lock:
+                    self.totals['rejected'] += 1
+                return False
+            db.execute('INSERT INTO events (created, event) VALUES (?, ?)',
+                       (time.time(), json.dumps(event)))
+        with self._lock:
+            self.totals['queued'] += 1
+            if self.thread_pid != os.getpid():
+                thread = threading.Thread(target=self.run, name='notify')
+                thread.daemon = True
+                thread.start()
+                self.thread_pid = os.getpid()
+        self.wakeup.set()
+        return True
+
+    def pending(self):
+        """ (events queued, age in seconds of the oldest) """
+        (first, last, created) = self._connect().execute(
+            'SELECT min(id), max(id), (SELECT created FROM events ORDER BY id LIMIT 1) '
+            'FROM events').fetchone()
+        if first is None:
+            return (0, 0.0)
+        return (last - first + 1, time.time() - created)
+
+    def run(self):
+        delay = None
+        while True:
+            if delay:
+                time.sleep(delay)
+            else:
+                self.wakeup.wait(self.interval)
+                self.wakeup.clear()
+            try:
+                self.deliver()
+                delay = None
+            except Exception:
+                with self._lock:
+                    self.totals['failures'] += 1
+                delay = min(max(2 * (delay or 0), self.retry_delay), self.max_retry_delay)
+                log.exception('Delivering notifications failed, retrying in %gs', delay,
+                              extra=log_event('notify', retry_in=delay))
+
+    def deliver(self):
+        """ Hand the queued events to the sink until there are none left.
+        Returns how many were delivered, or None if another process is
+        delivering them; raises what the sink raises. """
+        lock = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EACCES):
+                    return None
+                raise
+            delivered = 0
+            while True:
+                rows = self._connect().execute('SELECT id, event FROM events ORDER BY id LIMIT ?',
+                                               (self.batch_size,)).fetchall()
+                if not rows:
+                    return delivered
+                started = time.time()
+                self.sink([json.loads(event) for (_, event) in rows])
+                self.last_batch_seconds = time.time() - started
+                with self._transaction() as db:
+                    db.execute('DELETE FROM events WHERE id <= ?', (rows[-1][0],))
+                delivered += len(rows)
+                with self._lock:
+                    self.totals['delivered'] += len(rows)
+        finally:
+            os.close(lock)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _connect(self):
+        # A connection can't be shared by threads, nor survive a fork.
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=FULL')
+            db.executescript(self.SCHEMA)
+            (local.db, local.pid) = (db, os.getpid())
+        return local.db
+
+class WebhookSink(object):
+    """ POSTs every batch to url as {"events": [...]}; an error status or no
+    answer within timeout seconds is a failure. """
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, events):
+        body = json.dumps({'events': events}).encode('utf-8')
+        notify = urllib.request.Request(self.url, data=body,
+                                        headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(notify, timeout=self.timeout) as response:
+            response.read()
+
+class SQLiteSink(object):
+    """ Adds every event to the completed_uploads table of an SQLite
+    database, for the backend to pick up. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, events):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS completed_uploads ('
+                           'bucket TEXT, key TEXT, uuid TEXT, name TEXT, '
+                           'received REAL, event TEXT)')
+                db.executemany('INSERT INTO completed_uploads VALUES (?, ?, ?, ?, ?, ?)',
+                               [(event.get('bucket'), event.get('key'), event.get('uuid'),
+                                 event.get('name'), event.get('received'), json.dumps(event))
+                                for event in events])
+        finally:
+            db.close()
+
+class FileSink(object):
+    """ Appends every event to a file, one JSON object a line. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, events):
+        with open(self.path, 'a') as out:
+            out.write(''.join(json.dumps(event) + '\n' for event in events))
+            out.flush()
+            os.fsync(out.fileno())
+
+def make_sink(spec):
+    """ The sink P3S3F_NOTIFY_SINK describes. """
+    if spec.startswith(('http://', 'https://')):
+        return WebhookSink(spec)
+    if spec.startswith('sqlite:'):
+        return SQLiteSink(spec[len('sqlite:'):])
+    if spec.startswith('file:'):
+        return FileSink(spec[len('file:'):])
+    if ':' in spec:
+        (module, name) = spec.split(':', 1)
+        return getattr(importlib.import_module(module), name)
+    raise ValueError('Unknown P3S3F_NOTIFY_SINK: %r' % spec)
+
+_notification_queue = None
+_notification_lock = threading.Lock()
+
+def notification_queue():
+    """ This process's NotificationQueue of P3S3F_NOTIFY_QUEUE, or None. """
+    global _notification_queue
+    if P3S3F_NOTIFY_QUEUE is None:
+        return None
+    with _notification_lock:
+        if _notification_queue is None:
+            _notification_queue = NotificationQueue(P3S3F_NOTIFY_QUEUE,
+                make_sink(P3S3F_NOTIFY_SINK or 'file:' + P3S3F_NOTIFY_QUEUE + '.jsonl'),
+                max_pending=P3S3F_NOTIFY_MAX_PENDING, batch_size=P3S3F_NOTIFY_BATCH)
+    return _notification_queue
+
 @app.route("/s3/success", methods=['GET', 'POST'])
 def s3_success():
     """ Success redirect endpoint for <=IE9. """
 
-    print("\t**** THIS DATA USED TO NOTIFY BACKEND OF COMPLETED DATA ****", file=sys.stderr)
-    for key, value in request.form.items():
-        # these don't have 'x-aws-meta-' prefix
-        print("\t%s : %s" % (key, value), file=sys.stderr)
-    print("\t************************************************************", file=sys.stderr)
+    # THIS DATA USED TO NOTIFY BACKEND OF COMPLETED DATA
+    # (the fields don't have the 'x-aws-meta-' prefix)
+    log.info('Upload completed', extra=log_event('success', request.values.to_dict()))
+
+    # the backend is told in the background, so its latency is not the client's
+    notifications = notification_queue()
+    if notifications is not None:
+        event = request.values.to_dict()
+        event['received'] = time.time()
+        if not notifications.put(event):
+            response = make_response('', 503)
+            response.headers['Retry-After'] = '10'
+            return response
 
     return make_response()
 
+@app.route("/metrics")
+def metrics():
+    """ Notification and delete queue figures of this process, and the log
+    records it dropped, in the Prometheus text format. """
+    lines = []
+    notifications = notification_queue()
+    if notifications is not None:
+        (depth, age) = notifications.pending()
+        lines += ['p3s3f_notifications_pending %d' % depth,
+                  'p3s3f_notifications_oldest_seconds %.3f' % age,
+                  'p3s3f_notifications_last_batch_seconds %.3f' % notifications.last_batch_seconds]
+        for name in ('queued', 'rejected', 'delivered', 'failures'):
+            lines.append('p3s3f_notifications_%s_total %d' % (name, notifications.totals[name]))
+    if _delete_queue is not None:
+        for name in ('deleted', 'retried', 'failed'):
+            lines.append('p3s3f_deletes_%s_total %d' % (name, _delete_queue.totals[name]))
+    lines.append('p3s3f_log_dropped_total{reason="queue_full"} %d' % log_queue.dropped)
+    for ((name, reason), count) in sorted(log_filter.dropped.items()):
+        lines.append('p3s3f_log_dropped_total{event="%s",reason="%s"} %d' % (name, reason, count))
+    response = make_response('\n'.join(lines) + '\n')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
 @app.route("/")
 def index():
     data = None
@@ -188,7 +1082,179 @@ def index():
     return data
 
 
+class KeepAliveHandler(WSGIRequestHandler):
+    """ HTTP/1.1, so clients can send one request after the other on a
+    connection. A connection idle for `timeout` seconds is closed, and so is
+    every connection once its worker is stopping, after telling the client so
+    in the response to its next request. """
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+
+    def end_headers(self):
+        if self.server.stopping and not self.close_connection:
+            self.send_header('Connection', 'close')
+        WSGIRequestHandler.end_headers(self)
+
+
+class WorkerServer(ThreadingMixIn, BaseWSGIServer):
+    """ The server of a worker process: a thread per connection, accepting
+    from the listening socket it shares with the other workers (fd). With a
+    `tls` context, connections are wrapped in TLS in their own thread, so a
+    slow handshake holds up nobody else. """
+    daemon_threads = True
+    multithread = True
+
+    def __init__(self, host, app, fd, tls=None):
+        BaseWSGIServer.__init__(self, host, 0, app, handler=KeepAliveHandler, fd=fd)
+        self.tls = tls
+        self.ssl_context = tls  # for wsgi.url_scheme
+        self.stopping = False
+        self.active = 0
+        self.idle = threading.Condition()
+
+    def process_request_thread(self, request, client_address):
+        with self.idle:
+            self.active += 1
+        try:
+            # the headers and body go out in separate writes; without this,
+            # the body waits for the client's delayed ACK on a kept-alive connection
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.tls is not None:
+                request.settimeout(KeepAliveHandler.timeout)
+                request = self.tls.wrap_socket(request, server_side=True)
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        except (OSError, ssl.SSLError):
+            self.shutdown_request(request)
+        finally:
+            with self.idle:
+                self.active -= 1
+                self.idle.notify_all()
+
+    def stop(self, timeout):
+        """ Stop accepting, and give the connections open timeout seconds
+        to finish. """
+        self.stopping = True
+        self.shutdown()
+        deadline = time.time() + timeout
+        with self.idle:
+            while self.active and time.time() < deadline:
+                self.idle.wait(deadline - time.time())
+
+def tls_context():
+    """ The TLS context of P3S3F_SRV_CRT/P3S3F_SRV_KEY if P3S3F_USE_HTTPS is 1. """
+    if os.getenv('P3S3F_USE_HTTPS') != '1':
+        return None
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(os.getenv('P3S3F_SRV_CRT'), os.getenv('P3S3F_SRV_KEY'))
+    return context
+
+def run_worker(listener, graceful_timeout):
+    """ Serve from the listening socket until SIGTERM, then finish the
+    requests in progress; the body of a worker process. """
+    server = WorkerServer(os.getenv('P3S3F_HOST_NAME') or '127.0.0.1', app,
+                          listener.fileno(), tls=tls_context())
+    listener.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master stops us
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+        target=server.stop, args=(graceful_timeout,)).start())
+    server.serve_forever()
+    # serve_forever() is back once stop() has stopped it; wait for the rest
+    server.stop(graceful_timeout)
+    if _delete_queue is not None:
+        _delete_queue.flush(5)
+    log_queue.stop()
+
+def serve(workers, graceful_timeout=30):
+    """ Pre-fork server: a master process listens on P3S3F_HOST_NAME and
+    P3S3F_HOST_PORT, and forks `workers` processes that accept connections
+    from that socket and serve them (HTTP/1.1 keep-alive, and HTTPS as for
+    app.run()), so signing uses every core. Workers that die are replaced.
+
+    SIGTERM or SIGINT stops the workers gracefully: they stop accepting and
+    get graceful_timeout seconds to finish the requests in progress. SIGHUP
+    restarts gracefully: the master executes itself again (picking up new
+    code and configuration), handing on the listening socket, starts new
+    workers and only then stops the old ones, so no connection is refused.
+    """
+    if os.getenv('P3S3F_LISTEN_FD'):
+        listener = socket.socket(fileno=int(os.environ.pop('P3S3F_LISTEN_FD')))
+    else:
+        listener = socket.create_server((os.getenv('P3S3F_HOST_NAME') or '127.0.0.1',
+                                         int(os.getenv('P3S3F_HOST_PORT') or 5000)),
+                                        backlog=1024)
+    tls_context()  # a bad certificate stops us here, rather than every worker
+    old_workers = [int(pid) for pid in os.environ.pop('P3S3F_OLD_WORKERS', '').split(',') if pid]
+    children = set()
+    signals = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(listener, graceful_timeout)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    for _ in range(workers):
+        spawn()
+    for pid in old_workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    print("\t**** Serving on %s:%d with %d workers (pid %d) ****"
+          % (listener.getsockname()[:2] + (workers, os.getpid())), file=sys.stderr)
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+    while True:
+        time.sleep(0.2)
+        while True:
+            try:
+                (pid, _) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if not pid:
+                break
+            if pid in children:
+                children.discard(pid)
+                if not signals:
+                    print("\t**** Worker %d died, starting another ****" % pid, file=sys.stderr)
+                    spawn()
+        if not signals:
+            continue
+        if signals[0] == signal.SIGHUP:
+            print("\t**** Restarting ****", file=sys.stderr)
+            listener.set_inheritable(True)
+            env = dict(os.environ, P3S3F_LISTEN_FD=str(listener.fileno()),
+                       P3S3F_OLD_WORKERS=','.join(str(pid) for pid in children))
+            sys.stdout.flush()
+            os.execve(sys.executable, [sys.executable] + sys.argv, env)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + graceful_timeout + 5
+        while children and time.time() < deadline:
+            try:
+                (pid, _) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                children.discard(pid)
+            else:
+                time.sleep(0.1)
+        for pid in children:
+            os.kill(pid, signal.SIGKILL)
+        return 0
+
 def main(argv=None):
+    workers = os.getenv('P3S3F_WORKERS', '0')
+    workers = os.cpu_count() if workers == 'auto' else int(workers)
+    if workers > 0:
+        KeepAliveHandler.timeout = float(os.getenv('P3S3F_KEEPALIVE', '5'))
+        return serve(workers, float(os.getenv('P3S3F_GRACEFUL_TIMEOUT', '30')))
+
     print("\n#####\n!\tWARNING: This example is using app.run() please see:\n!\t\thttp://flask.pocoo.org/docs/latest/api/#flask.Flask.run\n#####\n", file=sys.stderr)
     threaded = False
     if os.getenv('P3S3F_THREADED') == '1' :
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+""" Load test for the traditional upload servers (flask-fine-uploader,
+django-fine-uploader, or flask-fine-uploader's aio_server.py).
+
+Simulates concurrent Fine Uploader clients over HTTP: each one uploads
+files, chunked or not, sending the chunks in order or several at a time
+(concurrent chunking), and optionally deletes them again. Reports
+uploads/sec, MB/s, p50/p99 latency of chunk, final-chunk and delete
+requests, and the peak RSS of every server process.
+
+    python3 bench.py --url http://127.0.0.1:5000 \\
+        --server 'python app.py' --server-cwd ../flask-fine-uploader \\
+        --clients 16 --uploads 20 --file-size 8M --chunk-size 1M
+
+Requires Python 3.5+ and nothing else.
+"""
+import argparse
+import collections
+import concurrent.futures
+import http.client
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+BOUNDARY = 'FineUploaderBenchBoundary'
+
+
+def parse_size(text):
+    """ '512', '64K', '8M', '1G' -> bytes."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def multipart_body(fields, data):
+    """ A Fine Uploader upload request body: the fields, then qqfile."""
+    head = ''.join('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+        % (BOUNDARY, name, value) for name, value in fields)
+    head += ('--%s\r\nContent-Disposition: form-data; name="qqfile"; filename="blob"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n' % BOUNDARY)
+    return head.encode('ascii') + data + ('\r\n--%s--\r\n' % BOUNDARY).encode('ascii')
+
+
+class Client(object):
+    """ One simulated browser: uploads files one after the other over its
+    own connections, `concurrency` chunks at a time.
+    """
+
+    def __init__(self, url, stats, data, chunk_size, concurrency, delete):
+        self.url = urlsplit(url)
+        self.stats = stats
+        self.data = data
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.delete = delete
+        self.local = threading.local()
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency) \
+            if concurrency > 1 else None
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = http.client.HTTPConnection(
+                self.url.hostname, self.url.port or 80, timeout=300)
+        return self.local.connection
+
+    def request(self, kind, method, path, body=None):
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        if body is not None:
+            headers['Content-Type'] = 'multipart/form-data; boundary=%s' % BOUNDARY
+        started = time.time()
+        try:
+            connection = self.connection()
+            connection.request(method, self.url.path.rstrip('/') + path, body, headers)
+            response = connection.getresponse()
+            content = response.read()
+            if response.getheader('connection', '').lower() == 'close':
+                connection.close()
+            ok = response.status == 200 and json.loads(content.decode('utf-8')).get('success')
+        except (OSError, http.client.HTTPException, ValueError):
+            self.local.connection = None
+            ok = False
+        self.stats.record(kind, time.time() - started, ok)
+        return ok
+
+    def upload(self):
+        qquuid = str(uuid.uuid4())
+        size = len(self.data)
+        if not self.chunk_size or self.chunk_size >= size:
+            ok = self.request('final', 'POST', '/upload', multipart_body(
+                [('qquuid', qquuid), ('qqfilename', 'bench.bin'),
+                 ('qqtotalfilesize', size)], self.data))
+        else:
+            total_parts = -(-size // self.chunk_size)
+
+            def send(index):
+                offset = index * self.chunk_size
+                chunk = self.data[offset:offset + self.chunk_size]
+                return self.request('final' if index == total_parts - 1 else 'chunk',
+                    'POST', '/upload', multipart_body([
+                        ('qquuid', qquuid), ('qqfilename', 'bench.bin'),
+                        ('qqtotalfilesize', size), ('qqtotalparts', total_parts),
+                        ('qqpartindex', index), ('qqpartbyteoffset', offset),
+                        ('qqchunksize', len(chunk))], chunk))
+
+            # Like Fine Uploader, the last chunk is only sent once all the
+            # others are in.
+            parts = range(total_parts - 1)
+            if self.executor is None:
+                ok = all([send(index) for index in parts])
+            else:
+                ok = all(self.executor.map(send, parts))
+            ok = send(total_parts - 1) and ok
+
+        self.stats.uploaded(size if ok else 0, ok)
+        if ok and self.delete:
+            self.request('delete', 'DELETE', '/upload/%s' % qquuid)
+
+    def run(self, uploads):
+        try:
+            for _ in range(uploads):
+                self.upload()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+
+class Stats(object):
+    """ Latencies and outcomes of the requests, by kind."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.uploads = 0
+        self.failed_uploads = 0
+        self.bytes = 0
+
+    def record(self, kind, seconds, ok):
+        with self.lock:
+            self.latencies[kind].append(seconds)
+            if not ok:
+                self.errors[kind] += 1
+
+    def uploaded(self, size, ok):
+        with self.lock:
+            if ok:
+                self.uploads += 1
+                self.bytes += size
+            else:
+                self.failed_uploads += 1
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of sorted `values`."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(-(-fraction * len(values) // 1)) - 1))]
+
+
+class RSSMonitor(object):
+    """ Tracks the peak resident set size (VmHWM) of a process and all its
+    descendants, e.g. a pre-forking server and its workers, from /proc.
+    """
+
+    def __init__(self, pids, interval=0.25):
+        self.pids = list(pids)
+        self.interval = interval
+        self.peaks = {}
+        self.names = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='rss')
+        self.thread.daemon = True
+
+    def start(self):
+        if os.path.isdir('/proc') and self.pids:
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.sample()
+        return self.peaks
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        for pid in self.tree():
+            try:
+                with open('/proc/%d/status' % pid) as status:
+                    for line in status:
+                        if line.startswith('Name:'):
+                            self.names[pid] = line.split()[1]
+                        elif line.startswith('VmHWM:'):
+                            kib = int(line.split()[1])
+                            self.peaks[pid] = max(self.peaks.get(pid, 0), kib * 1024)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def tree(self):
+        children = collections.defaultdict(list)
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open('/proc/%s/stat' % name) as stat:
+                        # The command may contain spaces: the ppid follows ')'.
+                        ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+                except (IOError, OSError, ValueError, IndexError):
+                    continue
+                children[ppid].append(int(name))
+        found, pending = [], list(self.pids)
+        while pending:
+            pid = pending.pop()
+            found.append(pid)
+            pending.extend(children.get(pid, ()))
+        return found
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def run(args):
+    url = urlsplit(args.url)
+    server = None
+    if args.server:
+        server = subprocess.Popen(shlex.split(args.server), cwd=args.server_cwd,
+            stdout=subprocess.DEVNULL if args.quiet_server else None,
+            stderr=subprocess.DEVNULL if args.quiet_server else None)
+    try:
+        wait_for_port(url.hostname, url.port or 80)
+        pids = list(args.pid) + ([server.pid] if server else [])
+        monitor = RSSMonitor(pids).start()
+
+        stats = Stats()
+        data = os.urandom(args.file_size)
+        clients = [Client(args.url, stats, data, args.chunk_size,
+            args.concurrent_chunks, args.delete) for _ in range(args.clients)]
+        started = time.time()
+        with concurrent.futures.ThreadPoolExecutor(args.clients) as executor:
+            list(executor.map(lambda client: client.run(args.uploads), clients))
+        elapsed = time.time() - started
+        peaks = monitor.stop()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results = {
+        'config': {
+            'clients': args.clients, 'uploads_per_client': args.uploads,
+            'file_size': args.file_size, 'chunk_size': args.chunk_size,
+            'concurrent_chunks': args.concurrent_chunks, 'delete': args.delete,
+        },
+        'seconds': elapsed,
+        'uploads': stats.uploads,
+        'failed_uploads': stats.failed_uploads,
+        'uploads_per_sec': stats.uploads / elapsed,
+        'mb_per_sec': stats.bytes / elapsed / 1024 ** 2,
+        'latency': {},
+        'errors': dict(stats.errors),
+        'peak_rss': dict((str(pid), peak) for pid, peak in sorted(peaks.items())),
+        'process_names': dict((str(pid), name) for pid, name in monitor.names.items()),
+    }
+    for kind, latencies in sorted(stats.latencies.items()):
+        latencies.sort()
+        results['latency'][kind] = {
+            'count': len(latencies),
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1],
+        }
+    return results
+
+
+def report(results, out=sys.stdout):
+    config = results['config']
+    out.write('%d clients x %d uploads of %d bytes, %s\n' % (config['clients'],
+        config['uploads_per_client'], config['file_size'],
+        'chunks of %d bytes, %d at a time' % (config['chunk_size'], config['concurrent_chunks'])
+        if config['chunk_size'] else 'not chunked'))
+    out.write('%d uploads (%d failed) in %.2fs: %.1f uploads/s, %.1f MB/s\n\n' % (
+        results['uploads'], results['failed_uploads'], results['seconds'],
+        results['uploads_per_sec'], results['mb_per_sec']))
+    out.write('%-8s %8s %8s %10s %10s %10s %10s\n' % ('request', 'count',
+        'errors', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'))
+    for kind, latency in sorted(results['latency'].items()):
+        out.write('%-8s %8d %8d %10.1f %10.1f %10.1f %10.1f\n' % (kind,
+            latency['count'], results['errors'].get(kind, 0), latency['mean'] * 1000,
+            latency['p50'] * 1000, latency['p99'] * 1000, latency['max'] * 1000))
+    if results['peak_rss']:
+        out.write('\n%-8s %-16s %12s\n' % ('pid', 'process', 'peak RSS MB'))
+        for pid, peak in sorted(results['peak_rss'].items(), key=lambda item: int(item[0])):
+            out.write('%-8s %-16s %12.1f\n' % (pid,
+                results['process_names'].get(pid, '?'), peak / 1024.0 ** 2))
+
+
+def regressions(results, baseline, tolerance):
+    """ How `results` fall short of `baseline` by more than `tolerance` (a
+    fraction): lower throughput, or higher p50/p99 latency.
+    """
+    found = []
+    for key in ('uploads_per_sec', 'mb_per_sec'):
+        if results[key] < baseline[key] * (1 - tolerance):
+            found.append('%s: %.2f, was %.2f' % (key, results[key], baseline[key]))
+    for kind, latency in sorted(results['latency'].items()):
+        before = baseline['latency'].get(kind)
+        for key in ('p50', 'p99'):
+            if before and latency[key] > before[key] * (1 + tolerance):
+                found.append('%s %s: %.1fms, was %.1fms' % (kind, key,
+                    latency[key] * 1000, before[key] * 1000))
+    if results['failed_uploads'] > baseline['failed_uploads']:
+        found.append('failed uploads: %d, was %d' % (results['failed_uploads'],
+            baseline['failed_uploads']))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000',
+        help='where the server is (default: %(default)s)')
+    parser.add_argument('--server', help='command that starts the server; it is '
+        'started before and stopped after the run, and its processes measured')
+    parser.add_argument('--server-cwd', help='directory to start the server in')
+    parser.add_argument('--quiet-server', action='store_true',
+        help="discard the server's output")
+    parser.add_argument('--pid', type=int, action='append', default=[],
+        help='also measure the peak RSS of this (already running) server '
+        'process and its children; may be repeated')
+    parser.add_argument('--clients', type=int, default=8,
+        help='concurrent clients (default: %(default)s)')
+    parser.add_argument('--uploads', type=int, default=10,
+        help='uploads per client (default: %(default)s)')
+    parser.add_argument('--file-size', type=parse_size, default=parse_size('4M'),
+        help='size of every file, e.g. 512K, 8M (default: 4M)')
+    parser.add_argument('--chunk-size', type=parse_size, default=parse_size('1M'),
+        help='chunk size; 0 to send files whole (default: 1M)')
+    parser.add_argument('--concurrent-chunks', type=int, default=1,
+        help='chunks of a file sent at once, 1 for in order (default: %(default)s)')
+    parser.add_argument('--delete', action='store_true',
+        help='delete every file after uploading it')
+    parser.add_argument('--json', metavar='FILE',
+        help="also write the results as JSON ('-' for stdout)")
+    parser.add_argument('--baseline', metavar='FILE',
+        help='JSON results of an earlier run: exit with status 1 if this run '
+        'is slower by more than --tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='fraction a run may be slower than the baseline (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    report(results)
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    elif args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            found = regressions(results, json.load(baseline), args.tolerance)
+        for regression in found:
+            sys.stdout.write('REGRESSION %s\n' % regression)
+        if found:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)